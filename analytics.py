@@ -0,0 +1,201 @@
+from __future__ import annotations
+import time
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+import db
+import category_tree
+
+# Инкрементальная аналитика продаж: дневные агрегаты по товарам и категориям
+# (выручка, штуки, уникальные покупатели). Выдача заказа на сайте обновляет их сразу
+# (выручка — оплаченная сумма, после промокода), платежи ботов добираются пакетами через
+# catch_up() по таблице payments: продление подписки в боте обновляет уже существующую строку
+# purchases, а платёж всегда новый. Дашборд читает только агрегаты — сырые purchases/payments
+# на общей с ботами базе не сканируются.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS web_sales_daily_tariff(
+    day TEXT NOT NULL, tariff_id INTEGER NOT NULL,
+    revenue INTEGER NOT NULL DEFAULT 0, units INTEGER NOT NULL DEFAULT 0, buyers INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(day, tariff_id));
+CREATE TABLE IF NOT EXISTS web_sales_daily_category(
+    day TEXT NOT NULL, category_id INTEGER NOT NULL,
+    revenue INTEGER NOT NULL DEFAULT 0, units INTEGER NOT NULL DEFAULT 0, buyers INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(day, category_id));
+CREATE TABLE IF NOT EXISTS web_sales_buyers(
+    day TEXT NOT NULL, scope TEXT NOT NULL, ref_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+    PRIMARY KEY(day, scope, ref_id, user_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS web_sales_applied(ref TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS web_sales_state(key TEXT PRIMARY KEY, value INTEGER);
+"""
+_schema_ready = False
+
+def _ensure_schema(conn) -> None:
+    global _schema_ready
+    if not _schema_ready:
+        conn.executescript(_SCHEMA)
+        _schema_ready = True
+
+def _ready() -> None:
+    # DDL — отдельным соединением: executescript коммитит, внутри пачки писателя ему не место
+    if not _schema_ready:
+        conn = db._connect()
+        try:
+            _ensure_schema(conn)
+        finally:
+            conn.close()
+
+def _day(ts: Optional[int]) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(int(ts or time.time())))
+
+def _add_buyer(conn, day: str, scope: str, ref_id: int, user_id: int) -> int:
+    if not user_id or user_id <= 0:
+        return 0
+    return conn.execute("INSERT OR IGNORE INTO web_sales_buyers(day, scope, ref_id, user_id) VALUES(?,?,?,?);",
+                        (day, scope, ref_id, user_id)).rowcount
+
+def _bump(conn, day: str, scope: str, ref_id: int, user_id: int, revenue: int, units: int) -> None:
+    table, col = (("web_sales_daily_tariff", "tariff_id") if scope == "t"
+                  else ("web_sales_daily_category", "category_id"))
+    new_buyer = _add_buyer(conn, day, scope, ref_id, user_id)
+    conn.execute(
+        f"INSERT INTO {table}(day, {col}, revenue, units, buyers) VALUES(?,?,?,?,?) "
+        f"ON CONFLICT(day, {col}) DO UPDATE SET revenue = revenue + excluded.revenue, "
+        f"units = units + excluded.units, buyers = buyers + excluded.buyers;",
+        (day, ref_id, revenue, units, new_buyer))
+
+def _apply(conn, cats: Dict[int, int], day: str, user_id: int, lines: Iterable[Tuple[int, int, int]]) -> None:
+    """lines: (tariff_id, revenue, units); cats — tariff_id -> category_id из дерева каталога."""
+    # уникальные покупатели дня целиком (scope 'd'): сумма по категориям посчитала бы человека
+    # с покупками в двух категориях дважды
+    _add_buyer(conn, day, "d", 0, user_id)
+    for tariff_id, revenue, units in lines:
+        _bump(conn, day, "t", int(tariff_id), user_id, int(revenue), int(units))
+        _bump(conn, day, "c", cats.get(int(tariff_id), 0), user_id, int(revenue), int(units))
+
+def _split(total: int, lines: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """Разнести оплаченную сумму по строкам пропорционально их цене (остаток — самым дорогим)."""
+    full = sum(rev for _, rev, _ in lines)
+    if not full:
+        return [(tid, 0, units) for tid, _, units in lines]
+    shares = [total * rev // full for _, rev, _ in lines]
+    for i in sorted(range(len(lines)), key=lambda i: -lines[i][1])[:total - sum(shares)]:
+        shares[i] += 1
+    return [(tid, share, units) for (tid, _, units), share in zip(lines, shares)]
+
+def record_order(payment_id: str, user_id: int, items: List[Dict[str, Any]], total: int,
+                 ts: Optional[int] = None) -> None:
+    """Учесть выданный заказ витрины (вызывается из _deliver_order после выдачи).
+    total — оплаченная сумма (после промокода). Повтор по тому же payment_id игнорируется."""
+    _ready()
+    cats = category_tree.get_tree().tariff_cat
+    lines = _split(int(total), [(int(it['tariff_id']), int(it['price']) * int(it['quantity']),
+                                 int(it['quantity'])) for it in items])
+
+    def _do(conn):
+        cur = conn.execute("INSERT OR IGNORE INTO web_sales_applied(ref) VALUES(?);", (payment_id,))
+        if cur.rowcount:
+            _apply(conn, cats, _day(ts), int(user_id or -1), lines)
+    db._write(_do)
+
+def _payment_lines(conn, p) -> Tuple[Optional[int], List[Tuple[int, int, int]]]:
+    """Момент и строки (tariff_id, выручка, штуки) платежа, которого ещё нет в агрегатах."""
+    ts = None
+    for col in db._PAYMENT_TIME_COLUMNS:
+        if col in p.keys() and p[col]:
+            ts = int(p[col])
+            break
+    bought = conn.execute(
+        "SELECT tariff_id, price, COALESCE(last_ttl_update, bought_at) AS ts FROM purchases "
+        "WHERE payment_id = ?;", (p['guid'],)).fetchall() if db._table_exists(conn, "purchases") else []
+    if ts is None and bought:
+        # в схеме ботов у payments нет времени — берём момент последней записи покупки по этому платежу
+        ts = max(int(r['ts'] or 0) for r in bought) or None
+    amount = int(p['amount'] or 0)
+    if int(p['tariff_id'] or 0) > 0:
+        return ts, [(int(p['tariff_id']), amount, 1)]
+    # заказ-корзина витрины, не учтённый при выдаче: товары — в purchases с тем же payment_id
+    return ts, _split(amount, [(int(r['tariff_id']), int(r['price'] or 0), 1) for r in bought])
+
+def catch_up(batch: int = 500, max_batches: Optional[int] = None) -> int:
+    """Добрать платежи, записанные мимо витрины (боты, в т.ч. продления), по водяному знаку payments.rowid.
+    Каждый пакет — отдельная короткая транзакция. Возвращает число учтённых платежей."""
+    _ready()
+    cats = category_tree.get_tree().tariff_cat
+
+    def _do(conn) -> int:
+        if not db._table_exists(conn, "payments"):
+            return 0
+        row = conn.execute("SELECT value FROM web_sales_state WHERE key='payments_watermark';").fetchone()
+        mark = int(row['value']) if row else 0
+        rows = conn.execute(
+            "SELECT py.rowid AS _k, py.* FROM payments py WHERE py.rowid > ? ORDER BY py.rowid LIMIT ?;",
+            (mark, batch)).fetchall()
+        for r in rows:
+            if conn.execute("INSERT OR IGNORE INTO web_sales_applied(ref) VALUES(?);", (r['guid'],)).rowcount:
+                ts, lines = _payment_lines(conn, r)
+                _apply(conn, cats, _day(ts), int(r['user_id'] or -1), lines)
+        if rows:
+            mark = int(rows[-1]['_k'])
+        conn.execute("INSERT INTO web_sales_state(key, value) VALUES('payments_watermark', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value;", (mark,))
+        return len(rows)
+
+    total = 0
+    n = 0
+    while max_batches is None or n < max_batches:
+        n += 1
+        done = db._write(_do)
+        total += done
+        if done < batch:
+            break
+    return total
+
+# ---------------- Чтение (только агрегаты) ----------------
+
+def daily_units(days: int) -> List[Tuple[str, int, int]]:
+    """(day, tariff_id, units) за последние days дней — источник для индекса популярности."""
+    since = _day(time.time() - (days - 1) * 86400)
+    conn = db._connect()
+    try:
+        _ensure_schema(conn)
+        return [(r['day'], int(r['tariff_id']), int(r['units'])) for r in conn.execute(
+            "SELECT day, tariff_id, units FROM web_sales_daily_tariff WHERE day >= ?;", (since,)).fetchall()]
+    finally:
+        conn.close()
+
+def dashboard(days: int = 30) -> Dict[str, Any]:
+    since = _day(time.time() - (days - 1) * 86400)
+    conn = db._connect()
+    try:
+        _ensure_schema(conn)
+        daily = [dict(r) for r in conn.execute(
+            "SELECT day, SUM(revenue) AS revenue, SUM(units) AS units FROM web_sales_daily_tariff "
+            "WHERE day >= ? GROUP BY day ORDER BY day DESC;", (since,)).fetchall()]
+        buyers = {r['day']: r['buyers'] for r in conn.execute(
+            "SELECT day, COUNT(*) AS buyers FROM web_sales_buyers WHERE scope = 'd' AND day >= ? GROUP BY day;",
+            (since,)).fetchall()}
+        for d in daily:
+            d['buyers'] = buyers.get(d['day'], 0)
+        top_tariffs = [dict(r) for r in conn.execute(
+            "SELECT s.tariff_id, COALESCE(t.name, '#' || s.tariff_id) AS name, SUM(s.revenue) AS revenue, "
+            "SUM(s.units) AS units FROM web_sales_daily_tariff s LEFT JOIN tariffs t ON t.id = s.tariff_id "
+            "WHERE s.day >= ? GROUP BY s.tariff_id ORDER BY revenue DESC LIMIT 20;", (since,)).fetchall()]
+        categories = [dict(r) for r in conn.execute(
+            "SELECT category_id, SUM(revenue) AS revenue, SUM(units) AS units FROM web_sales_daily_category "
+            "WHERE day >= ? GROUP BY category_id ORDER BY revenue DESC;", (since,)).fetchall()]
+        row = conn.execute("SELECT value FROM web_sales_state WHERE key='payments_watermark';").fetchone()
+    finally:
+        conn.close()
+    tree = category_tree.get_tree()
+    for c in categories:
+        node = tree.get(c['category_id']) if c['category_id'] else None
+        c['name'] = node['name'] if node else 'Без категории'
+    return {
+        "days": days,
+        "daily": daily,
+        "top_tariffs": top_tariffs,
+        "categories": categories,
+        "revenue": sum(d['revenue'] or 0 for d in daily),
+        "units": sum(d['units'] or 0 for d in daily),
+        "watermark": int(row['value']) if row else 0,
+    }
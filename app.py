@@ -1,30 +1,182 @@
+import functools
+import os
+import stat
+import threading
 import time
-from flask import Flask, g, session
+import click
+from flask import Flask, g, session, request
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 import config
+import metrics
+import static_export
+import compression
+import profiler
 from routes_main import main_bp
 from routes_admin import admin_bp
 
-app = Flask(__name__, static_url_path='/static')
-app.config['SECRET_KEY'] = config.SECRET_KEY
+# Фильтр Jinja для форматирования timestamp. У покупок и заказов сроки часто совпадают
+# (одинаковые длительности, одна оплата), поэтому строки кэшируются по целому timestamp
+@functools.lru_cache(maxsize=4096)
+def _fmt_ts(ts: int) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
 
-# Регистрация блюпринтов
-app.register_blueprint(main_bp)
-app.register_blueprint(admin_bp)
-
-# Фильтр Jinja для форматирования timestamp
-@app.template_filter('dt')
 def _fmt_dt(ts):
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(ts))) if ts else ""
+    return _fmt_ts(int(ts)) if ts else ""
 
-# Контекст-процессор: прокидываем некоторые переменные во все шаблоны
-@app.context_processor
+# Контекст-процессор: прокидываем некоторые переменные во все шаблоны.
+# Считается один раз на запрос (g), а не на каждый render_template/include
 def inject_globals():
-    cart = session.get('cart') or []
-    return {
-        'cfg': config,
-        'cart_count': sum(int(it.get('quantity', 1)) for it in cart)
-    }
+    cached = g.get('_template_globals')
+    if cached is None:
+        cart = session.get('cart') or []
+        cached = g._template_globals = {
+            'cfg': config,
+            'cart_count': sum(int(it.get('quantity', 1)) for it in cart),
+            # страница для static_export.py: сессионная часть придёт из /api/session
+            'static_page': static_export.is_static_request(request),
+        }
+    return cached
+
+def _bytecode_cache(path: str):
+    """Кэш байткода Jinja. Байткод исполняется при загрузке, поэтому чужой или доступный другим
+    каталог не принимаем; без пути Jinja сама создаёт и проверяет каталог пользователя во временной папке."""
+    from jinja2 import FileSystemBytecodeCache
+    if not path:
+        return FileSystemBytecodeCache()
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+        raise RuntimeError(f"{path}: каталог должен принадлежать текущему пользователю и иметь права 0700")
+    return FileSystemBytecodeCache(path)
+
+def warm_templates(app: Flask) -> int:
+    """Скомпилировать все шаблоны заранее. Байткод ложится в кэш Jinja и переиспользуется
+    воркерами и перезапусками; с --preload скомпилированные шаблоны наследуются после fork."""
+    n = 0
+    for name in app.jinja_env.list_templates(extensions=("html",)):
+        app.jinja_env.get_template(name)
+        n += 1
+    return n
+
+def _search_reindex():
+    """Полная пересборка FTS-индекса товаров: подхватывает правки ботов (по крону)."""
+    import db
+    if not db.ensure_search_index():
+        print(f"Нет базы {config.SHOP_DB} или FTS5 недоступен в этой сборке SQLite")
+        return
+    print(f"Проиндексировано товаров: {db.rebuild_search_index()}")
+
+def _sales_catchup():
+    """Добрать в агрегаты продаж покупки, записанные ботами (по крону)."""
+    import analytics
+    print(f"Учтено платежей: {analytics.catch_up()}")
+
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Только проверить файл.')
+def _catalog_import(path, dry_run):
+    """Массовый импорт каталога из JSON/CSV (см. catalog_import.py)."""
+    import catalog_import
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        summary = catalog_import.import_catalog(
+            catalog_import.parse(data, 'json' if path.lower().endswith('.json') else 'csv'), dry_run=dry_run)
+    except catalog_import.ImportValidationError as e:
+        for err in e.errors:
+            print(err)
+        raise SystemExit(1)
+    except ValueError as e:
+        # битый JSON/CSV или не UTF-8
+        print(f"Не удалось разобрать файл: {e}")
+        raise SystemExit(1)
+    print(("Проверено: " if dry_run else "Импортировано: ") + ", ".join(f"{k}={v}" for k, v in summary.items()))
+
+@click.argument('out_dir', type=click.Path(file_okay=False))
+@click.option('--force', is_flag=True, help='Перерисовать все страницы, даже неизменившиеся.')
+def _static_export(out_dir, force):
+    """Статическая выгрузка главной, категорий и карточек товаров (см. static_export.py)."""
+    from flask import current_app
+    stats = static_export.export(current_app, out_dir, force=force)
+    print(", ".join(f"{k}={v}" for k, v in stats.items()))
+
+def warm_catalog() -> None:
+    """Собрать каталожные индексы в памяти один раз. В мастере gunicorn --preload это происходит
+    до fork, и воркеры получают готовый снимок без собственной загрузки."""
+    import category_tree
+    import popularity
+    category_tree.get_tree()
+    popularity.get_index()
+
+def create_app(preload: bool = None) -> Flask:
+    """Фабрика приложения. gunicorn: `gunicorn --preload wsgi:app` (см. wsgi.py)."""
+    app = Flask(__name__, static_url_path='/static')
+    app.config['SECRET_KEY'] = config.SECRET_KEY
+    if config.TRUSTED_PROXY_HOPS > 0:
+        # remote_addr — последний адрес, добавленный нашими прокси, а не то, что прислал клиент
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.TRUSTED_PROXY_HOPS)
+
+    # Тайминги запросов, счётчики SQL, /metrics
+    metrics.install(app)
+    # gzip/br для HTML и JSON
+    compression.install(app)
+    # сэмплирующий профайлер (/admin/profile); выключенный — одна проверка на запрос
+    profiler.install(app)
+
+    # Регистрация блюпринтов
+    app.register_blueprint(main_bp)
+    app.register_blueprint(admin_bp)
+
+    if config.JINJA_BYTECODE_CACHE:
+        try:
+            app.jinja_env.bytecode_cache = _bytecode_cache(config.JINJA_CACHE_DIR)
+        except RuntimeError as e:
+            app.logger.warning(f"Jinja bytecode cache disabled: {e}")
+    app.add_template_filter(_fmt_dt, 'dt')
+    app.context_processor(inject_globals)
+    app.cli.command('search-reindex')(_search_reindex)
+    app.cli.command('sales-catchup')(_sales_catchup)
+    app.cli.command('catalog-import')(_catalog_import)
+    app.cli.command('static-export')(_static_export)
+
+    try:
+        warm_templates(app)
+    except Exception as e:
+        app.logger.warning(f"Template warm-up failed: {e}")
+
+    import db
+    try:
+        # индексы под сортировки каталога — здесь, а не в запросах на чтение
+        db.ensure_catalog_indexes()
+    except Exception as e:
+        app.logger.warning(f"Catalog index setup failed: {e}")
+
+    try:
+        # FTS-индекс — здесь, а не при первом поиске
+        db.ensure_search_index()
+    except Exception as e:
+        app.logger.warning(f"Search index setup failed: {e}")
+
+    if config.PRELOAD_CATALOG if preload is None else preload:
+        try:
+            warm_catalog()
+        except Exception as e:
+            app.logger.warning(f"Catalog warm-up failed: {e}")
+    return app
+
+# Экземпляр приложения не создаётся при импорте модуля. `app.app` собирается при первом обращении
+# (один на процесс) — для прежних `gunicorn app:app` и `flask --app app`; wsgi.py берёт его же.
+_app = None
+_app_lock = threading.Lock()
+
+def __getattr__(name: str):
+    global _app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+    return _app
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1 @@
+# Нагрузочные бенчмарки витрины: генератор shop.db, заглушки платёжек и фейковый Redis.
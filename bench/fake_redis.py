@@ -0,0 +1,134 @@
+"""Потокобезопасный in-memory Redis с подмножеством команд, которые использует витрина."""
+from __future__ import annotations
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+class FakePubSub:
+    """Подписка pub/sub: сообщения publish() из любого потока приходят в listen() (блокирующий)."""
+
+    def __init__(self, owner: "FakeRedis", ignore_subscribe_messages: bool = False):
+        self._owner = owner
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._ignore = ignore_subscribe_messages
+        self.channels: List[bytes] = []
+
+    def subscribe(self, *channels):
+        with self._owner._lock:
+            for ch in channels:
+                ch = FakeRedis._b(ch)
+                self.channels.append(ch)
+                self._owner._subscribers.setdefault(ch, []).append(self)
+                if not self._ignore:
+                    self._queue.put({"type": "subscribe", "channel": ch, "data": len(self.channels)})
+
+    def listen(self):
+        while True:
+            yield self._queue.get()
+
+    def close(self):
+        with self._owner._lock:
+            for ch in self.channels:
+                subs = self._owner._subscribers.get(ch, [])
+                if self in subs:
+                    subs.remove(self)
+        self.channels = []
+
+class FakeRedis:
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._subscribers: Dict[bytes, List[FakePubSub]] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, exp = item
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    @staticmethod
+    def _b(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def set(self, key, value, ex=None, nx=False, xx=False, **kw):
+        with self._lock:
+            self.calls += 1
+            if nx and self._get(key) is not None:
+                return None
+            if xx and self._get(key) is None:
+                return None
+            self._data[key] = (self._b(value), time.time() + ex if ex else None)
+            return True
+
+    def setex(self, key, ttl, value):
+        return self.set(key, value, ex=int(ttl))
+
+    def get(self, key):
+        with self._lock:
+            self.calls += 1
+            return self._get(key)
+
+    def delete(self, *keys):
+        with self._lock:
+            self.calls += 1
+            return sum(1 for k in keys if self._data.pop(k, None) is not None)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self.calls += 1
+            value = int(self._get(key) or 0) + amount
+            exp = self._data.get(key, (None, None))[1]
+            self._data[key] = (self._b(value), exp)
+            return value
+
+    def expire(self, key, ttl):
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                return False
+            self._data[key] = (value, time.time() + int(ttl))
+            return True
+
+    def ttl(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return -2
+            return -1 if item[1] is None else max(0, int(item[1] - time.time()))
+
+    def publish(self, channel, message) -> int:
+        with self._lock:
+            self.calls += 1
+            ch = self._b(channel)
+            subs = list(self._subscribers.get(ch, []))
+        for sub in subs:
+            sub._queue.put({"type": "message", "channel": ch, "data": self._b(message)})
+        return len(subs)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> FakePubSub:
+        return FakePubSub(self, ignore_subscribe_messages)
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+_INSTANCE = FakeRedis()
+
+def from_url(url: str, **kw) -> FakeRedis:
+    # Один общий экземпляр на процесс — как будто все клиенты ходят в один Redis
+    return _INSTANCE
+
+def install() -> FakeRedis:
+    """Подменить redis.from_url в текущем процессе."""
+    import redis
+    redis.from_url = from_url
+    redis.Redis.from_url = staticmethod(from_url)
+    return _INSTANCE
@@ -0,0 +1,114 @@
+"""Генератор синтетической shop.db для бенчмарков.
+
+    python -m bench.gen_db /tmp/bench_shop.db --tariffs 5000 --purchases 50000
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+# Минимальная схема проекта ботов — ровно те таблицы/колонки, которые читает витрина
+SCHEMA = """
+CREATE TABLE categories(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT, parent_id INTEGER);
+CREATE TABLE tariffs(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT, price INTEGER,
+                     t_type TEXT, payload TEXT, status_name TEXT, category_id INTEGER);
+CREATE TABLE tariff_durations(id INTEGER PRIMARY KEY AUTOINCREMENT, tariff_id INTEGER, name TEXT, seconds INTEGER,
+                              price INTEGER, is_default INTEGER DEFAULT 0);
+CREATE TABLE channels(id INTEGER PRIMARY KEY, title TEXT, invite_link TEXT);
+CREATE TABLE tariff_channels(tariff_id INTEGER, channel_id INTEGER);
+CREATE TABLE bundle_items(bundle_id INTEGER, item_tariff_id INTEGER, UNIQUE(bundle_id, item_tariff_id));
+CREATE TABLE users(tg_id INTEGER PRIMARY KEY, is_admin INTEGER DEFAULT 0, created_at INTEGER);
+CREATE TABLE purchases(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, tariff_id INTEGER, link TEXT, price INTEGER,
+                       payment_id TEXT, ttl_seconds INTEGER, last_channel_id INTEGER, bought_at INTEGER,
+                       last_ttl_update INTEGER, activated INTEGER DEFAULT 0, active INTEGER DEFAULT 1, expires_at INTEGER);
+CREATE TABLE payments(guid TEXT PRIMARY KEY, user_id INTEGER, tariff_id INTEGER, amount INTEGER);
+CREATE INDEX idx_purchases_user ON purchases(user_id);
+"""
+
+WORDS = ["приватный", "канал", "подписка", "премиум", "гайд", "курс", "сигналы", "трейдинг", "крипто", "закрытый",
+         "клуб", "аналитика", "vip", "pro", "basic", "ultimate", "стратегии", "обучение", "чат", "статус"]
+
+def _text(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(n))
+
+def generate(path: str, categories: int = 20, tariffs: int = 1000, durations: int = 3, channels: int = 50,
+             bundles: int = 20, users: int = 2000, purchases: int = 10000, seed: int = 42) -> None:
+    rnd = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    # Категории: треть — подкатегории
+    cat_rows = []
+    for i in range(1, categories + 1):
+        parent = rnd.randint(1, i - 1) if i > 3 and rnd.random() < 0.33 else None
+        cat_rows.append((i, f"Категория {i} {_text(rnd, 1)}", _text(rnd, 6), parent))
+    conn.executemany("INSERT INTO categories(id, name, description, parent_id) VALUES(?,?,?,?);", cat_rows)
+    conn.executemany("INSERT INTO channels(id, title, invite_link) VALUES(?,?,?);",
+                     [(-1000000 - i, f"Канал {i}", f"https://t.me/+bench{i}") for i in range(1, channels + 1)])
+    t_rows = []
+    for i in range(1, tariffs + 1):
+        t_type = rnd.choices(["channel", "text", "status"], weights=[6, 3, 1])[0]
+        cat = rnd.randint(1, categories) if categories and rnd.random() < 0.9 else None
+        t_rows.append((i, f"{_text(rnd, 2).capitalize()} #{i}", _text(rnd, 30), rnd.randint(1, 500) * 10, t_type,
+                       "секретный текст" if t_type == "text" else "", None, cat))
+    for j in range(bundles):
+        i = tariffs + j + 1
+        t_rows.append((i, f"Набор #{j + 1}", _text(rnd, 20), rnd.randint(50, 900) * 10, "bundle", "", None, None))
+    conn.executemany("INSERT INTO tariffs(id, name, description, price, t_type, payload, status_name, category_id) "
+                     "VALUES(?,?,?,?,?,?,?,?);", t_rows)
+    channel_tariffs = [r[0] for r in t_rows if r[4] == "channel"]
+    if channels:
+        conn.executemany("INSERT INTO tariff_channels(tariff_id, channel_id) VALUES(?,?);",
+                         [(tid, -1000000 - rnd.randint(1, channels)) for tid in channel_tariffs])
+    d_rows = []
+    for tid in channel_tariffs:
+        for k in range(durations):
+            days = 30 * (k + 1)
+            d_rows.append((tid, f"{days} дней", days * 86400, (k + 1) * rnd.randint(10, 90) * 10, 1 if k == 0 else 0))
+    conn.executemany("INSERT INTO tariff_durations(tariff_id, name, seconds, price, is_default) VALUES(?,?,?,?,?);", d_rows)
+    plain = [r[0] for r in t_rows if r[4] != "bundle"]
+    b_rows = set()
+    for j in range(bundles):
+        for child in rnd.sample(plain, min(len(plain), 4)):
+            b_rows.add((tariffs + j + 1, child))
+    conn.executemany("INSERT INTO bundle_items(bundle_id, item_tariff_id) VALUES(?,?);", sorted(b_rows))
+    now = int(time.time())
+    conn.executemany("INSERT INTO users(tg_id, is_admin, created_at) VALUES(?,?,?);",
+                     [(100000 + u, 0, now - rnd.randint(0, 365 * 86400)) for u in range(users)])
+    p_rows = []
+    seen = set()
+    for k in range(purchases):
+        uid = 100000 + rnd.randrange(max(users, 1))
+        tid = rnd.choice(plain)
+        if (uid, tid) in seen:
+            continue
+        seen.add((uid, tid))
+        bought = now - rnd.randint(0, 180 * 86400)
+        p_rows.append((uid, tid, "", rnd.randint(1, 500) * 10, f"bench-{k}", None, None, bought, bought, 1, 1, None))
+    conn.executemany("INSERT INTO purchases(user_id, tariff_id, link, price, payment_id, ttl_seconds, last_channel_id, "
+                     "bought_at, last_ttl_update, activated, active, expires_at) VALUES(?,?,?,?,?,?,?,?,?,?,?,?);", p_rows)
+    conn.executemany("INSERT INTO payments(guid, user_id, tariff_id, amount) VALUES(?,?,?,?);",
+                     [(r[4], r[0], r[1], r[3]) for r in p_rows])
+    conn.commit()
+    conn.close()
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Синтетическая shop.db для бенчмарков")
+    ap.add_argument("path")
+    ap.add_argument("--categories", type=int, default=20)
+    ap.add_argument("--tariffs", type=int, default=1000)
+    ap.add_argument("--durations", type=int, default=3, help="длительностей на канал-тариф")
+    ap.add_argument("--channels", type=int, default=50)
+    ap.add_argument("--bundles", type=int, default=20)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--purchases", type=int, default=10000)
+    ap.add_argument("--seed", type=int, default=42)
+    a = ap.parse_args(argv)
+    generate(a.path, a.categories, a.tariffs, a.durations, a.channels, a.bundles, a.users, a.purchases, a.seed)
+    print(f"shop.db сгенерирована: {a.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Сквозной бенчмарк витрины: index → product_detail → add_to_cart → checkout → api_payment_status → выдача.
+
+    python -m bench.run --users 8 --flows 25 --latency-ms 50 --out bench_results.json
+    python -m bench.run --compare bench_results.json     # сравнить новый прогон с сохранённым
+
+Всё локально: синтетическая shop.db (bench.gen_db), заглушки платёжек (bench.stubs), фейковый Redis.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+ROUTES = ["index", "product_detail", "add_to_cart", "checkout", "payment", "api_payment_status", "delivery"]
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = (len(sorted_vals) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {r: [] for r in ROUTES}
+        self.errors: Dict[str, int] = {r: 0 for r in ROUTES}
+        self._lock = threading.Lock()
+
+    def add(self, route: str, seconds: float, ok: bool = True) -> None:
+        with self._lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, wall: float) -> Dict[str, Any]:
+        out = {}
+        for route, vals in self.samples.items():
+            if not vals:
+                continue
+            s = sorted(vals)
+            out[route] = {
+                "count": len(s),
+                "errors": self.errors.get(route, 0),
+                "p50_ms": round(_percentile(s, 0.50) * 1000, 3),
+                "p95_ms": round(_percentile(s, 0.95) * 1000, 3),
+                "p99_ms": round(_percentile(s, 0.99) * 1000, 3),
+                "mean_ms": round(sum(s) / len(s) * 1000, 3),
+                "max_ms": round(s[-1] * 1000, 3),
+                "throughput_rps": round(len(s) / wall, 2) if wall > 0 else 0.0,
+            }
+        return out
+
+def _timed(rec: Recorder, route: str, fn):
+    t0 = time.perf_counter()
+    resp = fn()
+    rec.add(route, time.perf_counter() - t0, ok=resp.status_code < 400)
+    return resp
+
+def _flow(app, rec: Recorder, rnd: random.Random, tg_id: int, tariffs: List[Dict[str, Any]],
+          method: str, max_polls: int) -> bool:
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = tg_id
+    _timed(rec, "index", lambda: client.get("/"))
+    t = rnd.choice(tariffs)
+    _timed(rec, "product_detail", lambda: client.get(f"/product/{t['id']}"))
+    form = {"tariff_id": str(t['id'])}
+    if t.get('duration'):
+        form["duration"] = str(t['duration'])
+    _timed(rec, "add_to_cart", lambda: client.post("/add_to_cart", data=form))
+    resp = _timed(rec, "checkout", lambda: client.post("/checkout", data={"method": method}))
+    m = re.search(r"/payment/([0-9a-f-]+)", resp.headers.get("Location", ""))
+    if not m:
+        return False
+    pid = m.group(1)
+    _timed(rec, "payment", lambda: client.get(f"/payment/{pid}"))
+    for _ in range(max_polls):
+        t0 = time.perf_counter()
+        r = client.get(f"/api/payment_status/{pid}")
+        elapsed = time.perf_counter() - t0
+        data = r.get_json(silent=True) or {}
+        if data.get("status") == "confirmed":
+            # подтверждающий опрос включает выдачу заказа (_deliver_order)
+            rec.add("delivery", elapsed, ok=r.status_code < 400)
+            return True
+        rec.add("api_payment_status", elapsed, ok=r.status_code < 400 and data.get("ok", False))
+    return False
+
+def _load_tariffs(db_path: str) -> List[Dict[str, Any]]:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute(
+        "SELECT t.id, t.t_type, (SELECT seconds FROM tariff_durations d WHERE d.tariff_id = t.id "
+        "AND d.is_default = 1 LIMIT 1) AS duration FROM tariffs t;").fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode().strip()
+    except Exception:
+        return None
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[str]:
+    """Сравнить p95 по маршрутам; вернуть список регрессий хуже threshold (доля, 0.2 = +20%)."""
+    regressions = []
+    print(f"{'route':<22}{'p95 old':>10}{'p95 new':>10}{'delta':>9}")
+    for route, cur in new["routes"].items():
+        prev = old.get("routes", {}).get(route)
+        if not prev:
+            continue
+        delta = (cur["p95_ms"] - prev["p95_ms"]) / prev["p95_ms"] if prev["p95_ms"] else 0.0
+        mark = ""
+        if delta > threshold:
+            mark = "  <-- регрессия"
+            regressions.append(route)
+        print(f"{route:<22}{prev['p95_ms']:>10.2f}{cur['p95_ms']:>10.2f}{delta * 100:>8.1f}%{mark}")
+    return regressions
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Бенчмарк витрины (storefront + checkout)")
+    ap.add_argument("--db", help="готовая shop.db (иначе сгенерируется во временной папке)")
+    ap.add_argument("--tariffs", type=int, default=1000)
+    ap.add_argument("--categories", type=int, default=20)
+    ap.add_argument("--purchases", type=int, default=10000)
+    ap.add_argument("--users", type=int, default=8, help="параллельных покупателей (потоков)")
+    ap.add_argument("--flows", type=int, default=25, help="покупок на одного покупателя")
+    ap.add_argument("--method", choices=["sbp", "crypto", "mixed"], default="mixed")
+    ap.add_argument("--latency-ms", type=float, default=50.0, help="задержка заглушек платёжек")
+    ap.add_argument("--paid-after", type=int, default=1, help="сколько опросов статуса до «оплачено»")
+    ap.add_argument("--catalog-cache", choices=["memory", "redis"], default="redis",
+                    help="CATALOG_CACHE_BACKEND: общий кэш каталога в (фейковом) Redis или в памяти процесса")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--fail-threshold", type=float, default=0.2)
+    a = ap.parse_args(argv)
+
+    from bench import gen_db, stubs, fake_redis
+    workdir = tempfile.mkdtemp(prefix="webshop-bench-")
+    db_path = a.db
+    if not db_path:
+        db_path = os.path.join(workdir, "shop.db")
+        gen_db.generate(db_path, categories=a.categories, tariffs=a.tariffs, purchases=a.purchases, seed=a.seed)
+    server = stubs.start(0, a.latency_ms, a.paid_after)
+    # config.py читает окружение при импорте — выставляем до импорта приложения
+    os.environ.update(stubs.env_for(server))
+    os.environ["SHOP_DB"] = db_path
+    os.environ.setdefault("SECRET_KEY", "bench")
+    # бенчмарк гоняет всех покупателей с одного IP — лимиты мешали бы измерению
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    os.environ["CATALOG_CACHE_BACKEND"] = a.catalog_cache
+    fake_redis.install()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from wsgi import app
+    app.logger.disabled = True
+
+    tariffs = [t for t in _load_tariffs(db_path) if t['t_type'] != 'bundle']
+    rec = Recorder()
+    ok_flows = [0]
+    lock = threading.Lock()
+
+    def worker(n: int) -> None:
+        rnd = random.Random(a.seed * 1000 + n)
+        for i in range(a.flows):
+            method = a.method if a.method != "mixed" else ("crypto" if i % 4 == 3 else "sbp")
+            if _flow(app, rec, rnd, 100000 + n, tariffs, method, max_polls=a.paid_after + 3):
+                with lock:
+                    ok_flows[0] += 1
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(a.users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    server.shutdown()
+
+    result = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(a),
+        },
+        "wall_seconds": round(wall, 3),
+        "flows": a.users * a.flows,
+        "flows_ok": ok_flows[0],
+        "flows_per_second": round(ok_flows[0] / wall, 2) if wall > 0 else 0.0,
+        "routes": rec.summary(wall),
+    }
+    with open(a.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"{result['flows_ok']}/{result['flows']} покупок за {result['wall_seconds']} с "
+          f"({result['flows_per_second']} покупок/с) -> {a.out}")
+    for route, st in result["routes"].items():
+        print(f"  {route:<20} n={st['count']:<5} p50={st['p50_ms']:>8.2f}ms p95={st['p95_ms']:>8.2f}ms "
+              f"p99={st['p99_ms']:>8.2f}ms {st['throughput_rps']:>7.1f} rps err={st['errors']}")
+    if a.compare:
+        with open(a.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        if compare(old, result, a.fail_threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Локальные заглушки Platega и Crypto Pay API с настраиваемой задержкой.
+
+    python -m bench.stubs --port 8765 --latency-ms 120
+"""
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+class _Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+    paid_after = 0        # сколько проверок статуса отвечать «pending» до «оплачено»
+    _invoice_ids = itertools.count(1)
+    _status_checks: dict = {}
+    _lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, payload, code: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _paid(self, key: str) -> bool:
+        with self._lock:
+            n = self._status_checks.get(key, 0) + 1
+            self._status_checks[key] = n
+        return n > self.paid_after
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        length = int(self.headers.get("Content-Length") or 0)
+        data = json.loads(self.rfile.read(length) or b"{}")
+        path = urlparse(self.path).path
+        if path == "/platega/transaction/process":
+            pid = data.get("id")
+            return self._reply({"transactionId": pid, "status": "PENDING",
+                                "redirect": f"http://{self.headers.get('Host')}/platega/pay/{pid}"})
+        if path == "/crypto/api/createInvoice":
+            iid = next(self._invoice_ids)
+            return self._reply({"ok": True, "result": {"invoice_id": iid, "status": "active",
+                                                       "pay_url": f"https://t.me/CryptoBot?start=IV{iid}"}})
+        self._reply({"error": "not found"}, 404)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path.startswith("/platega/transaction/"):
+            pid = url.path.rsplit("/", 1)[-1]
+            return self._reply({"id": pid, "status": "CONFIRMED" if self._paid(pid) else "PENDING"})
+        if url.path == "/crypto/api/getInvoices":
+            iid = url.query
+            return self._reply({"ok": True, "result": {"items": [{"status": "paid" if self._paid(iid) else "active"}]}})
+        self._reply({"error": "not found"}, 404)
+
+def start(port: int = 0, latency_ms: float = 0.0, paid_after: int = 0) -> ThreadingHTTPServer:
+    """Запустить заглушки в фоновом потоке; вернуть сервер (server.server_address — реальный порт)."""
+    handler = type("StubHandler", (_Handler,), {"latency": latency_ms / 1000.0, "paid_after": paid_after,
+                                                "_status_checks": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def env_for(server: ThreadingHTTPServer) -> dict:
+    """Переменные окружения config.py, направляющие витрину на заглушки."""
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    return {
+        "PLATEGA_CREATE_URL": f"{base}/platega/transaction/process",
+        "PLATEGA_STATUS_URL": f"{base}/platega/transaction/{{payment_id}}",
+        "CRYPTO_PAY_BASE_URL": f"{base}/crypto/api",
+    }
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Заглушки Platega / Crypto Pay")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency-ms", type=float, default=100.0)
+    ap.add_argument("--paid-after", type=int, default=0)
+    a = ap.parse_args(argv)
+    server = start(a.port, a.latency_ms, a.paid_after)
+    for k, v in env_for(server).items():
+        print(f"{k}={v}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
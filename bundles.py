@@ -0,0 +1,135 @@
+from __future__ import annotations
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+import config
+import db
+import catalog_cache
+
+# Планы выдачи: для каждого товара — плоский список id того, что реально выдаётся.
+# Бандлы раскрываются рекурсивно (вложенные бандлы допускаются), повторы убираются.
+# Планы пересчитываются при изменении каталога (хуки db.py) и по TTL (правки ботов),
+# поэтому при подтверждении оплаты выдача обычно не ходит в базу за составом бандла. Товар, которого
+# в планах нет (добавлен ботом после снимка), раскрывается прямо по базе. В плане только id товаров:
+# строки (payload, цена) и каналы выдача читает из базы свежими — их правят и боты.
+
+class BundleCycleError(ValueError):
+    pass
+
+def find_cycle(graph: Dict[int, List[int]], start: int) -> Optional[List[int]]:
+    """Путь start -> ... -> start, если из start по составу бандлов можно вернуться в него же."""
+    path: List[int] = []
+    on_path = set()
+    done = set()
+
+    def visit(node: int) -> Optional[List[int]]:
+        if node in on_path:
+            return path[path.index(node):] + [node]
+        if node in done:
+            return None
+        on_path.add(node); path.append(node)
+        for child in graph.get(node, []):
+            cycle = visit(child)
+            if cycle:
+                return cycle
+        on_path.discard(node); path.pop()
+        done.add(node)
+        return None
+
+    return visit(int(start))
+
+def _flatten(tariff_id: int, t_type, children) -> List[int]:
+    """Конечные (не-бандл) товары в порядке состава, без повторов; циклы из базы ботов просто обрываются.
+    t_type(id) — тип товара (None — товара нет), children(id) — состав бандла."""
+    out: Dict[int, None] = {}
+    seen = set()
+    stack = [int(tariff_id)]
+    while stack:
+        tid = stack.pop()
+        if tid in seen:
+            continue
+        ttype = t_type(tid)
+        if ttype is None:
+            continue
+        seen.add(tid)
+        if ttype == 'bundle':
+            stack.extend(reversed([int(c) for c in children(tid)]))
+        else:
+            out.setdefault(tid)
+    return list(out)
+
+class BundleResolver:
+    def __init__(self, tariffs: Dict[int, Dict[str, Any]], graph: Dict[int, List[int]]):
+        self.built_at = time.time()
+        self.tariffs = tariffs
+        self.graph = graph
+        self.plans: Dict[int, List[int]] = {}
+        for tid in tariffs:
+            self.plans[tid] = _flatten(tid, self._type, lambda b: graph.get(b, []))
+
+    def _type(self, tariff_id: int) -> Optional[str]:
+        t = self.tariffs.get(tariff_id)
+        return None if t is None else t.get('t_type') or ''
+
+    @classmethod
+    def load(cls) -> "BundleResolver":
+        tariffs, graph = catalog_cache.bundle_snapshot()
+        return cls(tariffs, graph)
+
+    def plan(self, tariff_id: int) -> Optional[List[int]]:
+        return self.plans.get(int(tariff_id))
+
+_resolver: Optional[BundleResolver] = None
+_resolver_lock = threading.Lock()
+
+def get_resolver() -> BundleResolver:
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None or time.time() - _resolver.built_at > config.CATALOG_TREE_TTL:
+            _resolver = BundleResolver.load()
+        return _resolver
+
+def rebuild() -> None:
+    global _resolver
+    fresh = BundleResolver.load()
+    with _resolver_lock:
+        _resolver = fresh
+
+def plan_from_db(tariff_id: int) -> List[int]:
+    """План по текущей базе, мимо снимка; [] — товара нет."""
+    types: Dict[int, Optional[str]] = {}
+
+    def t_type(tid: int) -> Optional[str]:
+        if tid not in types:
+            t = db.get_tariff(tid)
+            types[tid] = None if t is None else t.get('t_type') or ''
+        return types[tid]
+    return _flatten(tariff_id, t_type, db.get_bundle_items)
+
+def plan(tariff_id: int) -> List[int]:
+    """План выдачи товара: [tariff_id, ...] конечных товаров; [] — товара нет."""
+    out = get_resolver().plan(tariff_id)
+    if out is None:
+        # товар мог появиться мимо витрины (боты), а снимок в общем кэше ещё старый — раскрываем по базе
+        out = plan_from_db(tariff_id)
+    return out
+
+def check(bundle_id: int, item_ids: List[int], graph: Optional[Dict[int, List[int]]] = None,
+          names: Optional[Dict[int, str]] = None) -> None:
+    """Проверить новый состав бандла на циклы до сохранения. BundleCycleError — с цепочкой названий."""
+    graph = dict(graph if graph is not None else db.get_bundle_graph())
+    graph[int(bundle_id)] = [int(i) for i in item_ids]
+    cycle = find_cycle(graph, int(bundle_id))
+    if cycle:
+        if names is None:
+            names = {tid: t.get('name') or f"#{tid}" for tid, t in get_resolver().tariffs.items()}
+        chain = " → ".join(names.get(tid, f"#{tid}") for tid in cycle)
+        raise BundleCycleError(f"Бандл не может содержать сам себя: {chain}")
+
+@db.on_catalog_change
+def _on_catalog_change(kind: str, data: Dict[str, Any]) -> None:
+    # план пересчитывается сразу в запросе админки, а не при первой выдаче
+    if _resolver is None or kind.startswith("category_") or kind == "durations_changed":
+        return
+    rebuild()
@@ -0,0 +1,211 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+import config
+import clients
+import db
+import metrics
+
+# Общий для всех воркеров и нод кэш каталога в Redis (CATALOG_CACHE_BACKEND=redis).
+# Товары, длительности, каналы и снимки для дерева категорий и планов выдачи лежат под ключами
+# catalog:<версия>:<имя>. Правка каталога через db.py (админка, импорт) увеличивает catalog:version
+# и публикует событие в канал catalog:events: остальные процессы применяют его к своим индексам
+# (дерево категорий, планы бандлов) так же, как в процессе, где была правка, а их чтения сразу идут
+# под новой версией. Промах под версией загружает из базы ровно один процесс (короткий lock),
+# остальные ждут готовое значение. Старые версии просто истекают по CATALOG_CACHE_TTL.
+# Правки ботов мимо витрины подхватываются по TTL, как и раньше. Без Redis — чтение из базы напрямую.
+
+VERSION_KEY = "catalog:version"
+CHANNEL = "catalog:events"
+LOCK_TTL = 10        # сек: дольше одна загрузка из базы не длится
+LOCK_WAIT = 2.0      # сколько ждать чужую загрузку, прежде чем читать базу самим
+
+_log = logging.getLogger(__name__)
+_origin = uuid.uuid4().hex   # события своего процесса пропускаем — они уже применены
+_local = threading.local()
+
+# ---------------- Сериализация ----------------
+
+def _encode(value: Any) -> Any:
+    # в JSON ключи словарей — строки; словари с int-ключами (id -> ...) храним парами
+    if isinstance(value, dict):
+        if value and all(isinstance(k, int) for k in value):
+            return {"__int_keys__": [[k, _encode(v)] for k, v in value.items()]}
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if "__int_keys__" in value:
+            return {int(k): _decode(v) for k, v in value["__int_keys__"]}
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+def _dumps(value: Any) -> bytes:
+    # обёртка отличает закэшированный None («товара нет») от промаха
+    return json.dumps({"v": _encode(value)}, ensure_ascii=False).encode("utf-8")
+
+def _loads(raw: bytes) -> Any:
+    return _decode(json.loads(raw)["v"])
+
+# ---------------- Версия и события ----------------
+
+_version: Optional[int] = None
+_version_lock = threading.Lock()
+
+def _enabled() -> bool:
+    return config.CATALOG_CACHE_BACKEND == "redis"
+
+def version() -> int:
+    global _version
+    if _version is None:
+        with _version_lock:
+            if _version is None:
+                _version = int(clients.redis_client().get(VERSION_KEY) or 0)
+    return _version
+
+def _set_version(v: int) -> None:
+    global _version
+    with _version_lock:
+        if _version is None or v > _version:
+            _version = v
+
+class _Listener(threading.Thread):
+    """Подписка на catalog:events; после обрыва переподключается и сверяет версию."""
+
+    def __init__(self):
+        super().__init__(name="catalog-cache-listener", daemon=True)
+        self.pid = os.getpid()
+
+    def run(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                pubsub = clients.redis_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # пока подписки не было, события могли пройти мимо
+                current = int(clients.redis_client().get(VERSION_KEY) or 0)
+                if _version is not None and current != _version:
+                    _set_version(current)
+                    self._dispatch("catalog_reloaded", {})
+                backoff = 1.0
+                for msg in pubsub.listen():
+                    if msg.get("type") == "message":
+                        self._handle(msg["data"])
+            except Exception as e:
+                _log.warning(f"Catalog cache listener error: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _handle(self, raw: bytes) -> None:
+        try:
+            event = json.loads(raw)
+        except ValueError:
+            return
+        _set_version(int(event.get("v") or 0))
+        if event.get("origin") != _origin:
+            self._dispatch(event.get("kind", "catalog_reloaded"), event.get("data") or {})
+
+    @staticmethod
+    def _dispatch(kind: str, data: Dict[str, Any]) -> None:
+        # те же колбэки, что и у локальной правки; публикация из этого потока не повторяется
+        db._notify(kind, **data)
+
+_listener: Optional[_Listener] = None
+_listener_lock = threading.Lock()
+
+def _ensure_listener() -> None:
+    global _listener
+    l = _listener
+    if l is None or l.pid != os.getpid() or not l.is_alive():
+        with _listener_lock:
+            l = _listener
+            if l is None or l.pid != os.getpid() or not l.is_alive():
+                _listener = _Listener()
+                _listener.start()
+
+@db.on_catalog_change(first=True)
+def _on_catalog_change(kind: str, data: Dict[str, Any]) -> None:
+    if not _enabled() or threading.current_thread() is _listener:
+        return
+    try:
+        _ensure_listener()
+        r = clients.redis_client()
+        with metrics.upstream("redis.catalog"):
+            v = int(r.incr(VERSION_KEY))
+            r.publish(CHANNEL, json.dumps({"v": v, "kind": kind, "data": data, "origin": _origin},
+                                          ensure_ascii=False, default=str))
+        _set_version(v)
+    except Exception as e:
+        _log.warning(f"Catalog cache bump failed: {e}")
+
+# ---------------- Чтение ----------------
+
+@contextmanager
+def bypass():
+    """Чтения этого потока — прямо из базы (статическая выгрузка сверяет страницы с базой)."""
+    _local.bypass = True
+    try:
+        yield
+    finally:
+        _local.bypass = False
+
+def _cached(name: str, loader: Callable[[], Any]) -> Any:
+    if not _enabled() or getattr(_local, "bypass", False):
+        return loader()
+    owner = False
+    try:
+        _ensure_listener()
+        r = clients.redis_client()
+        key = f"catalog:{version()}:{name}"
+        with metrics.upstream("redis.catalog"):
+            raw = r.get(key)
+            deadline = time.monotonic() + LOCK_WAIT
+            while raw is None:
+                if r.set(key + ":lock", _origin, nx=True, ex=LOCK_TTL):
+                    owner = True
+                    break
+                # значение загружает другой процесс
+                if time.monotonic() > deadline:
+                    break
+                time.sleep(0.02)
+                raw = r.get(key)
+        if raw is not None:
+            return _loads(raw)
+    except Exception as e:
+        _log.warning(f"Catalog cache Redis error: {e}")
+        return loader()
+    value = loader()
+    try:
+        r.set(key, _dumps(value), ex=config.CATALOG_CACHE_TTL)
+        if owner:
+            r.delete(key + ":lock")
+    except Exception as e:
+        _log.warning(f"Catalog cache Redis error: {e}")
+    return value
+
+def tariff(tariff_id: int) -> Optional[Dict[str, Any]]:
+    return _cached(f"tariff:{int(tariff_id)}", lambda: db.get_tariff(tariff_id))
+
+def durations(tariff_id: int) -> List[Dict[str, Any]]:
+    return _cached(f"durations:{int(tariff_id)}", lambda: db.get_tariff_durations(tariff_id))
+
+def channels_map() -> Dict[int, Dict[str, Any]]:
+    return _cached("channels", db.get_channels_map)
+
+def category_snapshot() -> Tuple[List[Dict[str, Any]], List[Tuple[int, int]]]:
+    return _cached("categories", db.get_category_snapshot)
+
+def bundle_snapshot() -> Tuple[Dict[int, Dict[str, Any]], Dict[int, List[int]]]:
+    return _cached("bundles", db.get_bundle_snapshot)
@@ -0,0 +1,314 @@
+from __future__ import annotations
+import csv
+import io
+import json
+from typing import List, Dict, Any, Optional, Tuple
+
+import db
+import bundles
+
+# Массовый импорт каталога (категории, товары, длительности, состав бандлов) из JSON или CSV.
+# Строки ссылаются друг на друга внешними ключами (key), сопоставление key -> id хранится
+# в web_external_keys, поэтому повторный импорт того же файла обновляет записи, а не плодит копии.
+# Вся пачка сначала проверяется целиком, затем применяется executemany в одной транзакции
+# (одно задание db_writer, как и остальные записи); кэши каталога сбрасываются один раз в конце.
+#
+# JSON: {"categories": [{"key", "name", "description", "parent"}],
+#        "tariffs": [{"key", "name", "description", "price", "t_type", "payload", "status_name", "category"}],
+#        "durations": [{"tariff", "name", "seconds", "price", "is_default"}],
+#        "bundles": [{"bundle", "items": [...]}]}
+# CSV: одна таблица с колонкой kind (category/tariff/duration/bundle) и колонками тех же полей;
+#      items у бандла — ключи через «|».
+# Ссылки (parent, category, tariff, bundle, items) — внешний ключ или «#<id>» существующей записи.
+
+T_TYPES = ("channel", "text", "bundle", "status")
+_KINDS = {"category": "categories", "tariff": "tariffs", "duration": "durations", "bundle": "bundles"}
+
+_KEYS_SCHEMA = ("CREATE TABLE IF NOT EXISTS web_external_keys(kind TEXT NOT NULL, ext_key TEXT NOT NULL, "
+                "local_id INTEGER NOT NULL, PRIMARY KEY(kind, ext_key)) WITHOUT ROWID;")
+
+class ImportValidationError(ValueError):
+    def __init__(self, errors: List[str]):
+        super().__init__(f"{len(errors)} ошибок в данных импорта")
+        self.errors = errors
+
+# ---------------- Разбор ----------------
+
+def parse(data, fmt: str) -> Dict[str, List[Dict[str, Any]]]:
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig")
+    if fmt == "json":
+        raw = json.loads(data)
+        if not isinstance(raw, dict):
+            raise ImportValidationError(["JSON: ожидается объект с разделами categories/tariffs/durations/bundles"])
+        # форму разделов проверяет _build: здесь ничего не приводим, чтобы не скрыть ошибку
+        return {sec: raw.get(sec) or [] for sec in _KINDS.values()}
+    if fmt == "csv":
+        batch: Dict[str, List[Dict[str, Any]]] = {sec: [] for sec in _KINDS.values()}
+        for n, row in enumerate(csv.DictReader(io.StringIO(data)), start=2):
+            kind = (row.pop("kind", "") or "").strip()
+            if kind not in _KINDS:
+                raise ImportValidationError([f"CSV, строка {n}: неизвестный kind «{kind}»"])
+            row = {k: v for k, v in row.items() if k and v not in (None, "")}
+            if kind == "bundle":
+                row["items"] = [x.strip() for x in (row.get("items") or "").split("|") if x.strip()]
+            batch[_KINDS[kind]].append(row)
+        return batch
+    raise ImportValidationError([f"Неизвестный формат «{fmt}»"])
+
+# ---------------- Проверка и план ----------------
+
+def _int(value, default=None) -> Optional[int]:
+    if value in (None, ""):
+        return default
+    return int(value)
+
+class _Plan:
+    def __init__(self, conn):
+        self.conn = conn
+        self.errors: List[str] = []
+        self.known = {kind: {r['ext_key']: int(r['local_id']) for r in conn.execute(
+            "SELECT ext_key, local_id FROM web_external_keys WHERE kind=?;", (kind,)).fetchall()}
+            for kind in ("category", "tariff")}
+        self.existing = {
+            "category": {int(r[0]) for r in conn.execute("SELECT id FROM categories;")},
+            "tariff": {int(r[0]): r[1] for r in conn.execute("SELECT id, t_type FROM tariffs;")},
+        }
+        self.new_ids = {"category": {}, "tariff": {}}
+        self.next_id = {"category": self._max_id("categories"), "tariff": self._max_id("tariffs")}
+
+    def _max_id(self, table: str) -> int:
+        top = self.conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table};").fetchone()[0]
+        if db._table_exists(self.conn, "sqlite_sequence"):
+            row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name=?;", (table,)).fetchone()
+            if row and row[0]:
+                top = max(top, int(row[0]))
+        return int(top)
+
+    def claim(self, kind: str, key: str, where: str) -> Optional[int]:
+        """id для внешнего ключа: существующий из маппинга или новый (выделяется заранее, чтобы ссылки
+        внутри пачки разрешались без lastrowid)."""
+        if key in self.new_ids[kind]:
+            self.errors.append(f"{where}: ключ «{key}» повторяется")
+            return None
+        local = self.known[kind].get(key)
+        if local is None or local not in self.existing[kind]:
+            self.next_id[kind] += 1
+            local = self.next_id[kind]
+        self.new_ids[kind][key] = local
+        return local
+
+    def ref(self, kind: str, value, where: str) -> Optional[int]:
+        value = str(value).strip()
+        if value.startswith("#") and value[1:].isdigit():
+            local = int(value[1:])
+            if local in self.existing[kind] or local in self.new_ids[kind].values():
+                return local
+        elif value in self.new_ids[kind]:
+            return self.new_ids[kind][value]
+        elif value in self.known[kind] and self.known[kind][value] in self.existing[kind]:
+            return self.known[kind][value]
+        self.errors.append(f"{where}: не найдено {kind} «{value}»")
+        return None
+
+def _shape_errors(batch: Dict[str, Any]) -> List[str]:
+    """Разделы — списки объектов; иначе дальнейшая проверка упала бы на .get()."""
+    errors = []
+    for sec in _KINDS.values():
+        rows = batch.get(sec) or []
+        if not isinstance(rows, list):
+            errors.append(f"{sec}: ожидается список объектов")
+            continue
+        errors += [f"{sec}[{n}]: ожидается объект" for n, row in enumerate(rows, 1) if not isinstance(row, dict)]
+    for n, b in enumerate(batch.get("bundles") or [], 1):
+        if isinstance(b, dict) and not isinstance(b.get("items") or [], (list, str)):
+            errors.append(f"bundles[{n}]: items — список ключей")
+    return errors
+
+def _category_cycles(plan: _Plan, cats: List[Tuple]) -> None:
+    # родители после импорта: существующие из базы + из пачки (A → B → A через разные строки файла)
+    parents = {int(r[0]): [int(r[1])] for r in plan.conn.execute(
+        "SELECT id, parent_id FROM categories WHERE parent_id IS NOT NULL;")}
+    names = {int(r[0]): r[1] for r in plan.conn.execute("SELECT id, name FROM categories;")}
+    for cid, _, name, _, parent in cats:
+        parents[cid] = [parent] if parent is not None else []
+        names[cid] = name
+    imported = {c[0] for c in cats}
+    reported = set()
+    for cid, *_, parent in cats:
+        if parent == cid or cid in reported:
+            continue   # сам себе родитель — уже в ошибках
+        cycle = bundles.find_cycle(parents, cid)
+        # цикл, уже бывший в базе до импорта, — не ошибка этого файла
+        if cycle and imported & set(cycle) and len(cycle) > 2:
+            reported.update(cycle)
+            chain = " → ".join(names.get(c) or f"#{c}" for c in cycle)
+            plan.errors.append(f"categories: цикл родителей {chain}")
+
+def _build(conn, batch: Dict[str, List[Dict[str, Any]]]) -> Tuple[_Plan, Dict[str, Any]]:
+    plan = _Plan(conn)
+    out: Dict[str, Any] = {"categories": [], "tariffs": [], "durations": {}, "bundles": {}}
+    plan.errors += _shape_errors(batch)
+    if plan.errors:
+        return plan, out
+    batch = {sec: batch.get(sec) or [] for sec in _KINDS.values()}
+    # сначала выделяем id всем ключам, потом разрешаем ссылки — порядок строк в файле не важен
+    for n, c in enumerate(batch["categories"], 1):
+        key = str(c.get("key") or "").strip()
+        if not key:
+            plan.errors.append(f"categories[{n}]: нет key"); continue
+        plan.claim("category", key, f"categories[{n}]")
+    for n, t in enumerate(batch["tariffs"], 1):
+        key = str(t.get("key") or "").strip()
+        if not key:
+            plan.errors.append(f"tariffs[{n}]: нет key"); continue
+        plan.claim("tariff", key, f"tariffs[{n}]")
+    for n, c in enumerate(batch["categories"], 1):
+        where = f"categories[{n}]"
+        key = str(c.get("key") or "").strip()
+        name = str(c.get("name") or "").strip()
+        if not key:
+            continue
+        if not name:
+            plan.errors.append(f"{where}: пустое name")
+        parent = plan.ref("category", c["parent"], where) if c.get("parent") not in (None, "") else None
+        cid = plan.new_ids["category"][key]
+        if parent == cid:
+            plan.errors.append(f"{where}: категория не может быть родителем самой себя")
+        out["categories"].append((cid, key, name, str(c.get("description") or "").strip(), parent))
+    _category_cycles(plan, out["categories"])
+    types = dict(plan.existing["tariff"])
+    for n, t in enumerate(batch["tariffs"], 1):
+        where = f"tariffs[{n}]"
+        key = str(t.get("key") or "").strip()
+        if not key:
+            continue
+        name = str(t.get("name") or "").strip()
+        t_type = str(t.get("t_type") or "channel").strip()
+        if not name:
+            plan.errors.append(f"{where}: пустое name")
+        if t_type not in T_TYPES:
+            plan.errors.append(f"{where}: t_type должен быть одним из {', '.join(T_TYPES)}")
+        try:
+            price = _int(t.get("price"), 0)
+            if price < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            plan.errors.append(f"{where}: price должен быть целым ≥ 0"); price = 0
+        cat = plan.ref("category", t["category"], where) if t.get("category") not in (None, "") else None
+        tid = plan.new_ids["tariff"][key]
+        types[tid] = t_type
+        out["tariffs"].append((tid, key, name, str(t.get("description") or "").strip(), price, t_type,
+                               str(t.get("payload") or ""), t.get("status_name") or None, cat))
+    for n, d in enumerate(batch["durations"], 1):
+        where = f"durations[{n}]"
+        tid = plan.ref("tariff", d.get("tariff", ""), where)
+        try:
+            seconds, price = _int(d.get("seconds")), _int(d.get("price"), 0)
+            if not seconds or seconds <= 0 or price < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            plan.errors.append(f"{where}: seconds > 0 и price ≥ 0 — целые числа"); continue
+        if tid is not None:
+            is_default = str(d.get("is_default") or "").lower() in ("1", "true", "yes")
+            out["durations"].setdefault(tid, []).append(
+                (tid, str(d.get("name") or "").strip(), seconds, price, 1 if is_default else 0))
+    for n, b in enumerate(batch["bundles"], 1):
+        where = f"bundles[{n}]"
+        bid = plan.ref("tariff", b.get("bundle", ""), where)
+        items = b.get("items") or []
+        if isinstance(items, str):
+            items = [x for x in items.split("|") if x.strip()]
+        ids = [plan.ref("tariff", it, where) for it in items]
+        if bid is None:
+            continue
+        if types.get(bid) != "bundle":
+            plan.errors.append(f"{where}: «{b.get('bundle')}» — не бандл")
+        if bid in ids:
+            plan.errors.append(f"{where}: бандл содержит сам себя")
+        out["bundles"][bid] = [i for i in dict.fromkeys(ids) if i is not None and i != bid]
+    if out["bundles"]:
+        graph = db.get_bundle_graph(conn)
+        graph.update(out["bundles"])
+        names = {tid: t.get('name') or f"#{tid}" for tid, t in bundles.get_resolver().tariffs.items()}
+        names.update((t[0], t[2]) for t in out["tariffs"])
+        for bid, items in out["bundles"].items():
+            try:
+                bundles.check(bid, items, graph=graph, names=names)
+            except bundles.BundleCycleError as e:
+                plan.errors.append(f"bundles: {e}")
+                break
+    return plan, out
+
+# ---------------- Применение ----------------
+
+def _apply(conn, plan: _Plan, out: Dict[str, Any]) -> None:
+    cats = out["categories"]
+    conn.executemany("INSERT INTO categories(id, name, description, parent_id) VALUES(?,?,?,?) "
+                     "ON CONFLICT(id) DO UPDATE SET name=excluded.name, description=excluded.description, "
+                     "parent_id=excluded.parent_id;",
+                     [(cid, name, desc, parent) for cid, _, name, desc, parent in cats])
+    cols = [c['name'] for c in conn.execute("PRAGMA table_info(tariffs);")]
+    fields = ["id", "name", "description", "price", "t_type"]
+    optional = [f for f in ("payload", "status_name", "category_id") if f in cols]
+    fields += optional
+    tariffs = out["tariffs"]
+    rows = []
+    for tid, _, name, desc, price, t_type, payload, status_name, cat in tariffs:
+        extra = {"payload": payload, "status_name": status_name, "category_id": cat}
+        rows.append((tid, name, desc, price, t_type) + tuple(extra[f] for f in optional))
+    updates = ", ".join(f"{f}=excluded.{f}" for f in fields[1:])
+    conn.executemany(f"INSERT INTO tariffs({', '.join(fields)}) VALUES({', '.join('?' * len(fields))}) "
+                     f"ON CONFLICT(id) DO UPDATE SET {updates};", rows)
+    conn.executemany("INSERT OR REPLACE INTO web_external_keys(kind, ext_key, local_id) VALUES(?,?,?);",
+                     [("category", key, cid) for cid, key, *_ in cats] +
+                     [("tariff", key, tid) for tid, key, *_ in tariffs])
+    if tariffs and db._table_exists(conn, db._FTS_TABLE):
+        conn.executemany(f"DELETE FROM {db._FTS_TABLE} WHERE rowid=?;", [(t[0],) for t in tariffs])
+        conn.executemany(f"INSERT INTO {db._FTS_TABLE}(rowid, name, description) VALUES(?,?,?);",
+                         [(t[0], t[2], t[3]) for t in tariffs])
+    # длительности и состав бандлов заменяются целиком для упомянутых товаров
+    if out["durations"] and db._table_exists(conn, "tariff_durations"):
+        conn.executemany("DELETE FROM tariff_durations WHERE tariff_id=?;", [(t,) for t in out["durations"]])
+        conn.executemany("INSERT INTO tariff_durations(tariff_id, name, seconds, price, is_default) VALUES(?,?,?,?,?);",
+                         [row for rows_ in out["durations"].values() for row in rows_])
+    if out["bundles"] and db._table_exists(conn, "bundle_items"):
+        conn.executemany("DELETE FROM bundle_items WHERE bundle_id=?;", [(b,) for b in out["bundles"]])
+        conn.executemany("INSERT OR IGNORE INTO bundle_items(bundle_id, item_tariff_id) VALUES(?,?);",
+                         [(b, i) for b, items in out["bundles"].items() for i in items])
+
+def _check(conn, batch: Dict[str, List[Dict[str, Any]]]) -> Tuple[_Plan, Dict[str, Any], Dict[str, int]]:
+    plan, out = _build(conn, batch)
+    if plan.errors:
+        raise ImportValidationError(plan.errors)
+    summary = {
+        "categories": len(out["categories"]),
+        "tariffs": len(out["tariffs"]),
+        "durations": sum(len(v) for v in out["durations"].values()),
+        "bundles": len(out["bundles"]),
+        "created": sum(1 for kind in ("category", "tariff") for key, local in plan.new_ids[kind].items()
+                       if plan.known[kind].get(key) != local),
+    }
+    return plan, out, summary
+
+def import_catalog(batch: Dict[str, List[Dict[str, Any]]], dry_run: bool = False) -> Dict[str, int]:
+    """Проверить и применить пачку. Ошибки данных — ImportValidationError со списком всех проблем,
+    в этом случае база не меняется. Возвращает счётчики по разделам."""
+    # DDL — отдельным соединением, внутри задания писателя ему не место
+    conn = db._connect()
+    try:
+        conn.execute(_KEYS_SCHEMA)
+        conn.commit()
+        if dry_run:
+            return _check(conn, batch)[2]
+    finally:
+        conn.close()
+
+    def _do(conn) -> Dict[str, int]:
+        # проверка и запись в одной транзакции писателя: выделенные заранее id не пересекутся с чужой вставкой
+        plan, out, summary = _check(conn, batch)
+        _apply(conn, plan, out)
+        return summary
+    summary = db._write(_do)
+    db._notify("catalog_reloaded", **summary)
+    return summary
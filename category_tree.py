@@ -0,0 +1,191 @@
+from __future__ import annotations
+import threading
+import time
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+import config
+import db
+import catalog_cache
+
+# Материализованное дерево категорий: все категории грузятся одним запросом,
+# дальше витрина и админка берут детей/путь/счётчики из памяти.
+# Правки через db.py применяются инкрементально, правки ботов — полной пересборкой по TTL.
+
+def _sort_key(cat: Dict[str, Any]):
+    return ((cat.get('name') or '').lower(), int(cat['id']))
+
+class CategoryTree:
+    def __init__(self, categories: Iterable[Dict[str, Any]], tariff_categories: Iterable[Tuple[int, int]]):
+        self._lock = threading.RLock()
+        self.nodes: Dict[int, Dict[str, Any]] = {}
+        self.children: Dict[Optional[int], List[int]] = {}
+        self.tariff_cat: Dict[int, int] = {}     # tariff_id -> category_id (0 — без категории)
+        self.own_counts: Dict[int, int] = {}     # category_id -> товаров непосредственно в категории
+        self._subtree_counts: Optional[Dict[int, int]] = None
+        self.built_at = time.time()
+        for c in categories:
+            self.nodes[int(c['id'])] = dict(c)
+        for cid, node in self.nodes.items():
+            self.children.setdefault(node.get('parent_id'), []).append(cid)
+        for parent in self.children:
+            self._sort_children(parent)
+        for tid, cid in tariff_categories:
+            self.tariff_cat[int(tid)] = int(cid)
+            self.own_counts[int(cid)] = self.own_counts.get(int(cid), 0) + 1
+
+    @classmethod
+    def load(cls) -> "CategoryTree":
+        cats, tariffs = catalog_cache.category_snapshot()
+        return cls(cats, tariffs)
+
+    def _sort_children(self, parent: Optional[int]) -> None:
+        ids = self.children.get(parent)
+        if ids:
+            ids.sort(key=lambda cid: _sort_key(self.nodes[cid]))
+
+    # ---------- чтение ----------
+
+    def get(self, cat_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            node = self.nodes.get(int(cat_id))
+            return dict(node) if node else None
+
+    def children_of(self, parent_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(self.nodes[cid]) for cid in self.children.get(parent_id, [])]
+
+    def path(self, cat_id: int) -> List[Dict[str, Any]]:
+        """Цепочка от корня до категории (для хлебных крошек). Защищена от циклов в parent_id."""
+        with self._lock:
+            out = []
+            seen = set()
+            cur = self.nodes.get(int(cat_id))
+            while cur is not None and cur['id'] not in seen:
+                seen.add(cur['id'])
+                out.append(dict(cur))
+                parent = cur.get('parent_id')
+                cur = self.nodes.get(int(parent)) if parent is not None else None
+            out.reverse()
+            return out
+
+    def descendants(self, cat_id: int) -> List[int]:
+        """Сама категория и все её потомки."""
+        with self._lock:
+            out = []
+            stack = [int(cat_id)]
+            seen = set()
+            while stack:
+                cid = stack.pop()
+                if cid in seen:
+                    continue
+                seen.add(cid)
+                out.append(cid)
+                stack.extend(self.children.get(cid, []))
+            return out
+
+    def own_count(self, cat_id: int) -> int:
+        with self._lock:
+            return self.own_counts.get(int(cat_id), 0)
+
+    def subtree_count(self, cat_id: int) -> int:
+        with self._lock:
+            if self._subtree_counts is None:
+                self._subtree_counts = {cid: sum(self.own_counts.get(d, 0) for d in self.descendants(cid))
+                                        for cid in self.nodes}
+            return self._subtree_counts.get(int(cat_id), 0)
+
+    @property
+    def uncategorized_count(self) -> int:
+        return self.own_count(0)
+
+    def nav(self, parent_id: Optional[int] = None, depth: int = 1) -> List[Dict[str, Any]]:
+        """Уровень дерева со счётчиками и подкатегориями (depth уровней вниз)."""
+        with self._lock:
+            out = []
+            for node in self.children_of(parent_id):
+                node['product_count'] = self.subtree_count(node['id'])
+                node['subcategories'] = self.nav(node['id'], depth - 1) if depth > 0 else []
+                out.append(node)
+            return out
+
+    # ---------- инкрементальные изменения ----------
+
+    def _detach(self, cat_id: int) -> None:
+        node = self.nodes.get(cat_id)
+        if node is None:
+            return
+        siblings = self.children.get(node.get('parent_id'))
+        if siblings and cat_id in siblings:
+            siblings.remove(cat_id)
+
+    def upsert_category(self, cat_id: int, name: str, description: str, parent_id: Optional[int]) -> None:
+        with self._lock:
+            cat_id = int(cat_id)
+            self._detach(cat_id)
+            node = self.nodes.setdefault(cat_id, {'id': cat_id})
+            node.update(name=name, description=description, parent_id=parent_id)
+            self.children.setdefault(parent_id, []).append(cat_id)
+            self._sort_children(parent_id)
+            self._subtree_counts = None
+
+    def remove_category(self, cat_id: int) -> None:
+        with self._lock:
+            cat_id = int(cat_id)
+            self._detach(cat_id)
+            self.nodes.pop(cat_id, None)
+            # товары удалённой категории уходят в «без категории» — как в db.delete_category
+            moved = self.own_counts.pop(cat_id, 0)
+            if moved:
+                for tid, cid in self.tariff_cat.items():
+                    if cid == cat_id:
+                        self.tariff_cat[tid] = 0
+                self.own_counts[0] = self.own_counts.get(0, 0) + moved
+            self._subtree_counts = None
+
+    def set_tariff(self, tariff_id: int, category_id: Optional[int]) -> None:
+        with self._lock:
+            self.remove_tariff(tariff_id)
+            cid = int(category_id or 0)
+            self.tariff_cat[int(tariff_id)] = cid
+            self.own_counts[cid] = self.own_counts.get(cid, 0) + 1
+            self._subtree_counts = None
+
+    def remove_tariff(self, tariff_id: int) -> None:
+        with self._lock:
+            old = self.tariff_cat.pop(int(tariff_id), None)
+            if old is not None:
+                self.own_counts[old] = max(0, self.own_counts.get(old, 0) - 1)
+                self._subtree_counts = None
+
+_tree: Optional[CategoryTree] = None
+_tree_lock = threading.Lock()
+
+def get_tree() -> CategoryTree:
+    global _tree
+    with _tree_lock:
+        if _tree is None or time.time() - _tree.built_at > config.CATALOG_TREE_TTL:
+            _tree = CategoryTree.load()
+        return _tree
+
+def invalidate() -> None:
+    global _tree
+    with _tree_lock:
+        _tree = None
+
+@db.on_catalog_change
+def _on_catalog_change(kind: str, data: Dict[str, Any]) -> None:
+    if kind == "catalog_reloaded":
+        # массовый импорт: дешевле перечитать дерево целиком, чем применять построчно
+        invalidate()
+        return
+    tree = _tree
+    if tree is None:
+        return
+    if kind in ("category_added", "category_updated"):
+        tree.upsert_category(data['id'], data['name'], data['description'], data['parent_id'])
+    elif kind == "category_deleted":
+        tree.remove_category(data['id'])
+    elif kind in ("tariff_added", "tariff_updated"):
+        tree.set_tariff(data['id'], data.get('category_id'))
+    elif kind == "tariff_deleted":
+        tree.remove_tariff(data['id'])
@@ -0,0 +1,185 @@
+from __future__ import annotations
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+from flask import current_app
+
+import config
+import clients
+import db
+
+# Распределение покупателей по каналам товара. Раньше всех отправляли в первый канал с invite-ссылкой,
+# и Handler-бот одобрял все join request'ы в одном канале. Здесь выбирается канал с наименьшим числом
+# выдач за текущее окно (с учётом веса) или по взвешенной очереди товара. Каналы со статусом
+# full/unhealthy пропускаются, пока у товара есть другие; если доступных нет, берётся наименее загруженный. Веса и статусы задаются в /admin/channels (таблица web_channel_state),
+# счётчики выдач — в shop.db или Redis (общие для всех воркеров).
+
+STATUSES = ("ok", "full", "unhealthy")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS web_channel_state(
+    channel_id INTEGER PRIMARY KEY, weight INTEGER NOT NULL DEFAULT 1, status TEXT NOT NULL DEFAULT 'ok',
+    updated_at INTEGER);
+CREATE TABLE IF NOT EXISTS web_channel_load(
+    scope TEXT NOT NULL, bucket INTEGER NOT NULL, assigned INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(scope, bucket)) WITHOUT ROWID;
+"""
+_schema_ready = False
+
+def _conn():
+    global _schema_ready
+    conn = db._connect()
+    if not _schema_ready:
+        conn.executescript(_SCHEMA)
+        _schema_ready = True
+    return conn
+
+def _window() -> int:
+    return int(time.time()) // max(1, config.CHANNEL_ALLOC_WINDOW)
+
+# ---------------- Счётчики ----------------
+
+class SqliteCounters:
+    def get(self, scopes: List[str]) -> Dict[str, int]:
+        conn = _conn()
+        try:
+            marks = ",".join("?" * len(scopes))
+            rows = conn.execute(f"SELECT scope, assigned FROM web_channel_load WHERE bucket=? AND scope IN ({marks});",
+                                (_window(), *scopes)).fetchall()
+            return {r['scope']: int(r['assigned']) for r in rows}
+        finally:
+            conn.close()
+
+    def incr(self, scope: str) -> int:
+        _conn().close()   # схема — до очереди писателя
+        w = _window()
+
+        def _do(conn) -> int:
+            conn.execute("INSERT INTO web_channel_load(scope, bucket, assigned) VALUES(?,?,1) "
+                         "ON CONFLICT(scope, bucket) DO UPDATE SET assigned = assigned + 1;", (scope, w))
+            n = conn.execute("SELECT assigned FROM web_channel_load WHERE scope=? AND bucket=?;", (scope, w)).fetchone()
+            # прошлые окна больше не нужны
+            conn.execute("DELETE FROM web_channel_load WHERE bucket < ?;", (w - 1,))
+            return int(n['assigned'])
+        return db._write(_do)
+
+class RedisCounters:
+    def __init__(self):
+        self._fallback = SqliteCounters()
+
+    def _key(self) -> str:
+        return f"challoc:{_window()}"
+
+    def get(self, scopes: List[str]) -> Dict[str, int]:
+        try:
+            values = clients.redis_client().hmget(self._key(), scopes)
+            return {s: int(v) for s, v in zip(scopes, values) if v is not None}
+        except Exception as e:
+            current_app.logger.warning(f"Channel allocator Redis error: {e}")
+            return self._fallback.get(scopes)
+
+    def incr(self, scope: str) -> int:
+        try:
+            r = clients.redis_client()
+            key = self._key()
+            pipe = r.pipeline()
+            pipe.hincrby(key, scope, 1)
+            pipe.expire(key, 2 * max(1, config.CHANNEL_ALLOC_WINDOW))
+            return int(pipe.execute()[0])
+        except Exception as e:
+            current_app.logger.warning(f"Channel allocator Redis error: {e}")
+            return self._fallback.incr(scope)
+
+_counters = None
+_lock = threading.Lock()
+
+def counters():
+    global _counters
+    if _counters is None:
+        with _lock:
+            if _counters is None:
+                _counters = RedisCounters() if config.CHANNEL_ALLOC_BACKEND == "redis" else SqliteCounters()
+    return _counters
+
+# ---------------- Веса и статусы ----------------
+
+_state: Dict[int, Dict[str, Any]] = {}
+_state_at = 0.0
+
+def channel_state() -> Dict[int, Dict[str, Any]]:
+    """channel_id -> {weight, status}; каналы без записи — вес 1, статус ok."""
+    global _state, _state_at
+    if time.time() - _state_at > config.CHANNEL_STATE_TTL:
+        conn = _conn()
+        try:
+            rows = conn.execute("SELECT channel_id, weight, status FROM web_channel_state;").fetchall()
+        finally:
+            conn.close()
+        _state = {int(r['channel_id']): {"weight": int(r['weight']), "status": r['status']} for r in rows}
+        _state_at = time.time()
+    return _state
+
+def set_state(channel_id: int, weight: int, status: str) -> None:
+    global _state_at
+    if status not in STATUSES:
+        raise ValueError(status)
+    _conn().close()
+    db._write(lambda conn: conn.execute(
+        "INSERT INTO web_channel_state(channel_id, weight, status, updated_at) VALUES(?,?,?,?) "
+        "ON CONFLICT(channel_id) DO UPDATE SET weight=excluded.weight, status=excluded.status, "
+        "updated_at=excluded.updated_at;", (int(channel_id), max(1, int(weight)), status, int(time.time()))))
+    _state_at = 0.0
+
+def _eligible(candidates: List[int], channels_map: Dict[int, Dict[str, Any]]) -> List[int]:
+    state = channel_state()
+    return [int(c) for c in candidates
+            if (channels_map.get(int(c)) or {}).get('invite_link')
+            and state.get(int(c), {}).get("status", "ok") == "ok"]
+
+def _weight(cid: int) -> int:
+    return max(1, channel_state().get(cid, {}).get("weight", 1))
+
+# ---------------- Выбор ----------------
+
+def pick(tariff_id: int, candidates: List[int], channels_map: Dict[int, Dict[str, Any]]) -> Optional[int]:
+    """Выбрать канал для новой выдачи и учесть её в счётчиках. None — ни у одного канала нет invite-ссылки."""
+    eligible = _eligible(candidates, channels_map)
+    if not eligible:
+        # все каналы full/unhealthy — оплаченный доступ всё равно выдаём: в наименее загруженный со ссылкой
+        eligible = [int(c) for c in candidates if (channels_map.get(int(c)) or {}).get('invite_link')]
+        if not eligible:
+            return None
+        current_app.logger.warning(f"No available channel for tariff {tariff_id}: all full/unhealthy, "
+                                   f"falling back to the least loaded one")
+        load = counters().get([f"c:{c}" for c in eligible])
+        chosen = min(eligible, key=lambda c: (load.get(f"c:{c}", 0) / _weight(c), eligible.index(c)))
+    elif len(eligible) == 1:
+        chosen = eligible[0]
+    elif config.CHANNEL_ALLOC_STRATEGY == "round_robin":
+        # n-я выдача товара попадает в канал по кумулятивным весам
+        n = counters().incr(f"t:{int(tariff_id)}") - 1
+        slot = n % sum(_weight(c) for c in eligible)
+        for chosen in eligible:
+            slot -= _weight(chosen)
+            if slot < 0:
+                break
+    else:
+        load = counters().get([f"c:{c}" for c in eligible])
+        chosen = min(eligible, key=lambda c: (load.get(f"c:{c}", 0) / _weight(c), eligible.index(c)))
+    counters().incr(f"c:{chosen}")
+    return chosen
+
+def keep_or_pick(tariff_id: int, current: Optional[int], candidates: List[int],
+                 channels_map: Dict[int, Dict[str, Any]]) -> Optional[int]:
+    """Для повторной выдачи ссылки: оставить текущий канал, если он ещё доступен, иначе выбрать новый."""
+    if current is not None and int(current) in _eligible(candidates, channels_map):
+        return int(current)
+    return pick(tariff_id, candidates, channels_map)
+
+def loads() -> Dict[int, int]:
+    """Выдачи по каналам за текущее окно (для админки)."""
+    cmap = db.get_channels_map()
+    scopes = [f"c:{c}" for c in cmap]
+    got = counters().get(scopes) if scopes else {}
+    return {c: got.get(f"c:{c}", 0) for c in cmap}
@@ -0,0 +1,45 @@
+from __future__ import annotations
+import threading
+from typing import Any
+
+import config
+
+# Тяжёлые клиенты создаются при первом обращении и переиспользуются всеми запросами воркера:
+# импорт requests/redis не стоит ничего на старте, а HTTP keep-alive и пул Redis-соединений
+# не пересоздаются на каждый вызов.
+
+_lock = threading.Lock()
+_http = None
+_redis = None
+
+def http():
+    """Общая requests.Session с пулом соединений к платёжкам."""
+    global _http
+    if _http is None:
+        with _lock:
+            if _http is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.HTTP_POOL_SIZE)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _http = s
+    return _http
+
+def redis_client() -> Any:
+    """Общий Redis-клиент (внутри — пул соединений, безопасен для потоков и переживает fork)."""
+    global _redis
+    if _redis is None:
+        with _lock:
+            if _redis is None:
+                import redis
+                _redis = redis.from_url(config.REDIS_URL)
+    return _redis
+
+def reset() -> None:
+    """Сбросить синглтоны (после fork в мастере или в тестах/бенчмарках)."""
+    global _http, _redis
+    with _lock:
+        _http = None
+        _redis = None
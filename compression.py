@@ -0,0 +1,106 @@
+from __future__ import annotations
+import gzip
+import zlib
+from typing import Iterable, Iterator, Optional
+
+from flask import Flask, Response, request, stream_template, get_flashed_messages
+
+import config
+
+try:
+    import brotli   # необязательная зависимость: без неё — только gzip
+except ImportError:
+    brotli = None
+
+# Сжатие ответов (HTML/JSON) по Accept-Encoding: br, если установлен пакет brotli, иначе gzip.
+# Ответы меньше COMPRESS_MIN_SIZE отдаются как есть. Статика (send_file) не трогается — её лучше
+# сжимать заранее на nginx. Длинные списки рендерятся потоком (render_streamed): шапка страницы
+# уходит клиенту до того, как дорендерен весь список; такие ответы сжимаются по кускам.
+
+STREAM_CHUNK = 8192   # байт: куски потокового рендера не мельче этого
+
+def _negotiate() -> Optional[str]:
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"] > 0:
+        return "br"
+    if accept["gzip"] > 0:
+        return "gzip"
+    return None
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=config.COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=config.COMPRESS_LEVEL, mtime=0)
+
+def _compress_stream(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    # каждый кусок сбрасывается сразу (sync flush), чтобы браузер начинал разбор, не дожидаясь конца
+    if encoding == "br":
+        c = brotli.Compressor(quality=config.COMPRESS_BROTLI_QUALITY)
+        for chunk in chunks:
+            out = c.process(chunk) + c.flush()
+            if out:
+                yield out
+        yield c.finish()
+    else:
+        c = zlib.compressobj(config.COMPRESS_LEVEL, zlib.DEFLATED, 31)   # 31 — формат gzip
+        for chunk in chunks:
+            out = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+            if out:
+                yield out
+        yield c.flush()
+
+def _compressible(response: Response) -> bool:
+    return (response.status_code == 200
+            and not response.direct_passthrough
+            and "Content-Encoding" not in response.headers
+            and response.mimetype in config.COMPRESS_MIMETYPES
+            and request.method != "HEAD")
+
+def _add_vary(response: Response) -> None:
+    if "accept-encoding" not in (v.lower() for v in response.vary):
+        response.vary.add("Accept-Encoding")
+
+def install(app: Flask) -> None:
+    if not config.COMPRESS_ENABLED:
+        return
+
+    @app.after_request
+    def _compress_response(response):
+        if not _compressible(response):
+            return response
+        _add_vary(response)
+        encoding = _negotiate()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = _compress_stream(response.iter_encoded(), encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < config.COMPRESS_MIN_SIZE:
+                return response
+            response.set_data(_compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+def _buffered(parts: Iterable[str]) -> Iterator[str]:
+    # Jinja отдаёт строку на каждый тег — склеиваем в куски, чтобы не писать в сокет по паре байт
+    buf = []
+    size = 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+def render_streamed(template_name: str, **context) -> Response:
+    """Потоковый рендер большой страницы вместо render_template."""
+    # flash-сообщения забираем из сессии до отправки заголовков, иначе cookie уйдёт без изменений
+    # и сообщение покажется ещё раз
+    get_flashed_messages(with_categories=True)
+    # stream_template сам держит контекст запроса на время генерации
+    return Response(_buffered(stream_template(template_name, **context)), mimetype="text/html")
@@ -1,7 +1,10 @@
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+# .env рядом с приложением; python-dotenv импортируем, только если файл есть (без обхода стека find_dotenv)
+_ENV_FILE = os.getenv("WEBSHOP_ENV_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+if os.path.exists(_ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(_ENV_FILE)
 
 # Путь к общей базе проекта ботов (SQLite)
 SHOP_DB = os.getenv("SHOP_DB", "shop.db")
@@ -50,3 +53,92 @@ SECRET_KEY = os.getenv("SECRET_KEY", "CHANGE_ME_SECRET")
 # Тайминги ожидания оплаты/пула
 PAYMENT_POLL_INTERVAL = int(os.getenv("PAYMENT_POLL_INTERVAL", "4"))   # секунды
 PAYMENT_POLL_ATTEMPTS = int(os.getenv("PAYMENT_POLL_ATTEMPTS", "45"))  # попыток (около 3 минут)
+
+# Дерево категорий: полная пересборка раз в N секунд (подхватывает правки ботов)
+CATALOG_TREE_TTL = int(os.getenv("CATALOG_TREE_TTL", "300"))
+
+# Шаблоны компилируются при старте; байткод Jinja кэшируется на диске (общий для воркеров и перезапусков)
+JINJA_BYTECODE_CACHE = os.getenv("JINJA_BYTECODE_CACHE", "1") not in ("0", "false", "no")
+# пусто — защищённый каталог Jinja для текущего пользователя; свой каталог должен быть нашим и с правами 0700
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR", "")
+
+# Общий кэш каталога для всех воркеров/нод (catalog_cache.py): local — без него, redis — ключи с версией
+# и pub/sub-инвалидация при правках через админку. TTL ключей — потолок устаревания после правок ботов
+CATALOG_CACHE_BACKEND = os.getenv("CATALOG_CACHE_BACKEND", "local")   # local | redis
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "300"))
+
+# Записи в shop.db (общая с ботами): через один поток-писатель на воркер, пачками в коротких транзакциях.
+# Очередь ограничена — при переполнении запрос ждёт до DB_WRITE_TIMEOUT секунд, потом получает ошибку
+DB_WRITER = os.getenv("DB_WRITER", "1") in ("1", "true", "yes")
+DB_WRITE_QUEUE = int(os.getenv("DB_WRITE_QUEUE", "256"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "32"))
+DB_WRITE_TIMEOUT = float(os.getenv("DB_WRITE_TIMEOUT", "30"))
+
+# Полнотекстовый поиск: сколько результатов на страницу
+SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", "50"))
+
+# Размер страницы каталога (keyset-пагинация, кнопка «Показать ещё»)
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "24"))
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+
+# Популярность: продажи с затуханием (период полураспада), окно истории и период пересборки из агрегатов
+POPULARITY_HALF_LIFE_DAYS = float(os.getenv("POPULARITY_HALF_LIFE_DAYS", "14"))
+POPULARITY_WINDOW_DAYS = int(os.getenv("POPULARITY_WINDOW_DAYS", "90"))
+POPULARITY_REFRESH = int(os.getenv("POPULARITY_REFRESH", "600"))
+BESTSELLERS_LIMIT = int(os.getenv("BESTSELLERS_LIMIT", "6"))
+
+# Метрики: /metrics (Prometheus), лог медленных запросов с разбивкой SQL
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "no")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")          # если задан — /metrics?token=... или Bearer
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", "500"))
+
+# Пул HTTP keep-alive соединений к платёжкам (на воркер)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+# Прогрев каталога (дерево категорий, поисковый индекс) при создании приложения — до fork воркеров
+PRELOAD_CATALOG = os.getenv("PRELOAD_CATALOG", "0") in ("1", "true", "yes")
+
+# Идемпотентность checkout (ключи в Redis, без него — в памяти процесса): окно повторов (сек)
+# и сколько ждать счёт параллельного дубля
+CHECKOUT_IDEMPOTENCY_WINDOW = int(os.getenv("CHECKOUT_IDEMPOTENCY_WINDOW", "600"))
+CHECKOUT_DUPLICATE_WAIT = int(os.getenv("CHECKOUT_DUPLICATE_WAIT", "35"))
+
+# Распределение покупателей по каналам товара: least (меньше всего выдач за окно с учётом веса)
+# или round_robin (взвешенная очередь по товару); счётчики — в sqlite (shop.db) или redis
+CHANNEL_ALLOC_STRATEGY = os.getenv("CHANNEL_ALLOC_STRATEGY", "least")   # least | round_robin
+CHANNEL_ALLOC_BACKEND = os.getenv("CHANNEL_ALLOC_BACKEND", "sqlite")    # sqlite | redis
+CHANNEL_ALLOC_WINDOW = int(os.getenv("CHANNEL_ALLOC_WINDOW", "3600"))   # окно счётчиков выдач, сек
+CHANNEL_STATE_TTL = int(os.getenv("CHANNEL_STATE_TTL", "30"))           # кэш весов/статусов каналов, сек
+
+# Сжатие ответов: gzip или br (если установлен пакет brotli) для HTML/JSON от COMPRESS_MIN_SIZE байт
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "1") not in ("0", "false", "no")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))                   # gzip 1..9
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))  # br 0..11
+COMPRESS_MIMETYPES = ("text/html", "application/json", "text/plain", "text/csv", "application/x-ndjson")
+
+# Профайлер /admin/profile: период сэмплов и потолок длительности сессии
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+# Rate limiting: "N/сек" на пользователя (tg_id/сессия) и отдельно на IP; потолок одновременных запросов —
+# на воркер (memory) или общий для всех воркеров (redis)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") not in ("0", "false", "no")
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")   # memory | redis
+# Сколько доверенных прокси стоит перед приложением: IP клиента берётся из X-Forwarded-For на столько хопов
+# справа (ProxyFix). 0 — только адрес соединения; левые записи заголовка клиент подделывает сам
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))   # бакетов в памяти процесса
+RATE_LIMIT_IP_MULTIPLIER = float(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "5"))
+RATE_LIMITS = {
+    "checkout": os.getenv("RATE_LIMIT_CHECKOUT", "10/60"),
+    "platega_qr": os.getenv("RATE_LIMIT_QR", "5/60"),
+    "payment_status": os.getenv("RATE_LIMIT_STATUS", "60/60"),
+}
+CONCURRENCY_LIMITS = {
+    "checkout": int(os.getenv("CONCURRENCY_CHECKOUT", "16")),
+    "platega_qr": int(os.getenv("CONCURRENCY_QR", "2")),
+    "payment_status": int(os.getenv("CONCURRENCY_STATUS", "32")),
+}
+# Слот одновременного запроса в Redis освобождается сам через столько секунд, если воркер упал посреди запроса
+CONCURRENCY_SLOT_TTL = int(os.getenv("CONCURRENCY_SLOT_TTL", "120"))
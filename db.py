@@ -1,11 +1,18 @@
+import os
+import re
+import json
+import base64
 import sqlite3
 import time
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Tuple, Iterator
 
 import config
 
+# Класс соединения; metrics.install подменяет его на замеряющий запросы
+_connection_factory = sqlite3.Connection
+
 def _connect():
-    conn = sqlite3.connect(config.SHOP_DB, timeout=30)
+    conn = sqlite3.connect(config.SHOP_DB, timeout=30, factory=_connection_factory)
     conn.row_factory = sqlite3.Row
     try:
         conn.execute("PRAGMA journal_mode=WAL;")
@@ -26,6 +33,36 @@ def _column_exists(conn, table: str, column: str) -> bool:
     cols = [r['name'] for r in cur.fetchall()]
     return column in cols
 
+def _write(fn: Callable[[Any], Any]) -> Any:
+    """Выполнить запись fn(conn) в короткой транзакции и вернуть её результат. fn не делает commit:
+    транзакцией управляет db_writer (единый поток-писатель или прямое соединение, см. DB_WRITER)."""
+    import db_writer
+    return db_writer.run(fn)
+
+# ---------------- Catalog change hooks ----------------
+
+# Подписчики на изменения каталога: индексы/кэши обновляются инкрементально,
+# без повторного чтения всей базы. Колбэк получает (kind, data).
+_CATALOG_LISTENERS: List[Callable[[str, Dict[str, Any]], None]] = []
+
+def on_catalog_change(fn: Callable[[str, Dict[str, Any]], None] = None, *, first: bool = False):
+    """Подписать колбэк. first=True — вызывать раньше остальных (общий кэш должен сменить версию
+    до того, как локальные индексы начнут перечитывать данные)."""
+    def register(f):
+        if first:
+            _CATALOG_LISTENERS.insert(0, f)
+        else:
+            _CATALOG_LISTENERS.append(f)
+        return f
+    return register(fn) if fn is not None else register
+
+def _notify(kind: str, **data) -> None:
+    for fn in list(_CATALOG_LISTENERS):
+        try:
+            fn(kind, data)
+        except Exception:
+            pass
+
 # ---------------- Categories ----------------
 
 def get_categories(parent_id: Optional[int] = None) -> List[Dict[str, Any]]:
@@ -45,33 +82,40 @@ def get_category(cat_id: int) -> Optional[Dict[str, Any]]:
     conn.close()
     return dict(row) if row else None
 
-def add_category(name: str, description: str = "", parent_id: Optional[int] = None) -> int:
+def get_category_snapshot() -> Tuple[List[Dict[str, Any]], List[Tuple[int, int]]]:
+    """Все категории одним запросом + пары (tariff_id, category_id) для счётчиков (0 — без категории)."""
     conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO categories(name, description, parent_id) VALUES(?,?,?);",
-                (name.strip(), description.strip(), parent_id))
-    conn.commit()
-    nid = cur.lastrowid
+    cats = [dict(r) for r in conn.execute("SELECT * FROM categories ORDER BY name COLLATE NOCASE;").fetchall()]
+    cur = conn.execute("SELECT id, COALESCE(category_id, 0) AS category_id FROM tariffs;")
+    tariffs = [(int(r['id']), int(r['category_id'])) for r in cur.fetchall()]
     conn.close()
+    return cats, tariffs
+
+def add_category(name: str, description: str = "", parent_id: Optional[int] = None) -> int:
+    def _do(conn):
+        cur = conn.cursor()
+        cur.execute("INSERT INTO categories(name, description, parent_id) VALUES(?,?,?);",
+                    (name.strip(), description.strip(), parent_id))
+        return cur.lastrowid
+    nid = _write(_do)
+    _notify("category_added", id=nid, name=name.strip(), description=description.strip(), parent_id=parent_id)
     return nid
 
 def update_category(cat_id: int, name: str, description: str, parent_id: Optional[int] = None) -> None:
-    conn = _connect()
-    conn.execute("UPDATE categories SET name=?, description=?, parent_id=? WHERE id=?;",
-                 (name.strip(), description.strip(), parent_id, cat_id))
-    conn.commit()
-    conn.close()
+    _write(lambda conn: conn.execute("UPDATE categories SET name=?, description=?, parent_id=? WHERE id=?;",
+                                     (name.strip(), description.strip(), parent_id, cat_id)))
+    _notify("category_updated", id=cat_id, name=name.strip(), description=description.strip(), parent_id=parent_id)
 
 def delete_category(cat_id: int) -> None:
-    conn = _connect()
-    # Товары делаем без категории
-    try:
-        conn.execute("UPDATE tariffs SET category_id = NULL WHERE category_id = ?;", (cat_id,))
-    except Exception:
-        pass
-    conn.execute("DELETE FROM categories WHERE id = ?;", (cat_id,))
-    conn.commit()
-    conn.close()
+    def _do(conn):
+        # Товары делаем без категории
+        try:
+            conn.execute("UPDATE tariffs SET category_id = NULL WHERE category_id = ?;", (cat_id,))
+        except Exception:
+            pass
+        conn.execute("DELETE FROM categories WHERE id = ?;", (cat_id,))
+    _write(_do)
+    _notify("category_deleted", id=cat_id)
 
 # ---------------- Tariffs ----------------
 
@@ -100,6 +144,80 @@ def get_tariffs(category_id: Optional[int] = None) -> List[Dict[str, Any]]:
     conn.close()
     return rows
 
+# Keyset-пагинация: (выражение ключа, направление). Хвостовой ключ — всегда t.id,
+# поэтому курсор однозначен даже при одинаковых названиях/ценах.
+TARIFF_SORTS = {
+    "name": ("t.name COLLATE NOCASE", "ASC"),
+    "price": ("t.price", "ASC"),
+    "price_desc": ("t.price", "DESC"),
+    "newest": (None, "DESC"),
+}
+def ensure_catalog_indexes() -> None:
+    """Индексы под сортировки списка товаров. Вызывается при старте приложения: путь чтения DDL не делает."""
+    if not os.path.exists(config.SHOP_DB):
+        return
+    conn = _connect()
+    try:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tariffs_cat_name ON tariffs(category_id, name COLLATE NOCASE);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tariffs_cat_price ON tariffs(category_id, price);")
+        conn.commit()
+    finally:
+        conn.close()
+
+def encode_cursor(sort: str, row: Dict[str, Any]) -> str:
+    expr = TARIFF_SORTS[sort][0]
+    key = None if expr is None else (row['price'] if expr == "t.price" else row['name'])
+    raw = json.dumps([sort, key, int(row['id'])], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str], sort: str) -> Optional[Tuple[Any, int]]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c_sort, key, last_id = json.loads(raw)
+        if c_sort != sort:
+            return None
+        return key, int(last_id)
+    except Exception:
+        return None
+
+def get_tariffs_page(category_id: Optional[int] = None, sort: str = "name", after: Optional[str] = None,
+                     limit: int = 24) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница товаров без OFFSET: (rows, next_cursor). category_id как в get_tariffs (None — все, 0 — без категории)."""
+    if sort not in TARIFF_SORTS:
+        sort = "name"
+    expr, direction = TARIFF_SORTS[sort]
+    op = ">" if direction == "ASC" else "<"
+    where: List[str] = []
+    params: List[Any] = []
+    if category_id == 0:
+        where.append("t.category_id IS NULL")
+    elif category_id is not None:
+        where.append("t.category_id = ?"); params.append(category_id)
+    pos = decode_cursor(after, sort)
+    if pos is not None:
+        key, last_id = pos
+        if expr is None:
+            where.append(f"t.id {op} ?"); params.append(last_id)
+        else:
+            where.append(f"({expr} {op} ? OR ({expr} = ? AND t.id {op} ?))")
+            params.extend([key, key, last_id])
+    order = f"t.id {direction}" if expr is None else f"{expr} {direction}, t.id {direction}"
+    sql = ("SELECT t.*, COALESCE(c.name,'') AS category_name "
+           "FROM tariffs t LEFT JOIN categories c ON c.id = t.category_id "
+           + (f"WHERE {' AND '.join(where)} " if where else "")
+           + f"ORDER BY {order} LIMIT ?;")
+    params.append(limit + 1)
+    conn = _connect()
+    rows = [dict(r) for r in conn.execute(sql, tuple(params)).fetchall()]
+    conn.close()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, rows[-1])
+    return rows, next_cursor
+
 def get_tariff(tariff_id: int) -> Optional[Dict[str, Any]]:
     conn = _connect()
     cur = conn.execute("SELECT * FROM tariffs WHERE id=?;", (tariff_id,))
@@ -107,54 +225,167 @@ def get_tariff(tariff_id: int) -> Optional[Dict[str, Any]]:
     conn.close()
     return dict(row) if row else None
 
+def get_tariffs_by_ids(ids: List[int]) -> List[Dict[str, Any]]:
+    """Товары по списку id в том же порядке (несуществующие пропускаются)."""
+    if not ids:
+        return []
+    conn = _connect()
+    marks = ",".join("?" * len(ids))
+    rows = conn.execute(
+        "SELECT t.*, COALESCE(c.name,'') AS category_name FROM tariffs t "
+        f"LEFT JOIN categories c ON c.id = t.category_id WHERE t.id IN ({marks});",
+        tuple(int(i) for i in ids)).fetchall()
+    conn.close()
+    by_id = {int(r['id']): dict(r) for r in rows}
+    return [by_id[int(i)] for i in ids if int(i) in by_id]
+
 def add_tariff(name: str, description: str, price: int, t_type: str,
                payload: str = "", category_id: Optional[int] = None,
                status_name: Optional[str] = None) -> int:
-    conn = _connect()
-    cur = conn.cursor()
-    # Опциональные колонки payload/status_name/position могут отсутствовать в некоторых версиях — проверяем
-    cols = [c['name'] for c in conn.execute("PRAGMA table_info(tariffs);")]
-    fields = ["name", "description", "price", "t_type"]
-    values = [name.strip(), description.strip(), price, t_type]
-    if "payload" in cols:
-        fields.append("payload"); values.append(payload or "")
-    if "status_name" in cols:
-        fields.append("status_name"); values.append(status_name)
-    if "category_id" in cols:
-        fields.append("category_id"); values.append(category_id)
-    sql = f"INSERT INTO tariffs({', '.join(fields)}) VALUES({', '.join(['?']*len(values))});"
-    cur.execute(sql, tuple(values))
-    conn.commit()
-    nid = cur.lastrowid
-    conn.close()
+    def _do(conn):
+        cur = conn.cursor()
+        # Опциональные колонки payload/status_name/position могут отсутствовать в некоторых версиях — проверяем
+        cols = [c['name'] for c in conn.execute("PRAGMA table_info(tariffs);")]
+        fields = ["name", "description", "price", "t_type"]
+        values = [name.strip(), description.strip(), price, t_type]
+        if "payload" in cols:
+            fields.append("payload"); values.append(payload or "")
+        if "status_name" in cols:
+            fields.append("status_name"); values.append(status_name)
+        if "category_id" in cols:
+            fields.append("category_id"); values.append(category_id)
+        sql = f"INSERT INTO tariffs({', '.join(fields)}) VALUES({', '.join(['?']*len(values))});"
+        cur.execute(sql, tuple(values))
+        _search_index_upsert(conn, cur.lastrowid, name.strip(), description.strip())
+        return cur.lastrowid
+    nid = _write(_do)
+    _notify("tariff_added", id=nid, category_id=category_id)
     return nid
 
 def update_tariff(tariff_id: int, name: str, description: str, price: int,
                   category_id: Optional[int], payload: Optional[str] = None,
                   status_name: Optional[str] = None) -> None:
-    conn = _connect()
-    cols = [c['name'] for c in conn.execute("PRAGMA table_info(tariffs);")]
-    sets = ["name=?", "description=?", "price=?", "category_id=?"]
-    vals = [name.strip(), description.strip(), price, category_id]
-    if payload is not None and "payload" in cols:
-        sets.append("payload=?"); vals.append(payload)
-    if status_name is not None and "status_name" in cols:
-        sets.append("status_name=?"); vals.append(status_name)
-    sql = f"UPDATE tariffs SET {', '.join(sets)} WHERE id=?;"
-    vals.append(tariff_id)
-    conn.execute(sql, tuple(vals))
-    conn.commit()
-    conn.close()
+    def _do(conn):
+        cols = [c['name'] for c in conn.execute("PRAGMA table_info(tariffs);")]
+        sets = ["name=?", "description=?", "price=?", "category_id=?"]
+        vals = [name.strip(), description.strip(), price, category_id]
+        if payload is not None and "payload" in cols:
+            sets.append("payload=?"); vals.append(payload)
+        if status_name is not None and "status_name" in cols:
+            sets.append("status_name=?"); vals.append(status_name)
+        sql = f"UPDATE tariffs SET {', '.join(sets)} WHERE id=?;"
+        vals.append(tariff_id)
+        conn.execute(sql, tuple(vals))
+        _search_index_upsert(conn, tariff_id, name.strip(), description.strip())
+    _write(_do)
+    _notify("tariff_updated", id=tariff_id, category_id=category_id)
 
 def delete_tariff(tariff_id: int) -> None:
+    def _do(conn):
+        conn.execute("DELETE FROM tariffs WHERE id=?;", (tariff_id,))
+        try:
+            conn.execute("DELETE FROM payments WHERE tariff_id=?;", (tariff_id,))
+        except Exception:
+            pass
+        _search_index_delete(conn, tariff_id)
+    _write(_do)
+    _notify("tariff_deleted", id=tariff_id)
+
+# ------------- Search (FTS5) --------------
+
+# Полнотекстовый индекс по name/description. rowid = tariffs.id.
+# Правки через db.py (админка, импорт) обновляют индекс в той же записи; правки ботов попадают в него
+# полной пересборкой `flask search-reindex` (по крону). Схему ботов (триггеры на tariffs) не трогаем.
+# Таблица создаётся при старте приложения (ensure_search_index); поиск на пути запроса в базу не пишет.
+_FTS_TABLE = "tariffs_fts"
+_search_state = {"checked_at": 0.0, "fts": None}
+
+def _search_index_upsert(conn, tariff_id: int, name: str, description: str) -> None:
+    if not _table_exists(conn, _FTS_TABLE):
+        return
+    conn.execute(f"DELETE FROM {_FTS_TABLE} WHERE rowid=?;", (tariff_id,))
+    conn.execute(f"INSERT INTO {_FTS_TABLE}(rowid, name, description) VALUES(?,?,?);",
+                 (tariff_id, name, description or ""))
+
+def _search_index_delete(conn, tariff_id: int) -> None:
+    if _table_exists(conn, _FTS_TABLE):
+        conn.execute(f"DELETE FROM {_FTS_TABLE} WHERE rowid=?;", (tariff_id,))
+
+def ensure_search_index() -> bool:
+    """Создать FTS-таблицу, если её нет, и заполнить индекс. False — базы нет или FTS5 недоступен."""
+    if not os.path.exists(config.SHOP_DB):
+        # базу создают боты; пустой shop.db по опечатке в пути не создаём
+        _search_state["fts"] = False
+        return False
+    # DDL — отдельным соединением, как схемы остальных модулей; заполнение — обычной записью
     conn = _connect()
-    conn.execute("DELETE FROM tariffs WHERE id=?;", (tariff_id,))
     try:
-        conn.execute("DELETE FROM payments WHERE tariff_id=?;", (tariff_id,))
-    except Exception:
-        pass
-    conn.commit()
+        fresh = not _table_exists(conn, _FTS_TABLE)
+        if fresh:
+            try:
+                conn.execute(f"CREATE VIRTUAL TABLE {_FTS_TABLE} USING fts5("
+                             f"name, description, tokenize='unicode61 remove_diacritics 2');")
+            except sqlite3.OperationalError:
+                _search_state["fts"] = False
+                return False
+            conn.commit()
+    finally:
+        conn.close()
+    if fresh:
+        rebuild_search_index()
+    _search_state["fts"] = True
+    _search_state["checked_at"] = time.time()
+    return True
+
+def rebuild_search_index() -> int:
+    """Полная пересборка индекса (одна транзакция через db_writer). 0 — индекса нет."""
+    def _do(conn) -> int:
+        if not _table_exists(conn, _FTS_TABLE):
+            return 0
+        conn.execute(f"DELETE FROM {_FTS_TABLE};")
+        return conn.execute(f"INSERT INTO {_FTS_TABLE}(rowid, name, description) "
+                            f"SELECT id, COALESCE(name,''), COALESCE(description,'') FROM tariffs;").rowcount
+    return _write(_do)
+
+def _fts_query(text: str) -> str:
+    # Каждое слово — префиксный терм в кавычках: пользовательский ввод не ломает синтаксис MATCH
+    tokens = re.findall(r"\w+", text.lower())
+    return " ".join(f'"{t}"*' for t in tokens[:12])
+
+def search_tariffs(query: str, category_ids: Optional[List[int]] = None,
+                   limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
+    """Поиск товаров с ранжированием BM25 (название весит больше описания).
+    category_ids — фильтр по категориям (0 — без категории)."""
+    match = _fts_query(query or "")
+    if not match:
+        return []
+    conn = _connect()
+    fts = _search_state["fts"]
+    if fts is None or time.time() - _search_state["checked_at"] > 30:
+        # только проверка: без индекса (не создан при старте) — поиск по LIKE
+        fts = _table_exists(conn, _FTS_TABLE)
+        _search_state.update(fts=fts, checked_at=time.time())
+    where = ""
+    params: List[Any] = []
+    if category_ids is not None:
+        ids = [int(c) for c in category_ids] or [-1]
+        where = f" AND COALESCE(t.category_id, 0) IN ({', '.join(['?'] * len(ids))})"
+        params.extend(ids)
+    if fts:
+        sql = (f"SELECT t.*, COALESCE(c.name,'') AS category_name, bm25({_FTS_TABLE}, 10.0, 1.0) AS rank "
+               f"FROM {_FTS_TABLE} f JOIN tariffs t ON t.id = f.rowid "
+               f"LEFT JOIN categories c ON c.id = t.category_id "
+               f"WHERE {_FTS_TABLE} MATCH ?{where} ORDER BY rank LIMIT ? OFFSET ?;")
+        params = [match] + params + [limit, offset]
+    else:
+        # FTS5 не собран в этой сборке SQLite или индекс ещё не создан — деградируем до LIKE по названию
+        sql = ("SELECT t.*, COALESCE(c.name,'') AS category_name FROM tariffs t "
+               "LEFT JOIN categories c ON c.id = t.category_id "
+               f"WHERE t.name LIKE ?{where} ORDER BY t.name COLLATE NOCASE LIMIT ? OFFSET ?;")
+        params = [f"%{query.strip()}%"] + params + [limit, offset]
+    rows = [dict(r) for r in conn.execute(sql, tuple(params)).fetchall()]
     conn.close()
+    return rows
 
 # ------------- Durations --------------
 
@@ -169,24 +400,27 @@ def get_tariff_durations(tariff_id: int) -> List[Dict[str, Any]]:
     return rows
 
 def add_tariff_duration(tariff_id: int, seconds: int, name: str, price: int, is_default: bool = False) -> None:
-    conn = _connect()
-    if not _table_exists(conn, "tariff_durations"):
-        conn.close(); return
-    cur = conn.cursor()
-    if is_default:
-        cur.execute("UPDATE tariff_durations SET is_default=0 WHERE tariff_id=?;", (tariff_id,))
-    cur.execute("INSERT INTO tariff_durations(tariff_id, name, seconds, price, is_default) VALUES(?,?,?,?,?);",
-                (tariff_id, name.strip(), seconds, price, 1 if is_default else 0))
-    conn.commit()
-    conn.close()
+    def _do(conn):
+        if not _table_exists(conn, "tariff_durations"):
+            return
+        cur = conn.cursor()
+        if is_default:
+            cur.execute("UPDATE tariff_durations SET is_default=0 WHERE tariff_id=?;", (tariff_id,))
+        cur.execute("INSERT INTO tariff_durations(tariff_id, name, seconds, price, is_default) VALUES(?,?,?,?,?);",
+                    (tariff_id, name.strip(), seconds, price, 1 if is_default else 0))
+    _write(_do)
+    _notify("durations_changed", tariff_id=tariff_id)
 
 def delete_tariff_duration(duration_id: int) -> None:
-    conn = _connect()
-    if not _table_exists(conn, "tariff_durations"):
-        conn.close(); return
-    conn.execute("DELETE FROM tariff_durations WHERE id=?;", (duration_id,))
-    conn.commit()
-    conn.close()
+    def _do(conn):
+        if not _table_exists(conn, "tariff_durations"):
+            return None
+        row = conn.execute("SELECT tariff_id FROM tariff_durations WHERE id=?;", (duration_id,)).fetchone()
+        conn.execute("DELETE FROM tariff_durations WHERE id=?;", (duration_id,))
+        return row['tariff_id'] if row else None
+    tariff_id = _write(_do)
+    if tariff_id is not None:
+        _notify("durations_changed", tariff_id=tariff_id)
 
 # ------------- Channels / Bundles --------------
 
@@ -217,44 +451,70 @@ def get_bundle_items(bundle_id: int) -> List[int]:
     conn.close()
     return out
 
-def set_bundle_items(bundle_id: int, item_ids: List[int]) -> None:
+def get_bundle_graph(conn=None) -> Dict[int, List[int]]:
+    """Весь состав бандлов одним запросом: bundle_id -> [item_tariff_id]."""
+    own = conn is None
+    conn = conn or _connect()
+    out: Dict[int, List[int]] = {}
+    if _table_exists(conn, "bundle_items"):
+        for r in conn.execute("SELECT bundle_id, item_tariff_id FROM bundle_items ORDER BY rowid;").fetchall():
+            out.setdefault(int(r[0]), []).append(int(r[1]))
+    if own:
+        conn.close()
+    return out
+
+def get_bundle_snapshot() -> Tuple[Dict[int, Dict[str, Any]], Dict[int, List[int]]]:
+    """Всё, что нужно для планов выдачи: товары (без описаний) и состав бандлов."""
     conn = _connect()
-    if not _table_exists(conn, "bundle_items"):
-        conn.close(); return
-    cur = conn.cursor()
-    cur.execute("DELETE FROM bundle_items WHERE bundle_id=?;", (bundle_id,))
-    for tid in item_ids:
-        if tid == bundle_id: 
-            continue
-        try:
-            cur.execute("INSERT OR IGNORE INTO bundle_items(bundle_id, item_tariff_id) VALUES(?,?);", (bundle_id, tid))
-        except Exception:
-            pass
-    conn.commit()
+    tariffs = {}
+    for r in conn.execute("SELECT * FROM tariffs;").fetchall():
+        row = dict(r)
+        row.pop('description', None)
+        tariffs[int(row['id'])] = row
+    graph = get_bundle_graph(conn)
     conn.close()
+    return tariffs, graph
+
+def set_bundle_items(bundle_id: int, item_ids: List[int]) -> None:
+    def _do(conn):
+        if not _table_exists(conn, "bundle_items"):
+            return
+        cur = conn.cursor()
+        cur.execute("DELETE FROM bundle_items WHERE bundle_id=?;", (bundle_id,))
+        for tid in item_ids:
+            if tid == bundle_id:
+                continue
+            try:
+                cur.execute("INSERT OR IGNORE INTO bundle_items(bundle_id, item_tariff_id) VALUES(?,?);", (bundle_id, tid))
+            except Exception:
+                pass
+    _write(_do)
+    _notify("bundle_changed", id=bundle_id)
 
 # ------------- Users & Purchases & Payments --------------
 
 def ensure_user(tg_id: int, is_admin: bool = False) -> None:
-    conn = _connect()
-    cols = [c['name'] for c in conn.execute("PRAGMA table_info(users);")]
-    # Минимальный набор колонок
-    if "tg_id" not in cols:
-        conn.close(); return
-    # Попытка вставки "мягко" с минимальными полями
+    def _do(conn):
+        cols = [c['name'] for c in conn.execute("PRAGMA table_info(users);")]
+        # Минимальный набор колонок
+        if "tg_id" not in cols:
+            return
+        # Попытка вставки "мягко" с минимальными полями
+        try:
+            if "created_at" in cols and "is_admin" in cols:
+                conn.execute("INSERT OR IGNORE INTO users(tg_id, is_admin, created_at) VALUES(?, ?, strftime('%s','now'));",
+                             (tg_id, 1 if is_admin else 0))
+            elif "is_admin" in cols:
+                conn.execute("INSERT OR IGNORE INTO users(tg_id, is_admin) VALUES(?, ?);",
+                             (tg_id, 1 if is_admin else 0))
+            else:
+                conn.execute("INSERT OR IGNORE INTO users(tg_id) VALUES(?);", (tg_id,))
+        except Exception:
+            pass
     try:
-        if "created_at" in cols and "is_admin" in cols:
-            conn.execute("INSERT OR IGNORE INTO users(tg_id, is_admin, created_at) VALUES(?, ?, strftime('%s','now'));",
-                         (tg_id, 1 if is_admin else 0))
-        elif "is_admin" in cols:
-            conn.execute("INSERT OR IGNORE INTO users(tg_id, is_admin) VALUES(?, ?);",
-                         (tg_id, 1 if is_admin else 0))
-        else:
-            conn.execute("INSERT OR IGNORE INTO users(tg_id) VALUES(?);", (tg_id,))
-        conn.commit()
+        _write(_do)
     except Exception:
         pass
-    conn.close()
 
 def get_purchases(tg_id: int) -> List[Dict[str, Any]]:
     conn = _connect()
@@ -272,58 +532,55 @@ def get_purchases(tg_id: int) -> List[Dict[str, Any]]:
 
 def upsert_purchase(tg_id: int, tariff_id: int, price: int, link: str,
                     duration_seconds: Optional[int], channel_id: Optional[int], payment_id: str) -> int:
-    conn = _connect()
-    if not _table_exists(conn, "purchases"):
-        conn.close(); return 0
-    cur = conn.cursor()
-    cur.execute("SELECT id, ttl_seconds FROM purchases WHERE user_id=? AND tariff_id=? LIMIT 1;", (tg_id, tariff_id))
-    row = cur.fetchone()
-    now = int(time.time())
-    if row:
-        pid = row['id']
-        current_ttl = row['ttl_seconds'] if row['ttl_seconds'] is not None else 0
-        if duration_seconds is None:
-            new_ttl = None
-        elif duration_seconds == 0:
-            new_ttl = 0
-        else:
-            new_ttl = (current_ttl or 0) + duration_seconds
-        expires_at = (now + new_ttl) if new_ttl and new_ttl > 0 else None
-        if channel_id is None:
-            cur.execute(
-                "UPDATE purchases SET link=?, price=?, payment_id=?, ttl_seconds=?, active=1, last_ttl_update=?, expires_at=? WHERE id=?;",
-                (link, price, payment_id, new_ttl, now, expires_at, pid)
-            )
+    def _do(conn):
+        if not _table_exists(conn, "purchases"):
+            return 0
+        cur = conn.cursor()
+        cur.execute("SELECT id, ttl_seconds FROM purchases WHERE user_id=? AND tariff_id=? LIMIT 1;", (tg_id, tariff_id))
+        row = cur.fetchone()
+        now = int(time.time())
+        if row:
+            pid = row['id']
+            current_ttl = row['ttl_seconds'] if row['ttl_seconds'] is not None else 0
+            if duration_seconds is None:
+                new_ttl = None
+            elif duration_seconds == 0:
+                new_ttl = 0
+            else:
+                new_ttl = (current_ttl or 0) + duration_seconds
+            expires_at = (now + new_ttl) if new_ttl and new_ttl > 0 else None
+            if channel_id is None:
+                cur.execute(
+                    "UPDATE purchases SET link=?, price=?, payment_id=?, ttl_seconds=?, active=1, last_ttl_update=?, expires_at=? WHERE id=?;",
+                    (link, price, payment_id, new_ttl, now, expires_at, pid)
+                )
+            else:
+                cur.execute(
+                    "UPDATE purchases SET link=?, price=?, payment_id=?, ttl_seconds=?, last_channel_id=?, active=1, last_ttl_update=?, expires_at=? WHERE id=?;",
+                    (link, price, payment_id, new_ttl, channel_id, now, expires_at, pid)
+                )
         else:
+            ttl = duration_seconds
+            expires_at = (now + ttl) if ttl and ttl > 0 else None
             cur.execute(
-                "UPDATE purchases SET link=?, price=?, payment_id=?, ttl_seconds=?, last_channel_id=?, active=1, last_ttl_update=?, expires_at=? WHERE id=?;",
-                (link, price, payment_id, new_ttl, channel_id, now, expires_at, pid)
+                "INSERT INTO purchases(user_id, tariff_id, link, price, payment_id, ttl_seconds, last_channel_id, bought_at, last_ttl_update, activated, active, expires_at) "
+                "VALUES(?,?,?,?,?,?,?, ?, ?, 0, 1, ?);",
+                (tg_id, tariff_id, link, price, payment_id, ttl, channel_id, now, now, expires_at)
             )
-    else:
-        ttl = duration_seconds
-        expires_at = (now + ttl) if ttl and ttl > 0 else None
-        cur.execute(
-            "INSERT INTO purchases(user_id, tariff_id, link, price, payment_id, ttl_seconds, last_channel_id, bought_at, last_ttl_update, activated, active, expires_at) "
-            "VALUES(?,?,?,?,?,?,?, ?, ?, 0, 1, ?);",
-            (tg_id, tariff_id, link, price, payment_id, ttl, channel_id, now, now, expires_at)
-        )
-        pid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return pid
+            pid = cur.lastrowid
+        return pid
+    return _write(_do)
 
 def mark_payment_processed(guid: str, tg_id: int, total_amount: int) -> None:
-    conn = _connect()
-    if not _table_exists(conn, "payments"):
-        conn.close(); return
+    def _do(conn):
+        if _table_exists(conn, "payments"):
+            # tariff_id = 0 для заказа-корзины
+            conn.execute("INSERT OR IGNORE INTO payments(guid, user_id, tariff_id, amount) VALUES(?,?,?,?);",
+                         (guid, tg_id, 0, total_amount))
     try:
-        # tariff_id = 0 для заказа-корзины
-        conn.execute("INSERT OR IGNORE INTO payments(guid, user_id, tariff_id, amount) VALUES(?,?,?,?);",
-                     (guid, tg_id, 0, total_amount))
-        conn.commit()
+        _write(_do)
     except Exception:
         pass
-    conn.close()
 
 def is_payment_processed(guid: str) -> bool:
     conn = _connect()
@@ -334,6 +591,75 @@ def is_payment_processed(guid: str) -> bool:
     conn.close()
     return ok
 
+# ------------- Export --------------
+
+EXPORT_BATCH = 1000
+_PAYMENT_TIME_COLUMNS = ("created_at", "paid_at", "ts")
+
+def _export_query(conn, kind: str, date_from: Optional[int], date_to: Optional[int],
+                  tariff_id: Optional[int]) -> Optional[Tuple[str, List[Any]]]:
+    where, params = [], []
+    if kind == "purchases":
+        if not _table_exists(conn, "purchases"):
+            return None
+        sql = ("SELECT p.rowid AS _k, p.*, t.name AS tariff_name, t.t_type "
+               "FROM purchases p LEFT JOIN tariffs t ON t.id = p.tariff_id")
+        key, ts = "p.rowid", "p.bought_at"
+        if tariff_id is not None:
+            where.append("p.tariff_id = ?"); params.append(tariff_id)
+    elif kind == "payments":
+        if not _table_exists(conn, "payments"):
+            return None
+        sql = "SELECT py.rowid AS _k, py.* FROM payments py"
+        key = "py.rowid"
+        ts = next((f"py.{c}" for c in _PAYMENT_TIME_COLUMNS if _column_exists(conn, "payments", c)), None)
+        if ts is None and (date_from is not None or date_to is not None):
+            # в схеме ботов у payments нет времени — берём момент покупки по этому платежу
+            ts = "(SELECT MIN(bought_at) FROM purchases pu WHERE pu.payment_id = py.guid)"
+        if tariff_id is not None:
+            # заказы-корзины пишутся с tariff_id = 0, их товары — в purchases с тем же payment_id
+            where.append("(py.tariff_id = ? OR EXISTS (SELECT 1 FROM purchases pu "
+                         "WHERE pu.payment_id = py.guid AND pu.tariff_id = ?))")
+            params += [tariff_id, tariff_id]
+    else:
+        raise ValueError(kind)
+    if date_from is not None:
+        where.append(f"{ts} >= ?"); params.append(date_from)
+    if date_to is not None:
+        where.append(f"{ts} < ?"); params.append(date_to)
+    where.append(f"{key} > ?")
+    return f"{sql} WHERE {' AND '.join(where)} ORDER BY {key} LIMIT ?;", params
+
+def iter_export(kind: str, date_from: Optional[int] = None, date_to: Optional[int] = None,
+                tariff_id: Optional[int] = None, batch: int = EXPORT_BATCH) -> Iterator[tuple]:
+    """Построчная выгрузка purchases (с названием товара) или payments.
+    Первым элементом отдаёт кортеж имён колонок, дальше — строки. Читает пакетами по rowid:
+    каждый пакет — отдельный короткий SELECT, поэтому медленный клиент не держит
+    блокировку чтения и не мешает ботам писать, а память не растёт с размером выгрузки."""
+    last = 0
+    header = None
+    while True:
+        conn = _connect()
+        try:
+            q = _export_query(conn, kind, date_from, date_to, tariff_id)
+            if q is None:
+                if header is None:
+                    yield ()
+                return
+            sql, params = q
+            cur = conn.execute(sql, params + [last, batch])
+            if header is None:
+                header = tuple(d[0] for d in cur.description)[1:]
+                yield header
+            rows = cur.fetchmany(batch)
+        finally:
+            conn.close()
+        for r in rows:
+            yield tuple(r)[1:]
+        if len(rows) < batch:
+            return
+        last = rows[-1][0]
+
 # ------------- Promocodes (если есть) --------------
 
 def get_promocode(code: str) -> Optional[Dict[str, Any]]:
@@ -346,12 +672,10 @@ def get_promocode(code: str) -> Optional[Dict[str, Any]]:
     return dict(row) if row else None
 
 def decrement_promo_use(code: str) -> None:
-    conn = _connect()
-    if not _table_exists(conn, "promocodes"):
-        conn.close(); return
+    def _do(conn):
+        if _table_exists(conn, "promocodes"):
+            conn.execute("UPDATE promocodes SET uses_left = uses_left - 1 WHERE code=? AND uses_left IS NOT NULL AND uses_left > 0;", (code.strip(),))
     try:
-        conn.execute("UPDATE promocodes SET uses_left = uses_left - 1 WHERE code=? AND uses_left IS NOT NULL AND uses_left > 0;", (code.strip(),))
-        conn.commit()
+        _write(_do)
     except Exception:
         pass
-    conn.close()
@@ -0,0 +1,156 @@
+from __future__ import annotations
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, List, Optional
+
+import config
+import db
+import metrics
+
+# Координация записей в shop.db. База общая с ботами, а у SQLite один write-lock: когда каждый
+# поток веба открывает свою транзакцию, они выстраиваются в очередь за ботами на busy timeout.
+# Здесь все записи воркера идут в один поток-писатель: он забирает из очереди пачку заданий,
+# берёт lock одним BEGIN IMMEDIATE, выполняет каждое задание в своём SAVEPOINT (ошибка одного
+# не откатывает остальные) и коммитит. Вызывающий ждёт Future со своим результатом.
+# Время ожидания lock'а, время в очереди и размер пачек — в /metrics.
+
+class WriterOverloaded(RuntimeError):
+    """Запись не выполнена (очередь переполнена или задание снято до начала) — можно повторить."""
+
+class WriteOutcomeUnknown(RuntimeError):
+    """Таймаут истёк, когда задание уже выполнялось: запись могла пройти. Повторять нельзя —
+    неидемпотентная запись (продление срока покупки) применилась бы дважды."""
+
+class _Job:
+    __slots__ = ("fn", "future", "enqueued_at")
+
+    def __init__(self, fn: Callable[[Any], Any]):
+        self.fn = fn
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class Writer(threading.Thread):
+    def __init__(self):
+        super().__init__(name="db-writer", daemon=True)
+        self.pid = os.getpid()
+        self.jobs: "queue.Queue[_Job]" = queue.Queue(maxsize=max(1, config.DB_WRITE_QUEUE))
+
+    def submit(self, fn: Callable[[Any], Any]) -> Future:
+        job = _Job(fn)
+        try:
+            # ограниченная очередь: при перегрузке вызывающий притормаживает, а не копит задания без предела
+            self.jobs.put(job, timeout=config.DB_WRITE_TIMEOUT)
+        except queue.Full:
+            raise WriterOverloaded(f"очередь записи переполнена ({self.jobs.maxsize})") from None
+        return job.future
+
+    def run(self) -> None:
+        conn = None
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < config.DB_WRITE_BATCH:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if conn is None:
+                    conn = db._connect()
+                    conn.isolation_level = None   # транзакциями управляем сами
+                self._apply(conn, batch)
+            except Exception as e:
+                # соединение в неизвестном состоянии — следующая пачка откроет новое
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+
+    def _apply(self, conn, batch: List[_Job]) -> None:
+        now = time.perf_counter()
+        jobs = []
+        for job in batch:
+            metrics.DB_WRITE_QUEUE_SECONDS.observe(now - job.enqueued_at)
+            if job.future.set_running_or_notify_cancel():
+                jobs.append(job)
+        if not jobs:
+            return
+        t0 = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE;")
+        metrics.DB_LOCK_WAIT.observe(time.perf_counter() - t0, "writer")
+        results = []
+        try:
+            for i, job in enumerate(jobs):
+                conn.execute(f"SAVEPOINT w{i};")
+                try:
+                    results.append((job, job.fn(conn), None))
+                except Exception as e:
+                    conn.execute(f"ROLLBACK TO w{i};")
+                    results.append((job, None, e))
+                conn.execute(f"RELEASE w{i};")
+            conn.execute("COMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+        metrics.DB_WRITE_BATCH.observe(len(jobs))
+        for job, result, error in results:
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+_writer: Optional[Writer] = None
+_lock = threading.Lock()
+
+def writer() -> Writer:
+    """Поток-писатель этого процесса (после fork воркера создаётся заново)."""
+    global _writer
+    w = _writer
+    if w is None or w.pid != os.getpid() or not w.is_alive():
+        with _lock:
+            w = _writer
+            if w is None or w.pid != os.getpid() or not w.is_alive():
+                w = _writer = Writer()
+                w.start()
+    return w
+
+def _direct(fn: Callable[[Any], Any]) -> Any:
+    conn = db._connect()
+    try:
+        t0 = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE;")
+        metrics.DB_LOCK_WAIT.observe(time.perf_counter() - t0, "direct")
+        out = fn(conn)
+        conn.commit()
+        return out
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def run(fn: Callable[[Any], Any]) -> Any:
+    """Выполнить запись fn(conn) и дождаться результата (исключение fn пробрасывается вызывающему).
+    По таймауту — WriterOverloaded (запись не выполнялась) или WriteOutcomeUnknown (могла пройти)."""
+    if not config.DB_WRITER:
+        return _direct(fn)
+    w = writer()
+    if threading.current_thread() is w:
+        raise RuntimeError("вложенная запись из потока-писателя")
+    future = w.submit(fn)
+    with metrics.upstream("sqlite.write"):
+        try:
+            return future.result(timeout=config.DB_WRITE_TIMEOUT)
+        except FutureTimeout:
+            # ещё в очереди — снимаем, писатель его пропустит; уже выполняется — исход неизвестен
+            if future.cancel():
+                raise WriterOverloaded(f"запись не дождалась очереди за {config.DB_WRITE_TIMEOUT:g} с") from None
+            raise WriteOutcomeUnknown(f"запись не завершилась за {config.DB_WRITE_TIMEOUT:g} с") from None
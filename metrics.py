@@ -0,0 +1,211 @@
+from __future__ import annotations
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from flask import Flask, Response, g, has_app_context, request, before_render_template, template_rendered, abort
+
+import config
+import db
+
+# Инструментирование запросов: время маршрута, число/время SQL-запросов, задержки платёжек и рендера.
+# Гистограммы отдаются в формате Prometheus на /metrics (значения — на процесс/воркер).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}   # counts по бакетам + [sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        key = tuple(str(v) for v in label_values)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for key, s in items:
+            base = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, key))
+            sep = "," if base else ""
+            for i, b in enumerate(self.buckets):
+                out.append(f'{self.name}_bucket{{{base}{sep}le="{b}"}} {int(s[i])}')
+            out.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {int(s[-1])}')
+            out.append(f"{self.name}_sum{{{base}}} {s[-2]:.6f}")
+            out.append(f"{self.name}_count{{{base}}} {int(s[-1])}")
+        return out
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REQUEST_SECONDS = Histogram("webshop_request_duration_seconds", "Время обработки запроса", ("endpoint", "method", "status"))
+DB_QUERIES = Histogram("webshop_db_queries_per_request", "Число SQL-запросов на HTTP-запрос", ("endpoint",), COUNT_BUCKETS)
+DB_CONNECTS = Histogram("webshop_db_connections_per_request", "Число открытых соединений SQLite на запрос", ("endpoint",), COUNT_BUCKETS)
+DB_SECONDS = Histogram("webshop_db_time_per_request_seconds", "Суммарное время SQL на запрос", ("endpoint",))
+UPSTREAM_SECONDS = Histogram("webshop_upstream_duration_seconds", "Задержка внешних вызовов", ("provider", "outcome"))
+RENDER_SECONDS = Histogram("webshop_template_render_seconds", "Время рендера шаблона", ("template",))
+DB_LOCK_WAIT = Histogram("webshop_db_lock_wait_seconds", "Ожидание write-lock SQLite (BEGIN IMMEDIATE)", ("path",))
+DB_WRITE_QUEUE_SECONDS = Histogram("webshop_db_write_queue_seconds", "Время задания записи в очереди писателя", ())
+DB_WRITE_BATCH = Histogram("webshop_db_write_batch_size", "Заданий записи в одной транзакции", (), COUNT_BUCKETS)
+HISTOGRAMS = [REQUEST_SECONDS, DB_QUERIES, DB_CONNECTS, DB_SECONDS, UPSTREAM_SECONDS, RENDER_SECONDS,
+              DB_LOCK_WAIT, DB_WRITE_QUEUE_SECONDS, DB_WRITE_BATCH]
+
+# ---------------- Per-request накопитель ----------------
+
+def _current() -> Optional[dict]:
+    if not has_app_context():
+        return None
+    return g.get("_metrics")
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+def _record_query(sql: str, seconds: float) -> None:
+    m = _current()
+    if m is None:
+        return
+    m["db_queries"] += 1
+    m["db_seconds"] += seconds
+    # нормализуем SQL, чтобы N+1 склеивался в одну строку разбивки
+    key = _SQL_LITERALS.sub("?", " ".join(sql.split())).rstrip(";")[:160]
+    cnt, total = m["queries"].get(key, (0, 0.0))
+    m["queries"][key] = (cnt + 1, total + seconds)
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - t0)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+@contextmanager
+def upstream(provider: str):
+    """Замер внешнего вызова (платёжки, Redis и т.п.): гистограмма + разбивка текущего запроса."""
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        dt = time.perf_counter() - t0
+        UPSTREAM_SECONDS.observe(dt, provider, outcome)
+        m = _current()
+        if m is not None:
+            m["upstream"].append((provider, dt))
+
+def render_prometheus() -> str:
+    lines: List[str] = []
+    for h in HISTOGRAMS:
+        lines.extend(h.render())
+    return "\n".join(lines) + "\n"
+
+# ---------------- Подключение к приложению ----------------
+
+def install(app: Flask) -> None:
+    if not config.METRICS_ENABLED:
+        return
+    db._connection_factory = TimedConnection
+    if not getattr(db._connect, "_timed", False):
+        raw_connect = db._connect
+
+        def _timed_connect():
+            m = _current()
+            if m is not None:
+                m["db_connects"] += 1
+            return raw_connect()
+        _timed_connect._timed = True
+        db._connect = _timed_connect
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics = {"t0": time.perf_counter(), "db_queries": 0, "db_seconds": 0.0, "db_connects": 0,
+                      "queries": {}, "upstream": [], "render_seconds": 0.0, "render_stack": []}
+
+    @app.after_request
+    def _metrics_status(response):
+        m = _current()
+        if m is not None:
+            m["status"] = response.status_code
+        return response
+
+    # Итог — в teardown, а не в after_request: у потокового ответа (render_streamed) тело и шаблон
+    # рендерятся уже после after_request, а контекст запроса снимается, когда тело отдано целиком
+    @app.teardown_request
+    def _metrics_finish(exc):
+        m = g.pop("_metrics", None)
+        if m is None or request.endpoint == "metrics":
+            return
+        elapsed = time.perf_counter() - m["t0"]
+        endpoint = request.endpoint or "unknown"
+        REQUEST_SECONDS.observe(elapsed, endpoint, request.method, m.get("status", 500))
+        DB_QUERIES.observe(m["db_queries"], endpoint)
+        DB_CONNECTS.observe(m["db_connects"], endpoint)
+        DB_SECONDS.observe(m["db_seconds"], endpoint)
+        if elapsed * 1000 >= config.SLOW_REQUEST_MS:
+            top = sorted(m["queries"].items(), key=lambda kv: kv[1][1], reverse=True)[:8]
+            breakdown = "; ".join(f"{cnt}x {tot * 1000:.1f}ms {sql}" for sql, (cnt, tot) in top)
+            upstream_s = ", ".join(f"{p}={dt * 1000:.0f}ms" for p, dt in m["upstream"])
+            app.logger.warning(
+                f"Slow request {request.method} {request.path} [{endpoint}] {elapsed * 1000:.0f}ms: "
+                f"db {m['db_queries']}q/{m['db_connects']}conn {m['db_seconds'] * 1000:.1f}ms, "
+                f"render {m['render_seconds'] * 1000:.1f}ms, upstream [{upstream_s}] | {breakdown}")
+
+    def _render_start(sender, template, context, **extra):
+        m = _current()
+        if m is not None:
+            m["render_stack"].append(time.perf_counter())
+
+    def _render_done(sender, template, context, **extra):
+        m = _current()
+        if m is None or not m["render_stack"]:
+            return
+        dt = time.perf_counter() - m["render_stack"].pop()
+        if not m["render_stack"]:
+            m["render_seconds"] += dt
+        RENDER_SECONDS.observe(dt, template.name or "string")
+
+    before_render_template.connect(_render_start, app, weak=False)
+    template_rendered.connect(_render_done, app, weak=False)
+
+    @app.route("/metrics")
+    def metrics():
+        if config.METRICS_TOKEN and request.args.get("token") != config.METRICS_TOKEN \
+                and request.headers.get("Authorization") != f"Bearer {config.METRICS_TOKEN}":
+            abort(403)
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,133 @@
+from __future__ import annotations
+import base64
+import json
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+import config
+import db
+import analytics
+import category_tree
+
+# Индекс популярности: продажи с экспоненциальным затуханием (forward decay — вес продажи
+# 2^((t - landmark) / half_life) растёт со временем, так что старые оценки не надо пересчитывать,
+# а порядок совпадает с «затухающим» счётчиком). Строится из дневных агрегатов analytics,
+# доставки витрины добавляются сразу, продажи ботов подтягиваются пересборкой раз в POPULARITY_REFRESH.
+# Рендер берёт готовый ранжированный список из памяти — без GROUP BY по purchases.
+
+SORT_KEY = "popular"
+
+class Popularity:
+    def __init__(self, half_life_days: float):
+        self._lock = threading.Lock()
+        self.half_life = max(half_life_days, 0.01) * 86400
+        self.built_at = time.time()
+        self.landmark = self.built_at - config.POPULARITY_WINDOW_DAYS * 86400
+        self.scores: Dict[int, float] = {}
+        self._ranked: Optional[List[Tuple[float, int]]] = None
+
+    @classmethod
+    def load(cls) -> "Popularity":
+        idx = cls(config.POPULARITY_HALF_LIFE_DAYS)
+        for day, tariff_id, units in analytics.daily_units(config.POPULARITY_WINDOW_DAYS):
+            # продажи дня считаем сделанными в полдень
+            ts = time.mktime(time.strptime(day, "%Y-%m-%d")) + 43200
+            idx.add(tariff_id, units, ts)
+        return idx
+
+    def add(self, tariff_id: int, units: int = 1, ts: Optional[float] = None) -> None:
+        weight = 2 ** (((ts or time.time()) - self.landmark) / self.half_life)
+        with self._lock:
+            self.scores[int(tariff_id)] = self.scores.get(int(tariff_id), 0.0) + units * weight
+            self._ranked = None
+
+    def ranked(self) -> List[Tuple[float, int]]:
+        """[(score, tariff_id)] по убыванию; пересортировка — только после новых продаж."""
+        with self._lock:
+            if self._ranked is None:
+                self._ranked = sorted(((s, tid) for tid, s in self.scores.items()), reverse=True)
+            return self._ranked
+
+    def score(self, tariff_id: int) -> float:
+        return self.scores.get(int(tariff_id), 0.0)
+
+_index: Optional[Popularity] = None
+_index_lock = threading.Lock()
+
+def get_index() -> Popularity:
+    global _index
+    with _index_lock:
+        if _index is None or time.time() - _index.built_at > config.POPULARITY_REFRESH:
+            _index = Popularity.load()
+        return _index
+
+def record(items: List[Dict[str, Any]]) -> None:
+    """Учесть выданный заказ в индексе этого процесса."""
+    idx = _index
+    if idx is None:
+        return
+    for it in items:
+        idx.add(int(it['tariff_id']), int(it.get('quantity') or 1))
+
+def _in_category(tree: category_tree.CategoryTree, tariff_id: int, category_id: Optional[int]) -> bool:
+    cid = tree.tariff_cat.get(tariff_id)
+    return cid is not None and (category_id is None or cid == category_id)
+
+def top(limit: int, category_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Хиты продаж: первые limit товаров рейтинга (category_id как в db.get_tariffs)."""
+    tree = category_tree.get_tree()
+    ids = []
+    for _, tid in get_index().ranked():
+        if _in_category(tree, tid, category_id):
+            ids.append(tid)
+            if len(ids) >= limit:
+                break
+    return db.get_tariffs_by_ids(ids)
+
+def _encode(score: float, tariff_id: int) -> str:
+    raw = json.dumps([SORT_KEY, score, tariff_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    if not cursor:
+        return None
+    try:
+        sort, score, last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (float(score), int(last_id)) if sort == SORT_KEY else None
+    except Exception:
+        return None
+
+def get_page(category_id: Optional[int] = None, after: Optional[str] = None,
+             limit: int = 24) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница «Популярные»: (rows, next_cursor), курсор — (score, id) по убыванию.
+    Сначала продававшиеся товары из рейтинга, затем непродававшиеся (score 0) — от новых к старым через
+    обычный keyset db.get_tariffs_page(sort='newest')."""
+    tree = category_tree.get_tree()
+    idx = get_index()
+    pos = _decode(after)
+    ids: List[int] = []
+    if pos is None or pos[0] > 0:
+        for score, tid in idx.ranked():
+            if pos is not None and (score, tid) >= pos:
+                continue
+            if _in_category(tree, tid, category_id):
+                ids.append(tid)
+                if len(ids) > limit:
+                    break
+    rows = db.get_tariffs_by_ids(ids[:limit])
+    if len(ids) > limit:
+        return rows, _encode(idx.score(ids[limit - 1]), ids[limit - 1])
+    # хвост без продаж: тот же порядок, что у sort=newest, продававшиеся пропускаем
+    after_id = pos[1] if pos is not None and pos[0] <= 0 else None
+    while len(rows) <= limit:
+        cursor = db.encode_cursor("newest", {"id": after_id}) if after_id is not None else None
+        page, next_cursor = db.get_tariffs_page(category_id, sort="newest", after=cursor, limit=limit)
+        rows.extend(r for r in page if idx.score(r['id']) <= 0)
+        if not next_cursor:
+            break
+        after_id = int(page[-1]['id'])
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        return rows[:limit], _encode(idx.score(last['id']), int(last['id']))
+    return rows, None
@@ -0,0 +1,175 @@
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+
+from flask import Flask, request
+
+import config
+
+# Сэмплирующий профайлер по требованию (/admin/profile). Отдельный поток раз в PROFILE_INTERVAL_MS
+# снимает стеки всех потоков воркера через sys._current_frames() и считает одинаковые стеки.
+# Режимы: «N секунд» — все потоки, кроме служебного; «N запросов к endpoint» — только потоки,
+# которые сейчас обрабатывают такой запрос. Результат — collapsed stacks (flamegraph.pl, speedscope)
+# или JSON speedscope. Пока сессии нет, на запрос приходится одна проверка глобальной переменной.
+# Профиль снимается в том воркере, который принял запрос на старт (у каждого процесса свой).
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_labels: Dict[Any, str] = {}
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename
+        if path.startswith(_here):
+            path = os.path.relpath(path, _here)
+        elif "site-packages" in path:
+            path = path.split("site-packages" + os.sep, 1)[-1]
+        label = _labels[code] = f"{code.co_name} ({path}:{code.co_firstlineno})"
+    return label
+
+def _stack(frame) -> Tuple[str, ...]:
+    out = []
+    while frame is not None:
+        out.append(_label(frame.f_code))
+        frame = frame.f_back
+    out.reverse()
+    return tuple(out)
+
+class Session(threading.Thread):
+    def __init__(self, seconds: float, endpoint: Optional[str] = None, requests_limit: int = 0):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = max(config.PROFILE_INTERVAL_MS, 1) / 1000
+        self.endpoint = endpoint
+        self.requests_limit = requests_limit
+        self.requests_left = requests_limit
+        self.seconds = min(seconds, config.PROFILE_MAX_SECONDS)
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self.active: Dict[int, str] = {}      # режим запросов: thread id -> endpoint
+        self._halt = threading.Event()
+
+    @property
+    def mode(self) -> str:
+        return f"{self.endpoint} ×{self.requests_limit}" if self.endpoint else f"{self.seconds:g} с"
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while not self._halt.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in frames.items():
+                if tid == me:
+                    continue
+                if self.endpoint:
+                    if tid not in self.active:
+                        continue
+                    root = f"[{self.endpoint}]"
+                else:
+                    # номера в именах потоков дробили бы граф на одинаковые ветки
+                    root = "[" + "".join(ch for ch in names.get(tid, "thread") if not ch.isdigit()).strip(" -_") + "]"
+                self.stacks[(root,) + _stack(frame)] += 1
+            self.samples += 1
+            del frames
+        self.finished_at = time.time()
+        _finish(self)
+
+    def stop(self) -> None:
+        self._halt.set()
+
+    def meta(self) -> Dict[str, Any]:
+        end = self.finished_at or time.time()
+        return {"mode": self.mode, "started_at": self.started_at, "duration": round(end - self.started_at, 2),
+                "samples": self.samples, "stacks": len(self.stacks), "running": self.finished_at is None,
+                "interval_ms": self.interval * 1000}
+
+_session: Optional[Session] = None
+_last: Optional[Session] = None
+_lock = threading.Lock()
+
+def _finish(s: Session) -> None:
+    global _session, _last
+    with _lock:
+        if _session is s:
+            _session = None
+        _last = s
+
+def start(seconds: float, endpoint: Optional[str] = None, requests_limit: int = 0) -> Session:
+    """Запустить сессию; вторая одновременно не запускается (RuntimeError)."""
+    global _session
+    with _lock:
+        if _session is not None:
+            raise RuntimeError("профилирование уже идёт")
+        s = _session = Session(seconds, endpoint, requests_limit)
+    s.start()
+    return s
+
+def stop() -> None:
+    s = _session
+    if s is not None:
+        s.stop()
+        s.join(timeout=2)
+
+def status() -> Dict[str, Any]:
+    s = _session
+    return {"running": s.meta() if s else None, "last": _last.meta() if _last else None}
+
+# ---------------- Форматы ----------------
+
+def collapsed(s: Session) -> str:
+    """Формат flamegraph.pl / speedscope: «кадр;кадр;кадр число»."""
+    return "".join(f"{';'.join(stack)} {n}\n" for stack, n in s.stacks.most_common())
+
+def speedscope(s: Session) -> Dict[str, Any]:
+    frames: List[Dict[str, Any]] = []
+    index: Dict[str, int] = {}
+    samples, weights = [], []
+    for stack, n in s.stacks.most_common():
+        ids = []
+        for label in stack:
+            i = index.get(label)
+            if i is None:
+                i = index[label] = len(frames)
+                frames.append({"name": label})
+            ids.append(i)
+        samples.append(ids)
+        weights.append(n * s.interval * 1000)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{"type": "sampled", "name": f"webshop pid {os.getpid()}: {s.mode}", "unit": "milliseconds",
+                      "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights}],
+        "name": f"webshop {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s.started_at))}",
+        "exporter": "webshop profiler",
+    }
+
+def last() -> Optional[Session]:
+    return _last
+
+# ---------------- Подключение к приложению ----------------
+
+def install(app: Flask) -> None:
+    @app.before_request
+    def _profile_enter():
+        s = _session
+        if s is None or not s.endpoint or request.endpoint != s.endpoint:
+            return
+        with _lock:
+            if s.requests_left <= 0:
+                return
+            s.requests_left -= 1
+        s.active[threading.get_ident()] = request.endpoint
+
+    @app.teardown_request
+    def _profile_exit(exc):
+        s = _session
+        if s is None or not s.endpoint:
+            return
+        if s.active.pop(threading.get_ident(), None) is not None and s.requests_left <= 0 and not s.active:
+            s.stop()
@@ -0,0 +1,196 @@
+from __future__ import annotations
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+import uuid
+from typing import Callable, Dict, Optional, Tuple
+
+from flask import current_app, jsonify, make_response, request, session
+
+import config
+import clients
+
+# Ограничение частоты для дорогих эндпоинтов (checkout, QR через Chromium, опрос статуса):
+# token bucket по пользователю (tg_id; гость — по IP, т.к. сессию он сбрасывает сам) и по IP + потолок
+# одновременных запросов на эндпоинт. Бэкенд бакетов и потолка — память процесса (потолок на воркер)
+# или Redis (общие для всех воркеров и нод).
+# IP — request.remote_addr; за прокси его выставляет ProxyFix (TRUSTED_PROXY_HOPS, см. app.py).
+
+def parse_rate(raw: str) -> Optional[Tuple[float, float]]:
+    """'10/60' -> (rate токенов/сек, ёмкость 10). Пусто или '0' — без ограничения."""
+    raw = (raw or "").strip()
+    if not raw or raw == "0":
+        return None
+    count, _, period = raw.partition("/")
+    burst = float(count)
+    return burst / float(period or 1), burst
+
+class MemoryBackend:
+    def __init__(self, max_buckets: Optional[int] = None):
+        # key -> (tokens, ts, full_at); порядок — от давно не использованных к свежим
+        self._buckets: "OrderedDict[str, Tuple[float, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self.max_buckets = max_buckets or config.RATE_LIMIT_MAX_BUCKETS
+
+    def _evict(self, now: float) -> None:
+        # бакет, который уже наполнился бы до краёв, ничем не отличается от отсутствующего
+        while self._buckets:
+            key, (_, _, full_at) = next(iter(self._buckets.items()))
+            if full_at > now and len(self._buckets) <= self.max_buckets:
+                break
+            del self._buckets[key]
+
+    def take(self, key: str, rate: float, burst: float) -> Tuple[bool, float]:
+        """Взять токен: (разрешено, через сколько секунд появится следующий)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts, _ = self._buckets.pop(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - ts) * rate)
+            ok = tokens >= 1
+            if ok:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            self._evict(now)
+            return (True, 0.0) if ok else (False, (1 - tokens) / rate)
+
+    def acquire(self, name: str, cap: int) -> Optional[Callable[[], None]]:
+        """Занять слот одновременного запроса: функция освобождения или None — потолок достигнут."""
+        sem = self._semaphores.get(name)
+        if sem is None:
+            with self._lock:
+                sem = self._semaphores.setdefault(name, threading.BoundedSemaphore(cap))
+        if not sem.acquire(blocking=False):
+            return None
+        return sem.release
+
+_LUA_TAKE = """
+local b = redis.call('HMGET', KEYS[1], 't', 'ts')
+local rate = tonumber(ARGV[1]); local burst = tonumber(ARGV[2]); local now = tonumber(ARGV[3])
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local ok = 0
+if tokens >= 1 then tokens = tokens - 1; ok = 1 end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {ok, tostring(tokens)}
+"""
+
+# Слоты — элементы sorted set со сроком в score: слот упавшего воркера истекает сам через CONCURRENCY_SLOT_TTL
+_LUA_ACQUIRE = """
+local now = tonumber(ARGV[1]); local cap = tonumber(ARGV[2]); local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= cap then return 0 end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[4])
+redis.call('EXPIRE', KEYS[1], ttl)
+return 1
+"""
+
+class RedisBackend:
+    def __init__(self):
+        self._script = None
+        self._acquire_script = None
+        self._fallback = MemoryBackend()
+
+    def take(self, key: str, rate: float, burst: float) -> Tuple[bool, float]:
+        try:
+            if self._script is None:
+                self._script = clients.redis_client().register_script(_LUA_TAKE)
+            ok, tokens = self._script(keys=[f"rl:{key}"], args=[rate, burst, time.time()])
+            tokens = float(tokens)
+            return bool(ok), 0.0 if ok else (1 - tokens) / rate
+        except Exception as e:
+            # Redis недоступен — ограничиваем хотя бы в пределах процесса
+            current_app.logger.warning(f"Rate limit Redis error: {e}")
+            return self._fallback.take(key, rate, burst)
+
+    def acquire(self, name: str, cap: int) -> Optional[Callable[[], None]]:
+        key, slot = f"rlc:{name}", uuid.uuid4().hex
+        try:
+            r = clients.redis_client()
+            if self._acquire_script is None:
+                self._acquire_script = r.register_script(_LUA_ACQUIRE)
+            if not self._acquire_script(keys=[key], args=[time.time(), cap, config.CONCURRENCY_SLOT_TTL, slot]):
+                return None
+        except Exception as e:
+            current_app.logger.warning(f"Rate limit Redis error: {e}")
+            return self._fallback.acquire(name, cap)
+
+        def release() -> None:
+            try:
+                r.zrem(key, slot)
+            except Exception as e:
+                current_app.logger.warning(f"Rate limit Redis error: {e}")
+        return release
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = RedisBackend() if config.RATE_LIMIT_BACKEND == "redis" else MemoryBackend()
+    return _backend
+
+def _client_ip() -> str:
+    return request.remote_addr or "unknown"
+
+def _user_key() -> str:
+    uid = session.get('user_id')
+    if uid and int(uid) > 0:
+        return f"tg:{int(uid)}"
+    # у гостя нет идентификатора, который он не мог бы сбросить, — бакет «пользователя» по IP
+    return f"guest:{_client_ip()}"
+
+def _too_many(retry_after: float, reason: str):
+    retry = max(1, math.ceil(retry_after))
+    if request.path.startswith("/api/") or "/api/" in request.path:
+        resp = make_response(jsonify({"ok": False, "status": "error", "message": f"rate limited ({reason})"}), 429)
+    else:
+        resp = make_response("Слишком много запросов — попробуйте через несколько секунд.", 429)
+        resp.mimetype = "text/plain"
+    resp.headers["Retry-After"] = str(retry)
+    return resp
+
+def check(name: str):
+    """Проверить бакеты пользователя и IP; вернуть 429-ответ или None."""
+    rule = parse_rate(config.RATE_LIMITS.get(name, ""))
+    if rule is None:
+        return None
+    rate, burst = rule
+    be = backend()
+    # за одним IP (NAT, офис) бывает много покупателей — его бакет шире в RATE_LIMIT_IP_MULTIPLIER раз
+    k = max(1.0, config.RATE_LIMIT_IP_MULTIPLIER)
+    for scope, ident, r, b in (("user", _user_key(), rate, burst), ("ip", _client_ip(), rate * k, burst * k)):
+        ok, retry = be.take(f"{name}:{scope}:{ident}", r, b)
+        if not ok:
+            return _too_many(retry, scope)
+    return None
+
+def limit(name: str):
+    """Декоратор маршрута: token bucket (config.RATE_LIMITS[name]) + потолок одновременных (config.CONCURRENCY_LIMITS[name])."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not config.RATE_LIMIT_ENABLED:
+                return fn(*args, **kwargs)
+            denied = check(name)
+            if denied is not None:
+                return denied
+            cap = int(config.CONCURRENCY_LIMITS.get(name) or 0)
+            if cap <= 0:
+                return fn(*args, **kwargs)
+            release = backend().acquire(name, cap)
+            if release is None:
+                return _too_many(1, "concurrency")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                release()
+        return wrapper
+    return deco
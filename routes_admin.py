@@ -1,10 +1,24 @@
 from __future__ import annotations
-from typing import List, Dict, Any, Optional
+import io
+import csv
+import json
+import os
+import time
+from typing import List, Dict, Any, Optional, Iterator
 
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import (Blueprint, render_template, request, redirect, url_for, session, flash, abort,
+                   Response, stream_with_context, jsonify, current_app)
 
 import db
 import config
+import category_tree
+import analytics
+import catalog_import
+import bundles
+import channel_alloc
+import profiler
+from routes_main import catalog_page
+from compression import render_streamed
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -31,15 +45,148 @@ def login_info():
 def index():
     return render_template('admin_base.html')
 
+# -------- Sales --------
+
+@admin_bp.route('/sales')
+def sales():
+    # только материализованные агрегаты; сырые покупки здесь не читаются
+    try:
+        days = max(1, min(int(request.args.get('days', 30)), 366))
+    except ValueError:
+        days = 30
+    return render_template('admin_sales.html', stats=analytics.dashboard(days))
+
+@admin_bp.route('/sales/catchup', methods=['POST'])
+def sales_catchup():
+    # ограниченное число пакетов, чтобы запрос не держал воркер; остальное — `flask sales-catchup`
+    n = analytics.catch_up(max_batches=20)
+    flash(f'Учтено платежей из ботов: {n}', 'success')
+    return redirect(url_for('admin.sales'))
+
+# -------- Profiler --------
+
+@admin_bp.route('/profile')
+def profile():
+    endpoints = sorted({r.endpoint for r in current_app.url_map.iter_rules() if r.endpoint != 'static'})
+    return render_template('admin_profile.html', status=profiler.status(), endpoints=endpoints, pid=os.getpid())
+
+@admin_bp.route('/profile/start', methods=['POST'])
+def profile_start():
+    try:
+        seconds = float(request.form.get('seconds') or 10)
+        endpoint = (request.form.get('endpoint') or '').strip() or None
+        count = int(request.form.get('count') or 0)
+        if seconds <= 0 or (endpoint and count <= 0):
+            raise ValueError
+    except ValueError:
+        flash('Некорректные параметры', 'error')
+        return redirect(url_for('admin.profile'))
+    try:
+        # в режиме запросов seconds — предел ожидания, если нужных запросов так и не будет
+        profiler.start(seconds, endpoint, count)
+    except RuntimeError as e:
+        flash(str(e), 'warning')
+    else:
+        flash('Профилирование запущено', 'success')
+    return redirect(url_for('admin.profile'))
+
+@admin_bp.route('/profile/stop', methods=['POST'])
+def profile_stop():
+    profiler.stop()
+    return redirect(url_for('admin.profile'))
+
+@admin_bp.route('/profile/last.<fmt>')
+def profile_download(fmt: str):
+    s = profiler.last()
+    if s is None:
+        abort(404)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(s.started_at))
+    if fmt == 'txt':
+        body, mimetype = profiler.collapsed(s), 'text/plain; charset=utf-8'
+    elif fmt == 'json':
+        body, mimetype = json.dumps(profiler.speedscope(s)), 'application/json'
+    else:
+        abort(404)
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="profile-{stamp}.{fmt}"'})
+
+# -------- Channels --------
+
+@admin_bp.route('/channels', methods=['GET', 'POST'])
+def channels():
+    if request.method == 'POST':
+        try:
+            channel_alloc.set_state(int(request.form['channel_id']), int(request.form.get('weight') or 1),
+                                    request.form.get('status') or 'ok')
+        except (KeyError, ValueError):
+            flash('Некорректные данные', 'error')
+        else:
+            flash('Канал обновлён', 'success')
+        return redirect(url_for('admin.channels'))
+    state = channel_alloc.channel_state()
+    load = channel_alloc.loads()
+    rows = [dict(c, weight=state.get(cid, {}).get('weight', 1), status=state.get(cid, {}).get('status', 'ok'),
+                 assigned=load.get(cid, 0)) for cid, c in sorted(db.get_channels_map().items())]
+    return render_template('admin_channels.html', channels=rows, statuses=channel_alloc.STATUSES)
+
+# -------- Export --------
+
+_EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+_EXPORT_CHUNK = 64 * 1024
+
+def _day_ts(value: Optional[str], shift_days: int = 0) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(time.mktime(time.strptime(value, "%Y-%m-%d"))) + shift_days * 86400
+    except ValueError:
+        abort(400)
+
+def _csv_chunks(rows: Iterator[tuple]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")  # BOM, чтобы Excel открыл кириллицу
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= _EXPORT_CHUNK:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+def _jsonl_chunks(rows: Iterator[tuple]) -> Iterator[str]:
+    header = next(rows, ())
+    parts, size = [], 0
+    for row in rows:
+        line = json.dumps(dict(zip(header, row)), ensure_ascii=False) + "\n"
+        parts.append(line); size += len(line)
+        if size >= _EXPORT_CHUNK:
+            yield "".join(parts)
+            parts, size = [], 0
+    yield "".join(parts)
+
+@admin_bp.route('/export/<kind>.<fmt>')
+def export(kind: str, fmt: str):
+    # выгрузка потоком: ни строки таблицы, ни готовый файл целиком в памяти не держатся
+    if kind not in ("purchases", "payments") or fmt not in _EXPORT_FORMATS:
+        abort(404)
+    tariff = request.args.get('tariff_id', '')
+    rows = db.iter_export(kind,
+                          date_from=_day_ts(request.args.get('from')),
+                          date_to=_day_ts(request.args.get('to'), shift_days=1),
+                          tariff_id=int(tariff) if tariff.isdigit() else None)
+    chunks = _csv_chunks(rows) if fmt == "csv" else _jsonl_chunks(rows)
+    filename = f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(stream_with_context(chunks), mimetype=_EXPORT_FORMATS[fmt],
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 # -------- Categories --------
 
 @admin_bp.route('/categories')
 def categories():
-    cats = db.get_categories(None)
-    # добавим подкатегории/счётчики для удобства
-    for c in cats:
-        c['subcategories'] = db.get_categories(c['id'])
-    uncategorized_count = len(db.get_tariffs(0))
+    # дерево с подкатегориями и счётчиками — из материализованного индекса, без запросов на каждую категорию
+    tree = category_tree.get_tree()
+    cats = tree.nav(None, depth=1)
+    uncategorized_count = tree.uncategorized_count
     return render_template('admin_categories.html', categories=cats, uncategorized_count=uncategorized_count)
 
 @admin_bp.route('/categories/new', methods=['GET', 'POST'])
@@ -54,7 +201,7 @@ def new_category():
         db.add_category(name, description, parent_id)
         flash('Категория создана', 'success')
         return redirect(url_for('admin.categories'))
-    all_top = db.get_categories(None)
+    all_top = category_tree.get_tree().children_of(None)
     return render_template('admin_category_edit.html', category=None, all_categories=all_top)
 
 @admin_bp.route('/categories/<int:cat_id>/edit', methods=['GET', 'POST'])
@@ -70,7 +217,7 @@ def edit_category(cat_id: int):
         db.update_category(cat_id, name, description, parent_id)
         flash('Сохранено', 'success')
         return redirect(url_for('admin.categories'))
-    all_top = db.get_categories(None)
+    all_top = category_tree.get_tree().children_of(None)
     return render_template('admin_category_edit.html', category=cat, all_categories=all_top)
 
 @admin_bp.route('/categories/<int:cat_id>/delete', methods=['POST'])
@@ -83,8 +230,8 @@ def delete_category(cat_id: int):
 
 @admin_bp.route('/tariffs')
 def tariffs():
-    tariffs = db.get_tariffs(None)
-    return render_template('admin_tariffs.html', tariffs=tariffs)
+    page = catalog_page(None, limit=config.ADMIN_PAGE_SIZE)
+    return render_streamed('admin_tariffs.html', tariffs=page.pop('products'), **page)
 
 @admin_bp.route('/tariffs/new', methods=['GET', 'POST'])
 def new_tariff():
@@ -111,7 +258,7 @@ def new_tariff():
         if t_type == 'bundle':
             return redirect(url_for('admin.edit_tariff', tariff_id=new_id))
         return redirect(url_for('admin.tariffs'))
-    categories = db.get_categories(None)
+    categories = category_tree.get_tree().children_of(None)
     return render_template('admin_tariff_edit.html', tariff=None, categories=categories, durations=[], bundle_items=[], all_tariffs=[])
 
 @admin_bp.route('/tariffs/<int:tariff_id>/edit', methods=['GET', 'POST'])
@@ -150,16 +297,22 @@ def edit_tariff(tariff_id: int):
                 item_ids = [int(x) for x in items]
             except Exception:
                 item_ids = []
+            # вложенные бандлы допустимы, циклы — нет: проверяем до записи
+            try:
+                bundles.check(tariff_id, item_ids)
+            except bundles.BundleCycleError as e:
+                flash(str(e), 'error')
+                return redirect(url_for('admin.edit_tariff', tariff_id=tariff_id))
             db.set_bundle_items(tariff_id, item_ids)
 
         flash('Сохранено', 'success')
         return redirect(url_for('admin.tariffs'))
-    categories = db.get_categories(None)
+    categories = category_tree.get_tree().children_of(None)
     durations = db.get_tariff_durations(tariff_id)
     bundle_items = []; all_tariffs = []
     if t['t_type'] == 'bundle':
         bundle_items = db.get_bundle_items(tariff_id)
-        all_tariffs = [x for x in db.get_tariffs(None) if x['t_type'] != 'bundle' and x['id'] != tariff_id]
+        all_tariffs = [x for x in db.get_tariffs(None) if x['id'] != tariff_id]
     return render_template('admin_tariff_edit.html', tariff=t, categories=categories, durations=durations,
                            bundle_items=bundle_items, all_tariffs=all_tariffs)
 
@@ -174,3 +327,29 @@ def delete_duration(tariff_id: int, duration_id: int):
     db.delete_tariff_duration(duration_id)
     flash('Длительность удалена', 'success')
     return redirect(url_for('admin.edit_tariff', tariff_id=tariff_id))
+
+# -------- Import --------
+
+@admin_bp.route('/import', methods=['GET', 'POST'])
+def import_catalog():
+    if request.method == 'GET':
+        return render_template('admin_import.html', errors=[], summary=None)
+    dry_run = request.values.get('dry_run') in ('1', 'on', 'true')
+    if request.is_json:
+        # API: тело — JSON-пачка, ответ — JSON
+        try:
+            summary = catalog_import.import_catalog(catalog_import.parse(request.get_data(), "json"), dry_run=dry_run)
+        except (catalog_import.ImportValidationError, ValueError) as e:
+            return jsonify({"ok": False, "errors": getattr(e, 'errors', None) or [str(e)]}), 400
+        return jsonify({"ok": True, "dry_run": dry_run, **summary})
+    f = request.files.get('file')
+    if not f or not f.filename:
+        flash('Выберите файл', 'error'); return redirect(url_for('admin.import_catalog'))
+    fmt = 'json' if f.filename.lower().endswith('.json') else 'csv'
+    try:
+        summary = catalog_import.import_catalog(catalog_import.parse(f.read(), fmt), dry_run=dry_run)
+    except (catalog_import.ImportValidationError, ValueError) as e:
+        errors = getattr(e, 'errors', None) or [str(e)]
+        return render_template('admin_import.html', errors=errors, summary=None), 400
+    flash('Проверка пройдена, изменения не применены' if dry_run else 'Каталог импортирован', 'success')
+    return render_template('admin_import.html', errors=[], summary=summary)
@@ -3,14 +3,26 @@ import uuid
 import time
 import hmac
 import hashlib
-from typing import List, Dict, Any, Optional
+import json
+import threading
+from typing import List, Dict, Any, Optional, Tuple
 
-import requests
-import redis
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify
+from flask import (Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify,
+                   get_flashed_messages)
 
 import config
 import db
+import category_tree
+import catalog_cache
+import analytics
+import popularity
+import bundles
+import channel_alloc
+import metrics
+import clients
+import ratelimit
+import db_writer
+from compression import render_streamed
 
 main_bp = Blueprint('main', __name__)
 
@@ -85,47 +97,90 @@ def _verify_telegram_login(data: Dict[str, str]) -> bool:
 
 def _set_auto_approve(channel_id: int, tg_id: int, ttl_seconds: Optional[int]) -> None:
     try:
-        r = redis.from_url(config.REDIS_URL)
-        key = f"auto:{channel_id}:{tg_id}"
-        if ttl_seconds is None:
-            r.set(key, "1")
-        elif ttl_seconds > 0:
-            r.setex(key, ttl_seconds, "1")
-        r.close()
+        with metrics.upstream("redis.auto_approve"):
+            r = clients.redis_client()
+            key = f"auto:{channel_id}:{tg_id}"
+            if ttl_seconds is None:
+                r.set(key, "1")
+            elif ttl_seconds > 0:
+                r.setex(key, ttl_seconds, "1")
     except Exception as e:
         current_app.logger.warning(f"Redis auto-approve error: {e}")
 
+SORT_OPTIONS = [("name", "По названию"), ("popular", "Популярные"), ("price", "Дешевле"), ("price_desc", "Дороже"),
+                ("newest", "Новые")]
+
+def catalog_page(category_id: Optional[int], limit: Optional[int] = None) -> Dict[str, Any]:
+    """Страница списка товаров по ?sort=&after= (keyset-курсор) + ссылки сортировки и «Показать ещё»."""
+    sort = request.args.get('sort') or 'name'
+    if sort == popularity.SORT_KEY:
+        # рейтинг из памяти, без агрегации по purchases
+        products, next_cursor = popularity.get_page(category_id, after=request.args.get('after'),
+                                                    limit=limit or config.CATALOG_PAGE_SIZE)
+    else:
+        if sort not in db.TARIFF_SORTS:
+            sort = 'name'
+        products, next_cursor = db.get_tariffs_page(category_id, sort=sort, after=request.args.get('after'),
+                                                    limit=limit or config.CATALOG_PAGE_SIZE)
+    args = dict(request.view_args or {})
+    return {
+        "products": products,
+        "sort": sort,
+        "sort_links": [{"key": k, "label": label, "active": k == sort,
+                        "url": url_for(request.endpoint, **args, sort=k)} for k, label in SORT_OPTIONS],
+        "next_url": url_for(request.endpoint, **args, sort=sort, after=next_cursor) if next_cursor else None,
+    }
+
 # -------------------- Маршруты сайта --------------------
 
 @main_bp.route('/')
 def index():
-    categories = db.get_categories(parent_id=None)
+    categories = category_tree.get_tree().nav(None, depth=0)
     # покажем на главной незакатегоризованные товары как подборку
-    products = db.get_tariffs(category_id=0)
-    return render_template('index.html', categories=categories, products=products)
+    page = catalog_page(0)
+    # хиты продаж по всему каталогу — первые позиции рейтинга популярности
+    bestsellers = popularity.top(config.BESTSELLERS_LIMIT) if not request.args.get('after') else []
+    return render_template('index.html', categories=categories, bestsellers=bestsellers, **page)
 
 @main_bp.route('/category/<int:cat_id>')
 def category(cat_id: int):
+    tree = category_tree.get_tree()
     if cat_id == 0:
         category = {"id": 0, "name": "Uncategorized", "description": ""}
-        products = db.get_tariffs(category_id=0)
         subs = []
+        breadcrumbs = []
     else:
-        category = db.get_category(cat_id)
+        category = tree.get(cat_id)
         if not category:
             flash("Категория не найдена", "error")
             return redirect(url_for('main.index'))
-        products = db.get_tariffs(category_id=cat_id)
-        subs = db.get_categories(parent_id=cat_id)
-    return render_template('category.html', category=category, products=products, subcategories=subs)
+        subs = tree.nav(cat_id, depth=0)
+        breadcrumbs = tree.path(cat_id)[:-1]
+    page = catalog_page(cat_id)
+    return render_streamed('category.html', category=category, subcategories=subs, breadcrumbs=breadcrumbs,
+                           total_count=tree.own_count(cat_id), **page)
+
+@main_bp.route('/search')
+def search():
+    q = (request.args.get('q') or '').strip()
+    cat = request.args.get('cat')
+    cat_id = int(cat) if cat and cat.isdigit() else None
+    tree = category_tree.get_tree()
+    products = []
+    if q:
+        # фильтр по категории включает её подкатегории
+        cat_ids = tree.descendants(cat_id) if cat_id else None
+        products = db.search_tariffs(q, category_ids=cat_ids, limit=config.SEARCH_RESULTS_LIMIT)
+    return render_template('search.html', q=q, cat_id=cat_id, products=products,
+                           categories=tree.children_of(None))
 
 @main_bp.route('/product/<int:tariff_id>')
 def product_detail(tariff_id: int):
-    product = db.get_tariff(tariff_id)
+    product = catalog_cache.tariff(tariff_id)
     if not product:
         flash("Товар не найден", "error")
         return redirect(url_for('main.index'))
-    durations = db.get_tariff_durations(tariff_id)
+    durations = catalog_cache.durations(tariff_id)
     return render_template('product_detail.html', product=product, durations=durations)
 
 @main_bp.route('/add_to_cart', methods=['POST'])
@@ -190,7 +245,8 @@ def view_cart():
             flash("Промокод не найден", "warning")
     total_after = max(0, data['total'] - discount)
     return render_template('cart.html', items=data['items'], total=data['total'], 
-                           promo=promo, discount=discount, total_after=total_after)
+                           promo=promo, discount=discount, total_after=total_after,
+                           checkout_token=_checkout_token())
 
 @main_bp.route('/apply_promo', methods=['POST'])
 def apply_promo():
@@ -202,7 +258,105 @@ def apply_promo():
         session.pop('promo_code', None)
     return redirect(url_for('main.view_cart'))
 
+# -------------------- Идемпотентность checkout --------------------
+# Ключ = токен формы + хэш корзины/суммы/способа оплаты. Повтор в пределах окна (двойной клик,
+# ретрай браузера) возвращает уже созданный заказ и не делает второй вызов к платёжке.
+# Ключи — в Redis (SET NX EX, общий для воркеров и нод: дубль может прийти в другой процесс);
+# значение — payment_id, пока счёт создаётся — пустая строка. Без Redis — словарь в процессе.
+
+_CHECKOUT_KEYS: Dict[str, Dict[str, Any]] = {}
+_checkout_lock = threading.Lock()
+_CHECKOUT_PREFIX = "checkout:"
+
+def _checkout_token() -> str:
+    token = session.get('checkout_token')
+    if not token:
+        token = session['checkout_token'] = uuid.uuid4().hex
+    return token
+
+def _checkout_key(enriched: Dict[str, Any], total: int, method: str) -> Optional[str]:
+    token = request.form.get('checkout_token') or session.get('checkout_token')
+    if not token:
+        return None
+    cart = sorted((it['tariff_id'], it['duration_seconds'], it['quantity'], it['price']) for it in enriched['items'])
+    raw = json.dumps([token, int(session.get('user_id') or -1), cart, total, method])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _checkout_claim_local(key: str) -> Tuple[bool, Dict[str, Any]]:
+    now = time.time()
+    with _checkout_lock:
+        for k in [k for k, e in _CHECKOUT_KEYS.items() if now - e['at'] > config.CHECKOUT_IDEMPOTENCY_WINDOW]:
+            _CHECKOUT_KEYS.pop(k, None)
+        entry = _CHECKOUT_KEYS.get(key)
+        if entry is not None:
+            return False, entry
+        entry = _CHECKOUT_KEYS[key] = {"payment_id": None, "at": now, "done": threading.Event()}
+        return True, entry
+
+def _checkout_claim(key: Optional[str]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """(True, запись) — этот запрос создаёт платёж; (False, запись) — повтор уже созданного/создаваемого."""
+    if key is None:
+        return True, None
+    try:
+        r = clients.redis_client()
+        with metrics.upstream("redis.checkout"):
+            if r.set(_CHECKOUT_PREFIX + key, "", nx=True, ex=config.CHECKOUT_IDEMPOTENCY_WINDOW):
+                return True, {"payment_id": None, "redis": True}
+            pid = r.get(_CHECKOUT_PREFIX + key)
+        return False, {"payment_id": pid.decode() if pid else None, "redis": True}
+    except Exception as e:
+        current_app.logger.warning(f"Checkout idempotency Redis error: {e}")
+    return _checkout_claim_local(key)
+
+def _checkout_release(key: Optional[str], entry: Optional[Dict[str, Any]], payment_id: Optional[str]) -> None:
+    if entry is None:
+        return
+    entry['payment_id'] = payment_id
+    if entry.get('redis'):
+        try:
+            r = clients.redis_client()
+            with metrics.upstream("redis.checkout"):
+                if payment_id is None:
+                    # платёж не создан — повтор должен пройти заново
+                    r.delete(_CHECKOUT_PREFIX + key)
+                else:
+                    r.set(_CHECKOUT_PREFIX + key, payment_id, xx=True, ex=config.CHECKOUT_IDEMPOTENCY_WINDOW)
+        except Exception as e:
+            current_app.logger.warning(f"Checkout idempotency Redis error: {e}")
+        return
+    if payment_id is None:
+        # платёж не создан — повтор должен пройти заново
+        with _checkout_lock:
+            if _CHECKOUT_KEYS.get(key) is entry:
+                _CHECKOUT_KEYS.pop(key, None)
+    entry['done'].set()
+
+def _checkout_wait(key: str, entry: Dict[str, Any]) -> None:
+    """Дождаться счёта первого запроса (он может быть ещё в полёте, в том числе в другом воркере)."""
+    if not entry.get('redis'):
+        entry['done'].wait(config.CHECKOUT_DUPLICATE_WAIT)
+        return
+    deadline = time.monotonic() + config.CHECKOUT_DUPLICATE_WAIT
+    try:
+        r = clients.redis_client()
+        while not entry['payment_id'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+            pid = r.get(_CHECKOUT_PREFIX + key)
+            if pid is None:
+                break   # первый запрос не создал платёж
+            entry['payment_id'] = pid.decode() or None
+    except Exception as e:
+        current_app.logger.warning(f"Checkout idempotency Redis error: {e}")
+
+def _checkout_existing(entry: Dict[str, Any]):
+    pid = entry.get('payment_id')
+    if pid and (entry.get('redis') or pid in PENDING_ORDERS):
+        return redirect(url_for('main.payment', payment_id=pid))
+    flash("Платёж уже создаётся — подождите пару секунд и обновите страницу", "warning")
+    return redirect(url_for('main.view_cart'))
+
 @main_bp.route('/checkout', methods=['POST'])
+@ratelimit.limit('checkout')
 def checkout():
     cart = _session_cart()
     if not cart:
@@ -233,7 +387,12 @@ def checkout():
                     if promo.get('max_discount') and disc > int(promo['max_discount']):
                         disc = int(promo['max_discount'])
                 total = max(0, total - disc)
-    method = (request.form.get('method') or 'sbp').lower()
+    method = 'crypto' if (request.form.get('method') or 'sbp').lower() == 'crypto' else 'sbp'
+    key = _checkout_key(enriched, total, method)
+    owner, entry = _checkout_claim(key)
+    if not owner:
+        _checkout_wait(key, entry)
+        return _checkout_existing(entry)
     payment_id = str(uuid.uuid4())
     if method == 'crypto':
         payload = {
@@ -246,8 +405,9 @@ def checkout():
             "Crypto-Pay-API-Token": config.CRYPTO_PAY_TOKEN
         }
         try:
-            resp = requests.post(f"{config.CRYPTO_PAY_BASE_URL}/createInvoice", json=payload, headers=headers, timeout=30)
-            data = resp.json()
+            with metrics.upstream("cryptopay.create_invoice"):
+                resp = clients.http().post(f"{config.CRYPTO_PAY_BASE_URL}/createInvoice", json=payload, headers=headers, timeout=30)
+                data = resp.json()
             result = data.get('result') or {}
             invoice_id = None
             redirect_url = None
@@ -260,6 +420,7 @@ def checkout():
             if not (redirect_url and invoice_id):
                 raise RuntimeError('No invoice data from CryptoBot')
         except Exception as e:
+            _checkout_release(key, entry, None)
             current_app.logger.exception(e)
             flash("Ошибка инициализации крипто-платежа", "error")
             return redirect(url_for('main.view_cart'))
@@ -289,12 +450,14 @@ def checkout():
             "X-Secret": config.PLATEGA_API_KEY
         }
         try:
-            resp = requests.post(config.PLATEGA_CREATE_URL, json=payload, headers=headers, timeout=30)
-            data = resp.json()
+            with metrics.upstream("platega.create"):
+                resp = clients.http().post(config.PLATEGA_CREATE_URL, json=payload, headers=headers, timeout=30)
+                data = resp.json()
             redirect_url = data.get('redirect')
             if not redirect_url:
                 raise RuntimeError('No redirect URL from Platega')
         except Exception as e:
+            _checkout_release(key, entry, None)
             current_app.logger.exception(e)
             flash("Ошибка инициализации платежа", "error")
             return redirect(url_for('main.view_cart'))
@@ -307,6 +470,7 @@ def checkout():
             "delivered": False,
             "created_at": int(time.time())
         }
+    _checkout_release(key, entry, payment_id)
     # переходим на нашу страницу оплаты (покажем QR и будем опрашивать статус)
     return redirect(url_for('main.payment', payment_id=payment_id))
 
@@ -320,6 +484,7 @@ def payment(payment_id: str):
                            redirect_url=order['redirect_url'], is_crypto=(order.get('method') == 'crypto'))
 
 @main_bp.route('/api/platega_qr/<payment_id>')
+@ratelimit.limit('platega_qr')
 def api_platega_qr(payment_id: str):
     order = PENDING_ORDERS.get(payment_id)
     if not order:
@@ -331,7 +496,7 @@ def api_platega_qr(payment_id: str):
     except Exception as e:
         return jsonify({"ok": False, "need_open": True, "redirect_url": url})
     try:
-        with sync_playwright() as p:
+        with metrics.upstream("playwright.qr"), sync_playwright() as p:
             browser = p.chromium.launch(headless=True)
             page = browser.new_page()
             page.goto(url, timeout=60000)
@@ -355,7 +520,24 @@ def api_platega_qr(payment_id: str):
         current_app.logger.warning(f"QR parse failed: {e}")
         return jsonify({"ok": False, "need_open": True, "redirect_url": url})
 
+def _deliver_confirmed(payment_id: str, order: Dict[str, Any]) -> bool:
+    """Выдать оплаченный заказ, если он ещё не выдан. False — выдать не удалось, платёж не помечен."""
+    if order.get('delivered') or db.is_payment_processed(payment_id):
+        return True
+    try:
+        _deliver_order(payment_id, order)
+    except db_writer.WriteOutcomeUnknown as e:
+        # запись выдачи могла пройти: повтор на следующем опросе продлил бы срок второй раз
+        current_app.logger.error(f"Delivery outcome unknown for {payment_id}, needs manual check: {e}")
+    except DeliveryError as e:
+        # повторная проверка статуса попробует снова; до этого заказ видно в логе
+        current_app.logger.error(f"Delivery failed for paid order {payment_id}: {e}")
+        return False
+    order['delivered'] = True
+    return True
+
 @main_bp.route('/api/payment_status/<payment_id>')
+@ratelimit.limit('payment_status')
 def api_payment_status(payment_id: str):
     order = PENDING_ORDERS.get(payment_id)
     if not order:
@@ -366,9 +548,10 @@ def api_payment_status(payment_id: str):
             return jsonify({"ok": False, "status": "error", "message": "invoice missing"}), 200
         headers = {"Crypto-Pay-API-Token": config.CRYPTO_PAY_TOKEN}
         try:
-            resp = requests.get(f"{config.CRYPTO_PAY_BASE_URL}/getInvoices", params={"invoice_ids": invoice_id},
-                                headers=headers, timeout=20)
-            data = resp.json()
+            with metrics.upstream("cryptopay.status"):
+                resp = clients.http().get(f"{config.CRYPTO_PAY_BASE_URL}/getInvoices", params={"invoice_ids": invoice_id},
+                                          headers=headers, timeout=20)
+                data = resp.json()
         except Exception:
             return jsonify({"ok": False, "status": "error", "message": "status check failed"}), 200
         status = None
@@ -382,9 +565,8 @@ def api_payment_status(payment_id: str):
             elif isinstance(result, list) and result:
                 status = str(result[0].get('status') or '').lower()
         if status in {"paid", "completed"}:
-            if not order.get('delivered') and not db.is_payment_processed(payment_id):
-                _deliver_order(payment_id, order)
-                order['delivered'] = True
+            if not _deliver_confirmed(payment_id, order):
+                return jsonify({"ok": True, "status": "delivery_failed"})
             return jsonify({"ok": True, "status": "confirmed"})
         if status in {"active", "pending"}:
             return jsonify({"ok": True, "status": "pending"})
@@ -394,35 +576,47 @@ def api_payment_status(payment_id: str):
     status_url = config.PLATEGA_STATUS_URL.format(payment_id=payment_id)
     headers = {"X-MerchantId": config.PLATEGA_MERCHANT_ID, "X-Secret": config.PLATEGA_API_KEY}
     try:
-        resp = requests.get(status_url, headers=headers, timeout=20)
-        data = resp.json()
+        with metrics.upstream("platega.status"):
+            resp = clients.http().get(status_url, headers=headers, timeout=20)
+            data = resp.json()
         status = (data.get('status') or '').lower()
     except Exception:
         return jsonify({"ok": False, "status": "error", "message": "status check failed"}), 200
     success_states = {"successful", "success", "completed", "paid", "confirmed"}
     if status in success_states:
-        if not order.get('delivered') and not db.is_payment_processed(payment_id):
-            _deliver_order(payment_id, order)
-            order['delivered'] = True
+        if not _deliver_confirmed(payment_id, order):
+            return jsonify({"ok": True, "status": "delivery_failed"})
         return jsonify({"ok": True, "status": "confirmed"})
     if status in {"pending", "processing", "created"}:
         return jsonify({"ok": True, "status": "pending"})
     return jsonify({"ok": True, "status": status})
 
+@main_bp.route('/api/session')
+def api_session():
+    """Сессионная часть статических страниц (static_export.py): корзина, вход, flash-сообщения."""
+    uid = session.get('user_id')
+    cart = session.get('cart') or []
+    resp = jsonify({
+        "cart_count": sum(int(it.get('quantity', 1)) for it in cart),
+        "user_id": uid,
+        "is_admin": bool(uid) and int(uid) in config.ADMINS,
+        "admin_url": url_for('admin.index'),
+        "logout_url": url_for('main.logout'),
+        # сообщение после «В корзину» со статической страницы иначе всплыло бы на следующей динамической
+        "messages": [{"category": c, "text": m} for c, m in get_flashed_messages(with_categories=True)],
+    })
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
 @main_bp.route('/account')
 def account():
     tg_id = int(session.get('user_id') or -1)
     purchases = []
     guest_purchases = session.get('guest_purchases') or []
     if tg_id > 0:
+        # даты форматирует фильтр dt (с кэшем по timestamp)
         purchases = db.get_purchases(tg_id)
-        # человеко-читаемые даты
-        for p in purchases:
-            if p.get('expires_at'):
-                p['expires_at_h'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(p['expires_at'])))
-            else:
-                p['expires_at_h'] = None
-    return render_template('account.html', purchases=purchases, guest_purchases=guest_purchases)
+    return render_streamed('account.html', purchases=purchases, guest_purchases=guest_purchases)
 
 @main_bp.route('/refresh_access/<int:purchase_id>')
 def refresh_access(purchase_id: int):
@@ -436,11 +630,9 @@ def refresh_access(purchase_id: int):
             # попробуем выдать ту же ссылку (или другую из списка каналов)
             chans = db.get_tariff_channels(int(p['tariff_id']))
             cmap = db.get_channels_map()
-            link = None; cid = None
-            for c in chans:
-                row = cmap.get(int(c))
-                if row and row.get('invite_link'):
-                    link = row['invite_link']; cid = int(c); break
+            # тот же канал, если он ещё принимает; иначе — новый через аллокатор
+            cid = channel_alloc.keep_or_pick(int(p['tariff_id']), p.get('last_channel_id'), chans, cmap)
+            link = cmap[cid]['invite_link'] if cid is not None else None
             if not link:
                 flash("Нет доступных ссылок канала", "warning")
                 return redirect(url_for('main.account'))
@@ -476,34 +668,56 @@ def logout():
 
 # -------------------- Внутренняя выдача заказа --------------------
 
+class DeliveryError(RuntimeError):
+    """Оплаченную позицию не удалось выдать; платёж остаётся необработанным до повтора."""
+
 def _deliver_order(payment_id: str, order: Dict[str, Any]) -> None:
     tg_id = int(order.get('user_id') or -1)
     items = order['items']
     # Для гостей (tg_id <= 0) — выдаём только текстовые товары в сессию (account -> guest_purchases)
     guest_accum = session.get('guest_purchases') or []
     channels_map = db.get_channels_map()
-    for it in items:
-        t = db.get_tariff(int(it['tariff_id']))
-        if not t:
-            continue
+    # готовые планы из памяти: бандл (в т.ч. вложенный) уже раскрыт в плоский список без повторов
+    plans = [bundles.plan(int(it['tariff_id'])) for it in items]
+    # строки товаров (payload, тип) — свежие из базы, одним запросом на весь заказ
+    rows = {int(t['id']): t for t in db.get_tariffs_by_ids(list({tid for plan in plans for tid in plan}))}
+    for i, it in enumerate(items):
+        if not plans[i] or any(tid not in rows for tid in plans[i]):
+            # план устарел (товар удалён или пересобран ботом) — раскрываем по базе
+            plans[i] = bundles.plan_from_db(int(it['tariff_id']))
+            rows.update({int(t['id']): t for t in db.get_tariffs_by_ids([tid for tid in plans[i] if tid not in rows])})
+        if not plans[i]:
+            raise DeliveryError(f"nothing to deliver for tariff {it['tariff_id']}")
+    # позиции, выданные прошлой попыткой, при повторе не продлеваются второй раз
+    done = order.setdefault('delivered_steps', [])
+    for i, (it, plan) in enumerate(zip(items, plans)):
         price = int(it['price']) * int(it['quantity'])
         dur = int(it.get('duration_seconds') or 0)
-        if t['t_type'] == 'bundle':
-            # выдаём бандл как набор его товаров
-            for child_id in db.get_bundle_items(int(t['id'])):
-                _deliver_single(tg_id, db.get_tariff(child_id), price=0, duration=dur,
-                                payment_id=payment_id, channels_map=channels_map, guest_accum=guest_accum)
-        else:
-            _deliver_single(tg_id, t, price=price, duration=dur,
+        is_bundle = plan != [int(it['tariff_id'])]
+        for tid in plan:
+            step = f"{i}:{tid}"
+            if step in done:
+                continue
+            # товары бандла записываются с нулевой ценой — сумма заказа уже в payments
+            _deliver_single(tg_id, rows[tid], price=0 if is_bundle else price, duration=dur,
                             payment_id=payment_id, channels_map=channels_map, guest_accum=guest_accum)
+            done.append(step)
+    # Агрегаты продаж — после выдачи и до записи в payments: платёж уже помечен учтённым,
+    # и догоняющий проход по payments не посчитает этот заказ второй раз. Выручка — оплаченная сумма
+    try:
+        analytics.record_order(payment_id, tg_id, items, int(order['total']))
+    except Exception as e:
+        current_app.logger.warning(f"Sales analytics update failed for {payment_id}: {e}")
+    popularity.record(items)
     # Пометим платёж
     if tg_id > 0:
         db.mark_payment_processed(payment_id, tg_id, int(order['total']))
     order['delivered'] = True
     # Сохраним гостевые покупки обратно в сессию
     session['guest_purchases'] = guest_accum
-    # Корзину очищаем
+    # Корзину очищаем, следующий заказ получит новый токен идемпотентности
     session['cart'] = []
+    session.pop('checkout_token', None)
 
 def _deliver_single(tg_id: int, tariff: Dict[str, Any], price: int, duration: int,
                     payment_id: str, channels_map: Dict[int, Dict[str, Any]], guest_accum: List[Dict[str, Any]]):
@@ -535,10 +749,12 @@ def _deliver_single(tg_id: int, tariff: Dict[str, Any], price: int, duration: in
         # Канал / прочее: нужна ссылка приглашения
         chans = db.get_tariff_channels(int(tariff['id']))
         invite_link = None; chosen_cid = None
-        for cid in chans:
-            row = channels_map.get(int(cid))
-            if row and row.get('invite_link'):
-                invite_link = row['invite_link']; chosen_cid = int(cid); break
+        if tg_id > 0:
+            # канал выбирает аллокатор: нагрузка на одобрение заявок распределяется по каналам товара
+            chosen_cid = channel_alloc.pick(int(tariff['id']), chans, channels_map)
+            if chosen_cid is None:
+                raise DeliveryError(f"no channel with invite link for tariff {tariff['id']}")
+            invite_link = channels_map[chosen_cid]['invite_link']
         if invite_link and tg_id > 0:
             db.upsert_purchase(tg_id, int(tariff['id']), price=price, link=invite_link,
                                duration_seconds=duration if duration > 0 else None,
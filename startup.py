@@ -0,0 +1,80 @@
+"""Профиль холодного старта: сколько стоит импорт каждого модуля и инициализация клиентов.
+
+    python -m startup            # отчёт по импорту wsgi (create_app) + инициализации
+    python -m startup --top 40
+
+Импорт измеряется в отдельном процессе через `python -X importtime`, инициализация — в текущем.
+"""
+from __future__ import annotations
+import argparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def import_profile(target: str = "wsgi") -> List[Tuple[str, int, int]]:
+    """[(модуль, self_us, cumulative_us)] для импорта target в чистом интерпретаторе."""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {target}"],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2))))
+    return rows
+
+def by_package(rows: List[Tuple[str, int, int]]) -> Dict[str, int]:
+    """Суммарное собственное время импорта по верхнеуровневым пакетам (flask, jinja2, requests, ...)."""
+    out: Dict[str, int] = {}
+    for name, self_us, _ in rows:
+        top = name.split(".")[0]
+        out[top] = out.get(top, 0) + self_us
+    return out
+
+def _rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 if sys.platform != "darwin" else rss / (1024.0 * 1024.0)
+
+def init_profile() -> List[Tuple[str, float, float]]:
+    """[(шаг, секунды, RSS МБ после шага)] — импорт приложения и первая инициализация тяжёлых клиентов."""
+    steps: List[Tuple[str, Callable[[], object]]] = [
+        ("import wsgi (create_app)", lambda: __import__("wsgi")),
+        ("catalog warm-up", lambda: __import__("app").warm_catalog()),
+        ("clients.http() (requests)", lambda: __import__("clients").http()),
+        ("clients.redis_client() (redis)", lambda: __import__("clients").redis_client()),
+        ("import playwright.sync_api", lambda: __import__("playwright.sync_api")),
+    ]
+    out = []
+    for name, fn in steps:
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            name = f"{name} [ошибка: {e.__class__.__name__}]"
+        out.append((name, time.perf_counter() - t0, _rss_mb()))
+    return out
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Профиль холодного старта витрины")
+    ap.add_argument("--target", default="wsgi")
+    ap.add_argument("--top", type=int, default=25)
+    a = ap.parse_args(argv)
+
+    rows = import_profile(a.target)
+    total = sum(r[1] for r in rows)
+    print(f"Импорт `{a.target}`: {total / 1000:.1f} ms, модулей: {len(rows)}")
+    print(f"\n{'пакет':<28}{'self, ms':>10}")
+    for pkg, us in sorted(by_package(rows).items(), key=lambda kv: kv[1], reverse=True)[:a.top]:
+        print(f"{pkg:<28}{us / 1000:>10.1f}")
+    print(f"\n{'шаг инициализации':<40}{'ms':>10}{'RSS, MB':>10}")
+    for name, secs, rss in init_profile():
+        print(f"{name:<40}{secs * 1000:>10.1f}{rss:>10.1f}")
+
+if __name__ == "__main__":
+    main()
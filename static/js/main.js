@@ -5,3 +5,70 @@ document.addEventListener('DOMContentLoaded', () => {
   el.classList.add('pulse');
   setTimeout(() => el.classList.remove('pulse'), 500);
 });
+
+// «Показать ещё»: догружаем следующую страницу (keyset-курсор в ссылке) и дописываем её в список
+document.addEventListener('click', async (e) => {
+  const btn = e.target.closest('[data-load-more]');
+  if (!btn) return;
+  const list = document.querySelector(btn.dataset.target);
+  if (!list) return;
+  e.preventDefault();
+  btn.setAttribute('aria-busy', 'true');
+  try {
+    const r = await fetch(btn.href, { headers: { 'X-Requested-With': 'fetch' } });
+    const doc = new DOMParser().parseFromString(await r.text(), 'text/html');
+    const fresh = doc.querySelector(btn.dataset.target);
+    if (fresh) list.append(...fresh.children);
+    const next = doc.querySelector('[data-load-more]');
+    if (next) {
+      btn.href = next.getAttribute('href');
+      btn.removeAttribute('aria-busy');
+    } else {
+      (btn.closest('.load-more') || btn).remove();
+    }
+  } catch (err) {
+    window.location = btn.href;
+  }
+});
+
+// Статическая выгрузка (static_export.py): страница одна для всех, поэтому корзину и ссылки входа
+// подставляем из /api/session уже в браузере
+document.addEventListener('DOMContentLoaded', async () => {
+  const url = document.body.dataset.sessionUrl;
+  if (!url) return;
+  try {
+    const r = await fetch(url, { credentials: 'same-origin', headers: { 'X-Requested-With': 'fetch' } });
+    if (!r.ok) return;
+    const s = await r.json();
+    const count = document.getElementById('cart-count');
+    if (count) count.textContent = s.cart_count;
+    const main = document.querySelector('.main .container');
+    if (main && s.messages.length) {
+      const list = document.createElement('div');
+      list.className = 'flash-list';
+      for (const m of s.messages) {
+        const el = document.createElement('div');
+        el.className = `flash flash-${m.category}`;
+        el.textContent = m.text;
+        list.append(el);
+      }
+      main.prepend(list);
+    }
+    if (!s.user_id) return;
+    const nav = document.getElementById('session-nav');
+    if (nav) {
+      nav.replaceChildren();
+      const links = s.is_admin ? [[s.admin_url, 'Админ'], [s.logout_url, 'Выход']] : [[s.logout_url, 'Выход']];
+      for (const [href, label] of links) {
+        const a = document.createElement('a');
+        a.href = href;
+        a.textContent = label;
+        nav.append(a);
+      }
+    }
+    // виджет входа Telegram вошедшему пользователю не нужен
+    document.querySelectorAll('iframe[id^="telegram-login"]').forEach((el) => el.remove());
+  } catch (err) {
+    // страница остаётся анонимной
+  }
+});
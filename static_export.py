@@ -0,0 +1,147 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+from typing import List, Dict, Any, Tuple
+
+import config
+import db
+import category_tree
+import catalog_cache
+import popularity
+
+# Статическая выгрузка витрины для CDN/nginx: главная, страницы категорий и карточки товаров
+# рендерятся обычными маршрутами (анонимная сессия, первая страница каждого списка) в OUT_DIR/.../index.html.
+# Корзина и ссылки входа на таких страницах подтягиваются из /api/session (static/js/main.js).
+# Для каждой страницы считается отпечаток данных, из которых она собрана (+ шаблоны и настройки рендера),
+# и в .manifest.json хранятся отпечатки прошлой выгрузки — перерисовываются только изменившиеся страницы,
+# страницы удалённых товаров и категорий удаляются.
+
+MANIFEST = ".manifest.json"
+STATIC_HEADER = "X-Static-Export"
+
+def _digest(*parts: Any) -> str:
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode()
+    return hashlib.sha1(raw).hexdigest()
+
+def _templates_digest() -> str:
+    """Шаблоны и настройки, от которых зависит разметка любой страницы."""
+    h = hashlib.sha1()
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isfile(path):
+            h.update(name.encode())
+            with open(path, "rb") as f:
+                h.update(f.read())
+    h.update(_digest(config.SITE_URL, config.TELEGRAM_LOGIN_BOT, config.CATALOG_PAGE_SIZE,
+                     config.BESTSELLERS_LIMIT).encode())
+    return h.hexdigest()
+
+def _snapshot() -> Tuple[Dict[int, str], Dict[int, List[Dict[str, Any]]]]:
+    """Все товары (id -> отпечаток строки) и варианты длительности — двумя запросами на всю выгрузку."""
+    conn = db._connect()
+    try:
+        tariffs = {int(r['id']): _digest(dict(r)) for r in conn.execute("SELECT * FROM tariffs;").fetchall()}
+        durations: Dict[int, List[Dict[str, Any]]] = {}
+        if db._table_exists(conn, "tariff_durations"):
+            for r in conn.execute("SELECT * FROM tariff_durations ORDER BY tariff_id, seconds;").fetchall():
+                durations.setdefault(int(r['tariff_id']), []).append(dict(r))
+        return tariffs, durations
+    finally:
+        conn.close()
+
+def plan_pages() -> Dict[str, Tuple[str, str]]:
+    """Страницы выгрузки: относительный путь файла -> (URL маршрута, отпечаток данных)."""
+    tree = category_tree.CategoryTree(*db.get_category_snapshot())   # прямо из базы, мимо кэшей с TTL
+    tariffs, durations = _snapshot()
+    tpl = _templates_digest()
+    by_cat: Dict[int, List[str]] = {}
+    for tid, cid in sorted(tree.tariff_cat.items()):
+        if tid in tariffs:
+            by_cat.setdefault(cid, []).append(tariffs[tid])
+    pages: Dict[str, Tuple[str, str]] = {}
+
+    bestsellers = []
+    for _, tid in popularity.get_index().ranked():
+        if tid in tree.tariff_cat:
+            bestsellers.append(tid)
+            if len(bestsellers) >= config.BESTSELLERS_LIMIT:
+                break
+    pages["index.html"] = ("/", _digest(tpl, tree.nav(None, depth=0), by_cat.get(0, []),
+                                        [tariffs.get(tid) for tid in bestsellers]))
+    pages["category/0/index.html"] = ("/category/0", _digest(tpl, by_cat.get(0, [])))
+    for cid in tree.nodes:
+        pages[f"category/{cid}/index.html"] = (
+            f"/category/{cid}",
+            _digest(tpl, tree.get(cid), tree.nav(cid, depth=0), tree.path(cid), by_cat.get(cid, [])))
+    for tid, row_digest in tariffs.items():
+        pages[f"product/{tid}/index.html"] = (f"/product/{tid}", _digest(tpl, row_digest, durations.get(tid, [])))
+    return pages
+
+def _load_manifest(out_dir: str) -> Dict[str, str]:
+    try:
+        with open(os.path.join(out_dir, MANIFEST), encoding="utf-8") as f:
+            return json.load(f).get("pages", {})
+    except (OSError, ValueError):
+        return {}
+
+def _write_file(path: str, data: bytes) -> None:
+    # через временный файл: nginx не отдаст наполовину записанную страницу
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _prune(out_dir: str, rel: str) -> None:
+    path = os.path.join(out_dir, rel)
+    try:
+        os.remove(path)
+    except OSError:
+        return
+    # пустые каталоги category/<id>/, product/<id>/
+    parent = os.path.dirname(path)
+    while os.path.abspath(parent) != os.path.abspath(out_dir):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+def export(app, out_dir: str, force: bool = False) -> Dict[str, int]:
+    """Выгрузить страницы в out_dir. Возвращает {"rendered", "unchanged", "removed", "failed"}."""
+    os.makedirs(out_dir, exist_ok=True)
+    # прошлый манифест нужен и с force: по нему удаляются страницы исчезнувших товаров и категорий
+    old = _load_manifest(out_dir)
+    pages = plan_pages()
+    done: Dict[str, str] = {}
+    stats = {"rendered": 0, "unchanged": 0, "removed": 0, "failed": 0}
+    client = app.test_client()
+    # рендер из тех же данных, по которым считались отпечатки, а не из кэшей с TTL
+    category_tree.invalidate()
+    with catalog_cache.bypass():
+        for rel, (url, fp) in sorted(pages.items()):
+            if not force and old.get(rel) == fp and os.path.exists(os.path.join(out_dir, rel)):
+                done[rel] = fp
+                stats["unchanged"] += 1
+                continue
+            resp = client.get(url, base_url=config.SITE_URL, headers={STATIC_HEADER: "1"})
+            if resp.status_code != 200:
+                # товар/категория исчезли между снимком и рендером — страница уйдёт при следующей выгрузке
+                app.logger.warning(f"Static export: {url} -> {resp.status_code}")
+                stats["failed"] += 1
+                continue
+            _write_file(os.path.join(out_dir, rel), resp.get_data())
+            done[rel] = fp
+            stats["rendered"] += 1
+    for rel in old:
+        if rel not in pages:
+            _prune(out_dir, rel)
+            stats["removed"] += 1
+    _write_file(os.path.join(out_dir, MANIFEST),
+                json.dumps({"pages": done}, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return stats
+
+def is_static_request(request) -> bool:
+    return request.headers.get(STATIC_HEADER) == "1"
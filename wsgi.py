@@ -0,0 +1,5 @@
+import app as factory
+
+# Точка входа для WSGI-сервера: экземпляр собирается один раз при первом обращении к app.app.
+# gunicorn --preload -w 4 wsgi:app   (PRELOAD_CATALOG=1 — собрать каталог в мастере до fork)
+app = factory.app